@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import WardrobeItem, Colour, PredefinedPair, ItemColor, FinalSelection
+from .models import WardrobeItem, Colour, PredefinedPair, ItemColor, FinalSelection, FileTombstone
 
 @admin.register(WardrobeItem)
 class WardrobeItemAdmin(admin.ModelAdmin):
@@ -27,3 +27,8 @@ class ItemColorAdmin(admin.ModelAdmin):
 @admin.register(FinalSelection)
 class FinalSelectionAdmin(admin.ModelAdmin):
     list_display = ('top', 'bottom', 'created_at')
+
+@admin.register(FileTombstone)
+class FileTombstoneAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created_at')
+    search_fields = ('name',)
@@ -0,0 +1,472 @@
+import json
+import os
+import platform
+import time
+from contextlib import contextmanager
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+from api.models import Colour, FinalSelection, ItemColor, PredefinedPair, WardrobeItem
+from api.serializers import FinalSelectionSerializer, WardrobeItemSerializer
+from api.views import get_final_selections
+from api.utils import segmentation
+from api.utils.color_matcher import (
+    get_palette,
+    get_top_matches_for_colours,
+    get_top_matches_lab,
+    get_top_matches_rgb,
+    get_top_matches_within_threshold,
+    invalidate_palette,
+)
+from api.utils.color_processor import (
+    DOMINANT_COLOUR_EXTRACTORS,
+    analyse_uploaded_image,
+    apply_mask,
+    convert_to_cv2,
+    get_dominant_rgb,
+    load_analysis_image,
+    remove_background_from_file,
+)
+from api.utils.outfit_matcher import invalidate_compatibility
+from api.utils.synthetic import generate_garment_images, generate_wardrobe
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def load_sample_images(directory, limit=None):
+    """Read the sample images in a directory as (file name, bytes) pairs"""
+    if not os.path.isdir(directory):
+        raise CommandError(f"Image directory not found: {directory}")
+    # Stored wardrobe images are sharded into subdirectories
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:limit]
+    samples = []
+    for path in paths:
+        with open(path, "rb") as img_file:
+            samples.append((os.path.basename(path), img_file.read()))
+    return samples
+
+
+def load_samples(options):
+    """Sample images as (name, bytes, mask) triples, synthetic ones if asked for
+
+    Synthetic garments come with their mask, so they skip the segmentation model.
+    """
+    if options["synthetic"]:
+        palette = [tuple(map(int, rgb)) for rgb in get_palette().rgb]
+        return [
+            (name, image_bytes, mask)
+            for name, image_bytes, mask, _ in generate_garment_images(
+                options["synthetic"], seed=options["seed"], palette=palette
+            )
+        ]
+
+    samples = load_sample_images(options["images"], options["limit"])
+    if not samples:
+        raise CommandError(f"No sample images in {options['images']}")
+    segmentation.warm_up()
+    return [(name, image_bytes, None) for name, image_bytes in samples]
+
+
+@contextmanager
+def scratch_database(palette_fixture=None, keepdb=False):
+    """Run against an empty copy of the database holding only the palette and its pairs
+
+    The palette comes from the configured database, or from a fixture dumped
+    with `dumpdata api.Colour api.PredefinedPair`. Scenarios that write
+    synthetic wardrobes never touch the real tables.
+    """
+    if palette_fixture is None:
+        colours = list(Colour.objects.values())
+        pairs = list(PredefinedPair.objects.values("top_colour_id", "bottom_colour_id"))
+
+    old_name = connection.settings_dict["NAME"]
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    migrate = test_settings.get("MIGRATE", True)
+    # Tables straight from the models: the data migrations need Postgres and
+    # the palette source files
+    test_settings["MIGRATE"] = False
+    try:
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb
+        )
+    finally:
+        test_settings["MIGRATE"] = migrate
+
+    try:
+        if palette_fixture is not None:
+            call_command("loaddata", palette_fixture, verbosity=0)
+        elif not Colour.objects.exists():
+            Colour.objects.bulk_create(Colour(**colour) for colour in colours)
+            PredefinedPair.objects.bulk_create(PredefinedPair(**pair) for pair in pairs)
+        invalidate_palette()
+        invalidate_compatibility()
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+        invalidate_palette()
+        invalidate_compatibility()
+
+
+@contextmanager
+def rolled_back():
+    """Run a block in a transaction that is always rolled back"""
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def synthetic_wardrobe(size, seed):
+    """Insert a synthetic wardrobe of size items, half tops and half bottoms"""
+    try:
+        return generate_wardrobe(size // 2, size - size // 2, seed=seed)
+    except ValueError as e:
+        raise CommandError(str(e))
+
+
+def api_request(path):
+    """A GET request for path, as the API views receive it"""
+    host = next(
+        (host for host in settings.ALLOWED_HOSTS if host != "*" and not host.startswith(".")),
+        "localhost",
+    )
+    return APIRequestFactory().get(path, HTTP_HOST=host)
+
+
+def timed(func, *args, **kwargs):
+    """Call func and return (result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def summarize(durations):
+    """Summary statistics, in milliseconds, for a list of durations in seconds"""
+    durations_ms = np.asarray(durations) * 1000
+    return {
+        "mean_ms": round(float(durations_ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(durations_ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(durations_ms, 95)), 2),
+    }
+
+
+def bench_resolution(options):
+    """Compare the dominant colour picked at full and at reduced analysis resolution"""
+    samples = load_samples(options)
+    max_size = options["max_size"] or settings.IMAGE_ANALYSIS_MAX_SIZE
+
+    per_image, full_times, reduced_times, deltas = [], [], [], []
+    for name, image_bytes, mask in samples:
+        full, full_time = timed(analyse_uploaded_image, image_bytes, mask=mask)
+        reduced, reduced_time = timed(analyse_uploaded_image, image_bytes, max_size, mask=mask)
+        full_rgb, reduced_rgb = full["rgb"], reduced["rgb"]
+        delta = float(np.linalg.norm(np.subtract(full_rgb, reduced_rgb)))
+
+        full_times.append(full_time)
+        reduced_times.append(reduced_time)
+        deltas.append(delta)
+        per_image.append(
+            {
+                "image": name,
+                "full_rgb": full_rgb,
+                "reduced_rgb": reduced_rgb,
+                "rgb_distance": round(delta, 2),
+                "full_ms": round(full_time * 1000, 2),
+                "reduced_ms": round(reduced_time * 1000, 2),
+            }
+        )
+
+    return {
+        "max_size": max_size,
+        "images": len(samples),
+        "full": summarize(full_times),
+        "reduced": summarize(reduced_times),
+        "mean_rgb_distance": round(float(np.mean(deltas)), 2),
+        "max_rgb_distance": round(float(np.max(deltas)), 2),
+        "per_image": per_image,
+    }
+
+
+def bench_extractors(options):
+    """Compare the accuracy and latency of each dominant colour extractor against MeanShift"""
+    samples = load_samples(options)
+    max_size = options["max_size"] or settings.IMAGE_ANALYSIS_MAX_SIZE
+    extractors = options["extractors"] or list(DOMINANT_COLOUR_EXTRACTORS)
+
+    # Segment every sample once so only the extraction step is timed
+    images = []
+    for _, image_bytes, mask in samples:
+        image = load_analysis_image(image_bytes, max_size)
+        cutout = remove_background_from_file(image) if mask is None else apply_mask(image, mask)
+        images.append(convert_to_cv2(cutout))
+    baseline = [get_dominant_rgb(image, "meanshift") for image in images]
+
+    results = {}
+    for extractor in extractors:
+        durations, deltas = [], []
+        for image, baseline_rgb in zip(images, baseline):
+            rgb, duration = timed(get_dominant_rgb, image, extractor)
+            durations.append(duration)
+            deltas.append(float(np.linalg.norm(np.subtract(rgb, baseline_rgb))))
+
+        results[extractor] = {
+            **summarize(durations),
+            "images_per_second": round(len(durations) / sum(durations), 2),
+            "mean_rgb_distance_to_meanshift": round(float(np.mean(deltas)), 2),
+            "max_rgb_distance_to_meanshift": round(float(np.max(deltas)), 2),
+        }
+
+    return {"max_size": max_size, "images": len(samples), "extractors": results}
+
+
+def bench_matcher(options):
+    """Measure palette matching latency for single calls and batches of random colours"""
+    rng = np.random.default_rng(0)
+    colours = rng.integers(0, 256, size=(options["colours"], 3))
+    item_types = rng.choice(["TOP", "BOTTOM"], size=len(colours))
+
+    # Load the palette (and lookup tables, if enabled) before timing
+    get_top_matches_for_colours(colours, item_types)
+
+    single_times = [
+        timed(get_top_matches_within_threshold, *colour, item_type)[1]
+        for colour, item_type in zip(colours, item_types)
+    ]
+    _, batch_time = timed(get_top_matches_for_colours, colours, item_types)
+
+    return {
+        "colours": len(colours),
+        "index": getattr(settings, "COLOUR_MATCH_INDEX", None),
+        "single": {
+            **summarize(single_times),
+            "calls_per_second": round(len(single_times) / sum(single_times), 1),
+        },
+        "batch": {
+            "total_ms": round(batch_time * 1000, 2),
+            "colours_per_second": round(len(colours) / batch_time, 1),
+        },
+    }
+
+
+def bench_colour_space(options):
+    """Compare RGB and CIEDE2000 matching on palette colours with known added noise"""
+    palette = get_palette()
+    rng = np.random.default_rng(0)
+
+    # Perturb every palette colour, once per compatible item type, and remember its id
+    sources, item_types = [], []
+    for index, type_bits in enumerate(palette.type_mask):
+        for item_type, bit in (("TOP", 1), ("BOTTOM", 2)):
+            if type_bits & bit:
+                sources.extend([index] * options["samples"])
+                item_types.extend([item_type] * options["samples"])
+    if not sources:
+        raise CommandError("The Colour palette is empty")
+
+    sources = np.array(sources)
+    noise = rng.normal(0, options["noise"], size=(len(sources), 3))
+    colours = np.clip(np.round(palette.rgb[sources] + noise), 0, 255)
+    expected_ids = palette.ids[sources]
+
+    results = {}
+    for name, match in (("rgb", get_top_matches_rgb), ("lab", get_top_matches_lab)):
+        matches, duration = timed(match, colours, item_types)
+        single_times = [
+            timed(match, colour[None, :], [item_type])[1]
+            for colour, item_type in zip(colours[:500], item_types[:500])
+        ]
+        top_ids = np.array([ids[0] if len(ids) else -1 for ids in matches])
+
+        results[name] = {
+            "accuracy": round(float(np.mean(top_ids == expected_ids)), 4),
+            "unmatched": round(float(np.mean(top_ids == -1)), 4),
+            "batch_ms": round(duration * 1000, 2),
+            "single": summarize(single_times),
+        }
+
+    return {"colours": len(colours), "noise_sigma": options["noise"], "modes": results}
+
+
+def bench_final_selections(options):
+    """Time the outfit listing, in full and its first page, on synthetic wardrobes of each size"""
+    path = reverse("final-selections")
+    results = {}
+    for size in options["sizes"]:
+        with rolled_back():
+            synthetic_wardrobe(size, options["seed"])
+            outfits = FinalSelection.objects.count()
+            results[size] = {"outfits": outfits}
+
+            for name, request in (
+                ("full", api_request(path)),
+                ("first_page", api_request(f"{path}?page_size={options['page_size']}")),
+            ):
+                durations = []
+                for _ in range(options["repeat"]):
+                    with CaptureQueriesContext(connection) as queries:
+                        response, duration = timed(lambda: get_final_selections(request).render())
+                    durations.append(duration)
+                results[size][name] = {
+                    **summarize(durations),
+                    "queries": len(queries),
+                    "response_bytes": len(response.content),
+                }
+            results[size]["full"]["outfits_per_second"] = round(
+                outfits / (results[size]["full"]["p50_ms"] / 1000), 1
+            )
+    return {"repeat": options["repeat"], "page_size": options["page_size"], "items": results}
+
+
+def bench_serializers(options):
+    """Measure how many items and outfits per second the serializers turn into data"""
+    with rolled_back():
+        synthetic_wardrobe(options["items"], options["seed"])
+        request = api_request(reverse("final-selections"))
+        context = {"request": request}
+
+        # Load everything up front so only serialization is timed
+        items = list(WardrobeItem.objects.all())
+        item_colours = ItemColor.objects.select_related("colour")
+        selections = list(
+            FinalSelection.objects.select_related("top", "bottom").prefetch_related(
+                Prefetch("top__colors", queryset=item_colours),
+                Prefetch("bottom__colors", queryset=item_colours),
+            )
+        )
+
+        results = {}
+        for name, serializer_class, rows in (
+            ("wardrobe_items", WardrobeItemSerializer, items),
+            ("final_selections", FinalSelectionSerializer, selections),
+        ):
+            durations = [
+                timed(lambda: serializer_class(rows, many=True, context=context).data)[1]
+                for _ in range(options["repeat"])
+            ]
+            results[name] = {
+                **summarize(durations),
+                "rows": len(rows),
+                "rows_per_second": round(len(rows) / float(np.median(durations)), 1),
+            }
+    return {"items": options["items"], "repeat": options["repeat"], "serializers": results}
+
+
+def bench_suite(options):
+    """Every offline scenario, on synthetic wardrobes and synthetic garment photos"""
+    options = {**options, "synthetic": options["synthetic"] or 10}
+    return {name: SCENARIOS[name](options) for name in OFFLINE_SCENARIOS}
+
+
+SCENARIOS = {
+    "resolution": bench_resolution,
+    "extractors": bench_extractors,
+    "matcher": bench_matcher,
+    "colour-space": bench_colour_space,
+    "final-selections": bench_final_selections,
+    "serializers": bench_serializers,
+    "suite": bench_suite,
+}
+# What the suite runs; all of it works without sample photos or the segmentation model
+OFFLINE_SCENARIOS = ("final-selections", "serializers", "matcher", "extractors")
+# Scenarios that write synthetic wardrobes, so they run on a scratch database
+WRITING_SCENARIOS = ("final-selections", "serializers", "suite")
+
+
+class Command(BaseCommand):
+    help = "Run an offline benchmark scenario and print the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(SCENARIOS))
+        parser.add_argument(
+            "--images",
+            default=os.path.join(settings.MEDIA_ROOT, "wardrobe"),
+            help="Directory of sample garment photos",
+        )
+        parser.add_argument("--limit", type=int, help="Use at most this many images")
+        parser.add_argument(
+            "--max-size", type=int, help="Analysis resolution to compare against full size"
+        )
+        parser.add_argument(
+            "--extractors",
+            nargs="+",
+            choices=sorted(DOMINANT_COLOUR_EXTRACTORS),
+            help="Colour extractors to compare (default: all)",
+        )
+        parser.add_argument(
+            "--colours", type=int, default=1000, help="Random colours to match"
+        )
+        parser.add_argument(
+            "--samples", type=int, default=20, help="Noisy samples per palette colour"
+        )
+        parser.add_argument(
+            "--noise", type=float, default=8.0, help="RGB noise standard deviation"
+        )
+        parser.add_argument(
+            "--synthetic",
+            type=int,
+            help="Use this many generated garment photos instead of the image directory",
+        )
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[10, 100, 1000],
+            help="Synthetic wardrobe sizes to list outfits for",
+        )
+        parser.add_argument(
+            "--items", type=int, default=1000, help="Synthetic wardrobe size to serialize"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="Timed runs per measurement"
+        )
+        parser.add_argument(
+            "--page-size", type=int, default=100, help="Page size of the paginated listing"
+        )
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Seed of the synthetic wardrobes and photos"
+        )
+        parser.add_argument(
+            "--palette",
+            help="Fixture of Colour and PredefinedPair rows for the synthetic wardrobes "
+            "(default: copy them from the configured database)",
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Keep the scratch database between runs instead of migrating a new one",
+        )
+        parser.add_argument("--output", help="Also write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        scenario = options["scenario"]
+        # Enough about the run to tell whether two result files are comparable
+        results = {
+            "scenario": scenario,
+            "started_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "extractor": getattr(settings, "COLOUR_EXTRACTOR", "meanshift"),
+            "match_index": getattr(settings, "COLOUR_MATCH_INDEX", None),
+        }
+        if scenario in WRITING_SCENARIOS:
+            with scratch_database(options["palette"], options["keepdb"]):
+                results.update(SCENARIOS[scenario](options))
+        else:
+            results.update(SCENARIOS[scenario](options))
+        output = json.dumps(results, indent=2)
+
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                output_file.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,47 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from api.utils import segmentation
+from api.utils.image_pipeline import process_pending_items, requeue_stale_items
+
+
+class Command(BaseCommand):
+    help = "Worker that assigns colours to uploaded items waiting in the PENDING state"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Process the current backlog and exit"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=20, help="Items to pick up per poll"
+        )
+        parser.add_argument(
+            "--interval", type=float, default=2.0, help="Seconds to sleep when idle"
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=600,
+            help="Requeue items stuck in PROCESSING for this many seconds",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Loading segmentation model...")
+        segmentation.preload()
+        self.stdout.write("Waiting for uploads...")
+        while True:
+            # A long-running worker would otherwise keep a connection the
+            # database has since closed
+            close_old_connections()
+            requeued = requeue_stale_items(options["stale_after"])
+            if requeued:
+                self.stdout.write(f"Requeued {requeued} stale items")
+
+            handled = process_pending_items(limit=options["batch_size"])
+            if handled:
+                self.stdout.write(f"Processed {handled} items")
+
+            if options["once"] and not handled:
+                break
+            if not handled:
+                time.sleep(options["interval"])
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.models import WardrobeItem
+from api.utils.color_matcher import invalidate_palette
+from api.utils.image_pipeline import reclassify_items, rematch_items
+from api.utils.outfit_matcher import invalidate_compatibility, rebuild_final_selections
+
+
+def load_checkpoint(path):
+    """Read the progress saved by an interrupted run, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(path, checkpoint):
+    """Write the progress so far, replacing the previous checkpoint atomically"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = "Recompute the colours and outfits of every processed wardrobe item"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", type=int, default=200, help="Items recomputed per transaction"
+        )
+        parser.add_argument(
+            "--reanalyse",
+            action="store_true",
+            help="Run colour extraction again even where a current analysis is stored",
+        )
+        parser.add_argument(
+            "--rematch-only",
+            action="store_true",
+            help="Only match the stored colour analyses against the palette again, "
+            "without reading any image; items with no analysis keep their colours",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=os.path.join(settings.BASE_DIR, ".reclassify_checkpoint.json"),
+            help="File recording progress, so an interrupted run can resume",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint of an earlier run and start from the first item",
+        )
+
+    def handle(self, *args, **options):
+        checkpoint_path = options["checkpoint"]
+        checkpoint = None if options["restart"] else load_checkpoint(checkpoint_path)
+        if checkpoint:
+            self.stdout.write(f"Resuming after item {checkpoint['last_id']}")
+        else:
+            checkpoint = {"last_id": 0, "reused": 0, "reanalysed": 0, "failed": 0}
+
+        # Palette and pair changes made by data migrations don't send the signals
+        # that bump their versions
+        invalidate_palette()
+        invalidate_compatibility()
+
+        items = WardrobeItem.objects.filter(color_status="DONE").order_by("id")
+        total = items.filter(id__gt=checkpoint["last_id"]).count()
+        done, start = 0, time.perf_counter()
+
+        while True:
+            chunk = list(items.filter(id__gt=checkpoint["last_id"])[: options["chunk_size"]])
+            if not chunk:
+                break
+
+            if options["rematch_only"]:
+                unanalysed = rematch_items(chunk)
+                reused, reanalysed = len(chunk) - len(unanalysed), 0
+                errors = {item.id: "no stored analysis" for item in unanalysed}
+            else:
+                reused, reanalysed, errors = reclassify_items(
+                    chunk, reanalyse=options["reanalyse"]
+                )
+            for item_id, error in errors.items():
+                self.stderr.write(f"Item {item_id} kept its colours: {error}")
+
+            checkpoint["last_id"] = chunk[-1].id
+            checkpoint["reused"] += reused
+            checkpoint["reanalysed"] += reanalysed
+            checkpoint["failed"] += len(errors)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            done += len(chunk)
+            rate = done / (time.perf_counter() - start)
+            self.stdout.write(
+                f"{done}/{total} items ({rate:.1f} items/s): "
+                f"{reused} reused, {reanalysed} reanalysed, {len(errors)} failed"
+            )
+
+        # Outfits are rebuilt once every item has its new colours
+        created, deleted = rebuild_final_selections()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Reclassified {done} items in {time.perf_counter() - start:.1f}s "
+                f"({checkpoint['reused']} reused, {checkpoint['reanalysed']} reanalysed, "
+                f"{checkpoint['failed']} failed); outfits: {created} added, {deleted} removed"
+            )
+        )
@@ -0,0 +1,119 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import WardrobeItem
+from api.storage import hash_file, relocate_file, wardrobe_image_name
+from api.utils.thumbnails import flat_thumbnail_name, get_thumbnail_sizes, thumbnail_name
+
+
+class Command(BaseCommand):
+    help = "Move stored wardrobe images and their thumbnails into the current sharded layout"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="Items checked per database query"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the files that would move",
+        )
+
+    def handle(self, *args, **options):
+        storage = WardrobeItem._meta.get_field("image").storage
+        total = WardrobeItem.objects.count()
+        last_id, checked, moved, missing = 0, 0, 0, 0
+        # Old name -> (new name, content hash) of every file moved so far
+        relocated = {}
+        start = time.perf_counter()
+
+        while True:
+            batch = list(
+                WardrobeItem.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "image", "content_hash")[: options["batch_size"]]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            checked += len(batch)
+
+            # Items of the batch sharing a file are moved together. Ones in later
+            # batches are just repointed
+            item_ids, content_hashes = {}, {}
+            for item_id, image_name, content_hash in batch:
+                item_ids.setdefault(image_name, []).append(item_id)
+                content_hashes.setdefault(image_name, content_hash)
+
+            # Files uploaded before content hashing get their new name from their
+            # bytes. The hash is committed before the file moves, so a rerun after
+            # an interrupted batch still finds the file under its new name
+            for image_name, content_hash in content_hashes.items():
+                if content_hash or image_name in relocated or not storage.exists(image_name):
+                    continue
+                with storage.open(image_name, "rb") as img_file:
+                    content_hashes[image_name] = hash_file(img_file)
+                if not options["dry_run"]:
+                    WardrobeItem.objects.filter(id__in=item_ids[image_name]).update(
+                        content_hash=content_hashes[image_name]
+                    )
+
+            # Row updates are committed once per batch; files already moved by an
+            # interrupted batch are picked up at their new name on the next run
+            with transaction.atomic():
+                for image_name, content_hash in content_hashes.items():
+                    if image_name in relocated:
+                        new_name, content_hash = relocated[image_name]
+                        WardrobeItem.objects.filter(id__in=item_ids[image_name]).update(
+                            image=new_name, content_hash=content_hash
+                        )
+                        continue
+                    if not content_hash:
+                        missing += 1
+                        continue
+
+                    extension = os.path.splitext(image_name)[1].lower()
+                    new_name = wardrobe_image_name(f"{content_hash}{extension}")
+                    if options["dry_run"]:
+                        moved += new_name != image_name
+                        continue
+
+                    if new_name != image_name:
+                        moved_file = relocate_file(storage, image_name, new_name)
+                        if not moved_file and not storage.exists(new_name):
+                            self.stderr.write(
+                                f"{image_name} is missing, its items were left as they are"
+                            )
+                            missing += 1
+                            continue
+
+                    # Thumbnails may still be in the flat layout next to a sharded image
+                    for size in get_thumbnail_sizes():
+                        new_thumbnail = thumbnail_name(new_name, size)
+                        for old_thumbnail in (
+                            flat_thumbnail_name(image_name, size),
+                            thumbnail_name(image_name, size),
+                        ):
+                            relocate_file(storage, old_thumbnail, new_thumbnail)
+                    if new_name == image_name:
+                        continue
+
+                    WardrobeItem.objects.filter(id__in=item_ids[image_name]).update(
+                        image=new_name, content_hash=content_hash
+                    )
+                    relocated[image_name] = (new_name, content_hash)
+                    moved += 1
+
+            rate = checked / (time.perf_counter() - start)
+            self.stdout.write(
+                f"{checked}/{total} items checked ({rate:.1f} items/s): "
+                f"{moved} files {'to move' if options['dry_run'] else 'moved'}, {missing} missing"
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'Would move' if options['dry_run'] else 'Moved'} {moved} files "
+                f"in {time.perf_counter() - start:.1f}s ({missing} missing)"
+            )
+        )
@@ -0,0 +1,56 @@
+import time
+from django.core.management.base import BaseCommand
+from api.models import WardrobeItem
+from api.utils.file_gc import record_orphaned_files, sweep_file_tombstones
+
+
+class Command(BaseCommand):
+    help = "Delete the stored images and thumbnails that deleted wardrobe items left behind"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, help="Tombstones handled per transaction"
+        )
+        parser.add_argument(
+            "--grace",
+            type=int,
+            help="Only sweep files tombstoned at least this many seconds ago "
+            "(default FILE_GC_GRACE_SECONDS)",
+        )
+        parser.add_argument(
+            "--orphans",
+            action="store_true",
+            help="First scan storage for files no item uses, e.g. left by failed deletes",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Keep running, sweeping again every this many seconds",
+        )
+
+    def handle(self, *args, **options):
+        storage = WardrobeItem._meta.get_field("image").storage
+
+        if options["orphans"]:
+            start = time.perf_counter()
+            found = record_orphaned_files(storage)
+            self.stdout.write(
+                f"Found {found} orphaned files in {time.perf_counter() - start:.1f}s"
+            )
+
+        while True:
+            start = time.perf_counter()
+            files, reclaimed, kept = sweep_file_tombstones(
+                storage, batch_size=options["batch_size"], grace_seconds=options["grace"]
+            )
+            if files or kept or not options["interval"]:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"Deleted {files} files, reclaiming {reclaimed / 1e6:.1f} MB "
+                        f"({reclaimed} bytes), in {time.perf_counter() - start:.1f}s; "
+                        f"{kept} were in use again"
+                    )
+                )
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,40 @@
+from collections import defaultdict
+from itertools import product
+from django.db import migrations
+
+
+def backfill_final_selections(apps, schema_editor):
+    # Selections used to be created lazily on read; they are now created on
+    # upload, so materialize the ones for items uploaded since the last read
+    ItemColor = apps.get_model('api', 'ItemColor')
+    PredefinedPair = apps.get_model('api', 'PredefinedPair')
+    FinalSelection = apps.get_model('api', 'FinalSelection')
+
+    items_by_colour = {'TOP': defaultdict(set), 'BOTTOM': defaultdict(set)}
+    rows = ItemColor.objects.values_list('clothing_id', 'colour_id', 'clothing__item_type')
+    for clothing_id, colour_id, item_type in rows:
+        items_by_colour[item_type][colour_id].add(clothing_id)
+
+    matches = set()
+    pairs = PredefinedPair.objects.values_list('top_colour_id', 'bottom_colour_id')
+    for top_colour_id, bottom_colour_id in set(pairs):
+        tops = items_by_colour['TOP'].get(top_colour_id)
+        bottoms = items_by_colour['BOTTOM'].get(bottom_colour_id)
+        if tops and bottoms:
+            matches.update(product(tops, bottoms))
+
+    existing_pairs = set(FinalSelection.objects.values_list('top_id', 'bottom_id'))
+    FinalSelection.objects.bulk_create(
+        [FinalSelection(top_id=t, bottom_id=b) for t, b in matches - existing_pairs],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('api', '0007_alter_finalselection_options_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_final_selections, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_backfill_final_selections'),
+    ]
+
+    operations = [
+        # Items uploaded before the background pipeline were processed inline
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='color_status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='DONE', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='wardrobeitem',
+            name='color_status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='processing_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='processing_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='processing_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
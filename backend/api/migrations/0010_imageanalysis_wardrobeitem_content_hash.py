@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 21:23
+
+import api.storage
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_wardrobeitem_color_status_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageAnalysis',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('r', models.IntegerField(validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(255)])),
+                ('g', models.IntegerField(validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(255)])),
+                ('b', models.IntegerField(validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(255)])),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='wardrobeitem',
+            name='image',
+            field=models.ImageField(storage=api.storage.get_wardrobe_storage, upload_to=api.storage.wardrobe_upload_to),
+        ),
+    ]
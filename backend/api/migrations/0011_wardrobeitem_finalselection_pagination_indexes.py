@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 21:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_imageanalysis_wardrobeitem_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='finalselection',
+            index=models.Index(fields=['-created_at', '-id'], name='selection_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='finalselection',
+            index=models.Index(fields=['top', '-created_at', '-id'], name='selection_top_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='finalselection',
+            index=models.Index(fields=['bottom', '-created_at', '-id'], name='selection_bottom_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='itemcolor',
+            index=models.Index(fields=['colour', 'clothing'], name='itemcolor_colour_item_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wardrobeitem',
+            index=models.Index(fields=['-created_at', '-id'], name='wardrobe_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wardrobeitem',
+            index=models.Index(fields=['item_type', '-created_at', '-id'], name='wardrobe_type_created_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 21:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_wardrobeitem_finalselection_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageanalysis',
+            name='extractor',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='imageanalysis',
+            name='features',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='imageanalysis',
+            name='mask',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 21:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_imageanalysis_mask_features'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='finalselection',
+            name='score',
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.AddField(
+            model_name='imageanalysis',
+            name='colours',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='itemcolor',
+            name='weight',
+            field=models.FloatField(default=1.0),
+        ),
+    ]
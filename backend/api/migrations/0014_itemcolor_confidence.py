@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 21:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_item_colour_weights'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemcolor',
+            name='confidence',
+            field=models.FloatField(default=1.0),
+        ),
+    ]
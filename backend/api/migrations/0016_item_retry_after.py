@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 22:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_file_tombstones'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wardrobeitem',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def reset_analysis_features(apps, schema_editor):
+    # Features used to be a separate colour histogram that nothing read. They
+    # are now the extractor's clusters that colours are picked from, so the old
+    # ones are dropped and those analyses fall back to their stored colours
+    ImageAnalysis = apps.get_model('api', 'ImageAnalysis')
+    ImageAnalysis.objects.update(features=[])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('api', '0016_item_retry_after'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_analysis_features, migrations.RunPython.noop),
+    ]
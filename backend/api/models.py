@@ -1,28 +1,87 @@
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
-import os
+from .storage import get_wardrobe_storage, wardrobe_upload_to
 
 class WardrobeItem(models.Model):
     ITEM_TYPES = (
         ('TOP', 'Top'),
         ('BOTTOM', 'Bottom'),
     )
+    COLOR_STATUSES = (
+        ('PENDING', 'Pending'),
+        ('PROCESSING', 'Processing'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    )
     
-    image = models.ImageField(upload_to='wardrobe/')
+    image = models.ImageField(upload_to=wardrobe_upload_to, storage=get_wardrobe_storage)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
     item_type = models.CharField(max_length=6, choices=ITEM_TYPES)
     created_at = models.DateTimeField(auto_now_add=True)
+    color_status = models.CharField(max_length=10, choices=COLOR_STATUSES, default='PENDING')
+    processing_attempts = models.PositiveSmallIntegerField(default=0)
+    processing_error = models.TextField(blank=True)
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    retry_after = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination, optionally filtered by item type
+            models.Index(fields=['-created_at', '-id'], name='wardrobe_created_id_idx'),
+            models.Index(fields=['item_type', '-created_at', '-id'], name='wardrobe_type_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.item_type} - {self.created_at}"
 
     def delete(self, *args, **kwargs):
-        if self.image:
-            if os.path.isfile(self.image.path):
-                os.remove(self.image.path)
-        super().delete(*args, **kwargs)
+        image_name = self.image.name
+        result = super().delete(*args, **kwargs)
+        if image_name:
+            record_file_tombstones([image_name])
+        return result
+
+
+def record_file_tombstones(names, batch_size=1000):
+    """Mark stored files for the sweeper, which deletes the ones nothing uses any more"""
+    # Identical uploads share one content-addressed file, so whether it is still
+    # used is only decided when it is swept
+    FileTombstone.objects.bulk_create(
+        [FileTombstone(name=name) for name in set(names) if name],
+        ignore_conflicts=True,
+        batch_size=batch_size,
+    )
+
+
+class FileTombstone(models.Model):
+    """A stored file that lost a reference, waiting for the sweep_files command"""
+    name = models.CharField(max_length=255, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ImageAnalysis(models.Model):
+    """Colour analysis of an image, keyed by the SHA-256 of its bytes"""
+    content_hash = models.CharField(max_length=64, unique=True)
+    r = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(255)])
+    g = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(255)])
+    b = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(255)])
+    # Extractor that picked r, g, b
+    extractor = models.CharField(max_length=20, blank=True)
+    # Background-removal alpha mask as a PNG, so the cutout can be rebuilt without the model
+    mask = models.BinaryField(null=True, blank=True)
+    # The extractor's largest clusters as [r, g, b, pixel share] rows, up to FEATURE_CLUSTERS
+    features = models.JSONField(default=list, blank=True)
+    # The clusters picked from them when analysed and matched against the palette
+    colours = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.r},{self.g},{self.b})"
 
 class Colour(models.Model):
     TYPE_CHOICES = (
@@ -81,10 +140,18 @@ class ItemColor(models.Model):
         on_delete=models.CASCADE,
         related_name='items'
     )
+    # Share of the item's foreground pixels wearing this colour
+    weight = models.FloatField(default=1.0)
+    # How close the matched pixels were to the palette colour, 1 (exact) to 0 (at the threshold)
+    confidence = models.FloatField(default=1.0)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = ['clothing', 'colour']
+        indexes = [
+            # Finds the items wearing a colour when filtering by colour
+            models.Index(fields=['colour', 'clothing'], name='itemcolor_colour_item_idx'),
+        ]
 
     def __str__(self):
         return f"{self.clothing.item_type} - {self.colour.name}"
@@ -109,10 +176,18 @@ class FinalSelection(models.Model):
         on_delete=models.CASCADE,
         related_name='bottom_selections'
     )
+    # Sum of top weight x bottom weight over the allowed colour pairs the two share
+    score = models.FloatField(default=1.0)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = ['top', 'bottom']
+        indexes = [
+            # Keyset pagination, optionally filtered by top or by bottom
+            models.Index(fields=['-created_at', '-id'], name='selection_created_id_idx'),
+            models.Index(fields=['top', '-created_at', '-id'], name='selection_top_created_idx'),
+            models.Index(fields=['bottom', '-created_at', '-id'], name='selection_bottom_created_idx'),
+        ]
 
     def __str__(self):
         return f"Match: {self.top.id} - {self.bottom.id})"
@@ -1,18 +1,24 @@
 from rest_framework import serializers
-from .models import WardrobeItem, ItemColor, FinalSelection
+from .models import WardrobeItem, FinalSelection
+from .utils.thumbnails import get_srcset
 
 class WardrobeItemSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = WardrobeItem
-        fields = ['id', 'image', 'item_type', 'created_at', 'image_url']
+        fields = ['id', 'image', 'item_type', 'created_at', 'image_url', 'srcset', 'color_status']
 
     def get_image_url(self, obj):
         if obj.image:
             # Return only the relative path
             return obj.image.url
         return None
+
+    def get_srcset(self, obj):
+        # Relative, like image_url
+        return get_srcset(obj.image.name)
     
 # backend/api/serializers.py
 class FinalSelectionSerializer(serializers.ModelSerializer):
@@ -20,11 +26,13 @@ class FinalSelectionSerializer(serializers.ModelSerializer):
     bottom_image = serializers.SerializerMethodField()
     top_colors = serializers.SerializerMethodField()
     bottom_colors = serializers.SerializerMethodField()
+    top_srcset = serializers.SerializerMethodField()
+    bottom_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = FinalSelection
         fields = ['id', 'top_id', 'bottom_id', 'top_image', 'bottom_image', 
-                 'top_colors', 'bottom_colors']
+                 'top_colors', 'bottom_colors', 'top_srcset', 'bottom_srcset', 'score']
 
     def get_top_image(self, obj):
         if obj.top and obj.top.image:
@@ -38,8 +46,16 @@ class FinalSelectionSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(obj.bottom.image.url)
         return None
 
+    # The view prefetches top__colors__colour and bottom__colors__colour, so these
+    # read from memory instead of querying once per selection
     def get_top_colors(self, obj):
-        return ItemColor.objects.filter(clothing=obj.top).values_list('colour__name', flat=True)
+        return [item_color.colour.name for item_color in obj.top.colors.all()]
 
     def get_bottom_colors(self, obj):
-        return ItemColor.objects.filter(clothing=obj.bottom).values_list('colour__name', flat=True)
\ No newline at end of file
+        return [item_color.colour.name for item_color in obj.bottom.colors.all()]
+
+    def get_top_srcset(self, obj):
+        return get_srcset(obj.top.image.name, self.context.get('request'))
+
+    def get_bottom_srcset(self, obj):
+        return get_srcset(obj.bottom.image.name, self.context.get('request'))
\ No newline at end of file
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Colour, PredefinedPair
+from .utils.color_matcher import invalidate_palette
+from .utils.outfit_matcher import invalidate_compatibility
+
+
+@receiver([post_save, post_delete], sender=Colour)
+def colour_changed(sender, **kwargs):
+    """Rebuild the matcher's palette structures after any Colour edit"""
+    invalidate_palette()
+
+
+@receiver([post_save, post_delete], sender=PredefinedPair)
+def pair_changed(sender, **kwargs):
+    """Rebuild the allowed colour pairs after any PredefinedPair edit"""
+    invalidate_compatibility()
@@ -0,0 +1,92 @@
+import hashlib
+import os
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, storages
+
+WARDROBE_STORAGE_ALIAS = "wardrobe"
+
+
+class ContentAddressedMixin:
+    """Storage behaviour for files whose name is derived from their content.
+
+    Saving a name that already exists is a no-op, so identical uploads share
+    one stored file. Mix it into any Django storage backend, e.g. an S3
+    backend pointed at an object store.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # Same name means same content, so never pick an alternative name
+        return name
+
+    def _save(self, name, content):
+        if self.exists(name):
+            return name
+        return super()._save(name, content)
+
+
+class ContentAddressedStorage(ContentAddressedMixin, FileSystemStorage):
+    """Content-addressed storage on the local filesystem"""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("allow_overwrite", True)
+        super().__init__(**kwargs)
+
+
+def get_wardrobe_storage():
+    """Storage used for wardrobe images: the "wardrobe" entry of STORAGES, if configured"""
+    if WARDROBE_STORAGE_ALIAS in settings.STORAGES:
+        return storages[WARDROBE_STORAGE_ALIAS]
+    return ContentAddressedStorage()
+
+
+def hash_file(file):
+    """SHA-256 hex digest of a Django File's content, leaving the file at its start"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def shard_name(directory, filename):
+    """Place a file under prefix directories taken from its name, e.g. wardrobe/ab/cd/abcd….jpg
+
+    MEDIA_SHARD_DEPTH levels of two characters each keep any one directory
+    small; names are content hashes, so files spread evenly.
+    """
+    depth = getattr(settings, "MEDIA_SHARD_DEPTH", 2)
+    shards = [filename[level * 2:level * 2 + 2] for level in range(depth)]
+    return "/".join([directory, *(shard for shard in shards if shard), filename])
+
+
+def wardrobe_image_name(filename):
+    """Storage name of a wardrobe image file in the current layout"""
+    return shard_name("wardrobe", filename)
+
+
+def wardrobe_upload_to(instance, filename):
+    """Name wardrobe images after the SHA-256 of their content"""
+    if not instance.content_hash:
+        instance.content_hash = hash_file(instance.image)
+    extension = os.path.splitext(filename)[1].lower()
+    return wardrobe_image_name(f"{instance.content_hash}{extension}")
+
+
+def relocate_file(storage, old_name, new_name):
+    """Move a stored file to a new name, returning False if there was nothing to move
+
+    Local files are renamed; other backends copy and delete. A file already
+    at new_name (identical content) just replaces the old one.
+    """
+    if old_name == new_name or not storage.exists(old_name):
+        return False
+    if not storage.exists(new_name):
+        if isinstance(storage, FileSystemStorage):
+            new_path = storage.path(new_name)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(storage.path(old_name), new_path)
+            return True
+        with storage.open(old_name, "rb") as old_file:
+            storage.save(new_name, old_file)
+    storage.delete(old_name)
+    return True
@@ -1,3 +1,1381 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from .models import (
+    Colour,
+    FileTombstone,
+    FinalSelection,
+    ImageAnalysis,
+    ItemColor,
+    PredefinedPair,
+    WardrobeItem,
+)
+from .serializers import WardrobeItemSerializer
+from .storage import ContentAddressedMixin, hash_file, relocate_file
+from .utils.color_processor import (
+    DOMINANT_COLOUR_EXTRACTORS,
+    analyse_uploaded_image,
+    apply_mask,
+    encode_mask,
+    get_colour_clusters,
+    load_analysis_image,
+    select_item_colours,
+)
+from .utils.file_gc import record_orphaned_files, sweep_file_tombstones
+from .utils.color_matcher import (
+    TYPE_BITS,
+    delta_e_2000,
+    get_match_confidence,
+    get_nearest_matches_from_lut,
+    get_palette,
+    get_top_matches_for_colours,
+    get_top_matches_lab,
+    get_top_matches_rgb,
+    get_top_matches_within_threshold,
+    invalidate_palette,
+)
+from .utils.image_pipeline import (
+    assign_item_colours,
+    claim_item,
+    create_wardrobe_items,
+    enqueue_items,
+    process_items,
+    process_pending_items,
+    reclassify_items,
+    release_contents,
+    requeue_stale_items,
+)
+from .utils import segmentation
+from .utils.metrics import Histogram
+from .utils.outfit_matcher import (
+    add_item_selections,
+    find_matching_pairs,
+    get_compatibility,
+    invalidate_compatibility,
+)
+from .utils.synthetic import draw_garment, generate_wardrobe
+from .utils.thumbnails import flat_thumbnail_name, thumbnail_name
+from .utils.timing import StageTimer, record, stage
+from .utils.uploads import BufferReader, read_upload
 
-# Create your tests here.
+
+class TemporaryMediaTestCase(TestCase):
+    """Writes stored files to a throwaway MEDIA_ROOT, removed after each test"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root))
+
+
+class FinalSelectionsQueryCountTests(TestCase):
+    def setUp(self):
+        self.colours = [
+            Colour.objects.create(name=f"Colour {i}", r=i, g=i, b=i, type="BOTH")
+            for i in range(3)
+        ]
+        tops = [
+            WardrobeItem.objects.create(image=f"wardrobe/top{i}.jpg", item_type="TOP")
+            for i in range(3)
+        ]
+        bottoms = [
+            WardrobeItem.objects.create(image=f"wardrobe/bottom{i}.jpg", item_type="BOTTOM")
+            for i in range(3)
+        ]
+        for item in tops + bottoms:
+            ItemColor.objects.create(clothing=item, colour=self.colours[0])
+            ItemColor.objects.create(clothing=item, colour=self.colours[1])
+        for top in tops:
+            for bottom in bottoms:
+                FinalSelection.objects.create(top=top, bottom=bottom)
+
+    def test_query_count_does_not_grow_with_selections(self):
+        url = reverse("final-selections")
+        # Selections with their items, then the colours of the tops and of the bottoms
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 9)
+        self.assertEqual(sorted(response.json()[0]["top_colors"]), ["Colour 0", "Colour 1"])
+
+        # More selections, items and colours still cost the same three queries
+        top = WardrobeItem.objects.create(image="wardrobe/top3.jpg", item_type="TOP")
+        ItemColor.objects.create(clothing=top, colour=self.colours[2])
+        for bottom in WardrobeItem.objects.filter(item_type="BOTTOM"):
+            FinalSelection.objects.create(top=top, bottom=bottom)
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        self.colour = Colour.objects.create(name="Navy", r=0, g=0, b=128, type="BOTH")
+        self.tops = [
+            WardrobeItem.objects.create(image=f"wardrobe/top{i}.jpg", item_type="TOP")
+            for i in range(5)
+        ]
+        self.bottom = WardrobeItem.objects.create(image="wardrobe/bottom.jpg", item_type="BOTTOM")
+        ItemColor.objects.create(clothing=self.tops[0], colour=self.colour)
+        for top in self.tops:
+            FinalSelection.objects.create(top=top, bottom=self.bottom)
+
+    def collect_pages(self, url):
+        ids, pages = [], 0
+        while url:
+            body = self.client.get(url).json()
+            ids.extend(row["id"] for row in body["results"])
+            url, pages = body["next"], pages + 1
+        return ids, pages
+
+    def test_pages_cover_every_row_once_newest_first(self):
+        ids, pages = self.collect_pages(reverse("get_wardrobe_items") + "?page_size=2")
+        expected = list(
+            WardrobeItem.objects.order_by("-created_at", "-id").values_list("id", flat=True)
+        )
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_unpaginated_requests_still_return_a_list(self):
+        response = self.client.get(reverse("final-selections"))
+        self.assertEqual(len(response.json()), 5)
+
+    def test_filters(self):
+        url = reverse("get_wardrobe_items")
+        self.assertEqual(len(self.client.get(url + "?type=BOTTOM").json()), 1)
+        self.assertEqual(len(self.client.get(url + f"?colour={self.colour.id}").json()), 1)
+
+        url = reverse("final-selections")
+        ids, _ = self.collect_pages(url + f"?page_size=2&colour={self.colour.id}")
+        self.assertEqual(len(ids), 1)
+        ids, _ = self.collect_pages(url + f"?page_size=2&top={self.tops[1].id}")
+        self.assertEqual(len(ids), 1)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse("final-selections") + "?cursor=nonsense")
+        self.assertEqual(response.status_code, 400)
+
+
+class StreamingResponseTests(TestCase):
+    def setUp(self):
+        colour = Colour.objects.create(name="Navy", r=0, g=0, b=128, type="BOTH")
+        bottom = WardrobeItem.objects.create(image="wardrobe/bottom.jpg", item_type="BOTTOM")
+        ItemColor.objects.create(clothing=bottom, colour=colour)
+        for i in range(7):
+            top = WardrobeItem.objects.create(image=f"wardrobe/top{i}.jpg", item_type="TOP")
+            ItemColor.objects.create(clothing=top, colour=colour)
+            FinalSelection.objects.create(top=top, bottom=bottom)
+
+    def read_stream(self, url):
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    @override_settings(STREAM_CHUNK_SIZE=3)
+    def test_streamed_json_matches_the_list_response(self):
+        url = reverse("final-selections")
+        self.assertEqual(json.loads(self.read_stream(url + "?stream=json")), self.client.get(url).json())
+
+    def test_ndjson_has_one_row_per_line(self):
+        lines = self.read_stream(reverse("get_wardrobe_items") + "?stream=ndjson").splitlines()
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(json.loads(lines[0])["item_type"], "TOP")
+
+    def test_unknown_stream_format_is_rejected(self):
+        response = self.client.get(reverse("final-selections") + "?stream=xml")
+        self.assertEqual(response.status_code, 400)
+
+
+class ThumbnailTests(TemporaryMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        buffer = io.BytesIO()
+        Image.new("RGB", (1000, 800), (20, 40, 160)).save(buffer, "JPEG")
+        image = ContentFile(buffer.getvalue())
+        self.item = WardrobeItem(item_type="TOP", content_hash=hash_file(image))
+        self.item.image.save("shirt.jpg", image, save=True)
+
+    def test_thumbnail_is_rendered_on_first_request_and_deleted_with_the_image(self):
+        srcset = WardrobeItemSerializer(self.item).data["srcset"]
+        url = srcset.split(", ")[1].split()[0]
+        response = self.client.get(url)
+
+        self.assertEqual(response["Content-Type"], "image/webp")
+        thumbnail = Image.open(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(thumbnail.size, (256, 205))
+
+        storage = self.item.image.storage
+        name = thumbnail_name(self.item.image.name, 256)
+        self.assertTrue(storage.exists(name))
+        self.item.delete()
+        self.assertTrue(storage.exists(name))
+        sweep_file_tombstones(storage, grace_seconds=0)
+        self.assertFalse(storage.exists(name))
+
+    def test_unknown_size_is_not_found(self):
+        url = reverse("thumbnail", args=[300, os.path.basename(self.item.image.name)])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class AnalysisResolutionTests(TestCase):
+    def encode(self, size, image_format):
+        buffer = io.BytesIO()
+        Image.new("RGB", size, (200, 30, 60)).save(buffer, image_format)
+        return buffer.getvalue()
+
+    def test_large_images_are_shrunk_to_the_analysis_size(self):
+        for image_format in ("JPEG", "PNG"):
+            with self.subTest(image_format=image_format):
+                image = load_analysis_image(self.encode((4000, 3000), image_format), max_size=512)
+                self.assertEqual(image.size, (512, 384))
+
+    def test_small_images_and_unbounded_analysis_keep_their_size(self):
+        for image_format in ("JPEG", "PNG"):
+            with self.subTest(image_format=image_format):
+                small = self.encode((300, 200), image_format)
+                self.assertEqual(load_analysis_image(small, max_size=512).size, (300, 200))
+                large = self.encode((1600, 1200), image_format)
+                self.assertEqual(load_analysis_image(large).size, (1600, 1200))
+
+
+class StoredMaskTests(TestCase):
+    def test_cutout_is_rebuilt_exactly_from_its_mask(self):
+        image = Image.new("RGB", (40, 30), (200, 30, 60))
+        mask = Image.linear_gradient("L").resize((40, 30))
+        cutout = Image.composite(image, Image.new("RGBA", image.size, 0), mask)
+
+        rebuilt = apply_mask(image, encode_mask(cutout))
+        self.assertEqual(rebuilt.tobytes(), cutout.convert("RGBA").tobytes())
+
+    def test_features_are_the_clusters_colours_are_picked_from(self):
+        pixels = np.zeros((10, 10, 3), dtype=np.uint8)
+        pixels[:6] = (20, 30, 120)
+        pixels[6:9] = (200, 20, 30)
+        pixels[9:] = (40, 160, 60)
+        image = Image.fromarray(pixels, "RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+
+        analysis = analyse_uploaded_image(
+            buffer.getvalue(), extractor="histogram", mask=encode_mask(image.convert("RGBA"))
+        )
+        self.assertEqual(
+            analysis["features"],
+            [[20, 30, 120, 0.6], [200, 20, 30, 0.3], [40, 160, 60, 0.1]],
+        )
+        self.assertEqual(analysis["colours"], [[20, 30, 120, 0.6], [200, 20, 30, 0.3]])
+
+
+class ColourExtractorTests(TestCase):
+    RED, BLUE = (200, 30, 30), (30, 60, 200)
+
+    def two_colour_image(self, noise=0):
+        """20x20 cutout: 100 transparent (black) pixels, then 210 red and 90 blue"""
+        pixels = np.array([(0, 0, 0)] * 100 + [self.RED] * 210 + [self.BLUE] * 90, dtype=np.float64)
+        # Fabric texture on the garment only, never turning a pixel transparent black
+        texture = np.random.default_rng(0).normal(0, noise, (300, 3))
+        pixels[100:] = np.clip(np.round(pixels[100:] + texture), 1, 255)
+        return pixels.astype(np.uint8).reshape(20, 20, 3)
+
+    def test_every_extractor_recovers_both_colours_and_their_shares(self):
+        for extractor in DOMINANT_COLOUR_EXTRACTORS:
+            with self.subTest(extractor=extractor):
+                self.assertEqual(
+                    get_colour_clusters(self.two_colour_image(), extractor),
+                    [(self.RED, 0.7), (self.BLUE, 0.3)],
+                )
+
+    def test_clusters_of_textured_colours_add_up_to_their_shares(self):
+        for extractor in DOMINANT_COLOUR_EXTRACTORS:
+            with self.subTest(extractor=extractor):
+                clusters = get_colour_clusters(self.two_colour_image(noise=4), extractor)
+                # Fabric texture may split a colour over several clusters, none in between
+                shares = {self.RED: 0.0, self.BLUE: 0.0}
+                for rgb, share in clusters:
+                    distances = {colour: np.linalg.norm(np.subtract(rgb, colour)) for colour in shares}
+                    nearest = min(distances, key=distances.get)
+                    self.assertLess(distances[nearest], 20)
+                    shares[nearest] += share
+                self.assertAlmostEqual(shares[self.RED], 0.7, places=6)
+                self.assertAlmostEqual(shares[self.BLUE], 0.3, places=6)
+
+    def test_unknown_extractors_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, "Unknown colour extractor 'dbscan'"):
+            get_colour_clusters(self.two_colour_image(), "dbscan")
+
+
+class SegmentationSessionTests(TestCase):
+    def setUp(self):
+        # A small model the tests never actually load; the configured one is restored after
+        configured = segmentation.health()
+        self.addCleanup(segmentation.configure, configured["model"], configured["threads"])
+        segmentation.configure("u2netp", threads=2)
+
+        self.create_session = self.enterContext(
+            mock.patch.object(segmentation, "_create_session", side_effect=lambda: object())
+        )
+        self.remove = mock.Mock(side_effect=lambda data, session=None: data)
+        self.enterContext(mock.patch.dict(sys.modules, {"rembg": mock.Mock(remove=self.remove)}))
+
+    def test_the_session_is_loaded_once_and_reused(self):
+        session = segmentation.get_session()
+        segmentation.warm_up()
+        self.assertIs(segmentation.get_session(), session)
+        self.assertEqual(self.create_session.call_count, 1)
+        self.assertIs(self.remove.call_args.kwargs["session"], session)
+
+        # Configuring it the same way keeps the session, another model replaces it
+        segmentation.configure("u2netp", threads=2)
+        self.assertIs(segmentation.get_session(), session)
+        segmentation.configure("isnet-general-use", threads=2)
+        self.assertIsNot(segmentation.get_session(), session)
+        self.assertEqual(self.create_session.call_count, 2)
+
+    def test_health_reports_the_session_and_post_warms_it_up(self):
+        url = reverse("segmentation-health")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {"model": "u2netp", "threads": 2, "loaded": False, "load_seconds": None},
+        )
+        self.create_session.assert_not_called()
+
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["loaded"])
+        self.assertIsInstance(response.json()["load_seconds"], float)
+        self.remove.assert_called_once()
+
+    def test_health_is_unavailable_while_the_model_cannot_load(self):
+        self.create_session.side_effect = RuntimeError("model file missing")
+
+        with self.assertLogs("api.views", "ERROR"):
+            response = self.client.post(reverse("segmentation-health"))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["error"], "model file missing")
+        self.assertFalse(response.json()["loaded"])
+        # Nothing half-loaded is kept: the next attempt tries again
+        self.create_session.side_effect = lambda: object()
+        self.assertEqual(self.client.post(reverse("segmentation-health")).status_code, 200)
+
+
+class WeightedOutfitTests(TestCase):
+    def test_pair_score_sums_weight_products_over_allowed_colour_pairs(self):
+        tops_by_colour = {1: {10: 0.6}, 2: {10: 0.4}}
+        bottoms_by_colour = {3: {20: 0.7}, 1: {20: 0.3}}
+        allowed_pairs = {(1, 3), (2, 3), (1, 1), (2, 2)}
+
+        scores = find_matching_pairs(tops_by_colour, bottoms_by_colour, allowed_pairs)
+        self.assertEqual(list(scores), [(10, 20)])
+        self.assertAlmostEqual(scores[10, 20], 0.6 * 0.7 + 0.4 * 0.7 + 0.6 * 0.3)
+
+    def test_processed_items_are_paired_with_their_matching_partners(self):
+        navy = Colour.objects.create(name="navy", r=20, g=30, b=120, type="BOTH")
+        red = Colour.objects.create(name="red", r=200, g=20, b=30, type="TOP")
+        khaki = Colour.objects.create(name="khaki", r=190, g=170, b=110, type="BOTTOM")
+        grey = Colour.objects.create(name="grey", r=128, g=128, b=128, type="BOTH")
+        PredefinedPair.objects.create(top_colour=navy, bottom_colour=khaki)
+        PredefinedPair.objects.create(top_colour=red, bottom_colour=khaki)
+
+        def process(item_type, colours):
+            item = WardrobeItem.objects.create(
+                image=f"wardrobe/{item_type}.jpg", item_type=item_type
+            )
+            assign_item_colours([item], [colours])
+            return item
+
+        top = process("TOP", [[20, 30, 120, 0.6], [200, 20, 30, 0.4]])
+        self.assertFalse(FinalSelection.objects.exists())
+
+        bottom = process("BOTTOM", [[190, 170, 110, 0.7], [128, 128, 128, 0.3]])
+        # Unpaired colours: nothing for this top or that bottom
+        process("TOP", [[128, 128, 128, 1.0]])
+        process("BOTTOM", [[20, 30, 120, 1.0]])
+
+        self.assertEqual(
+            list(FinalSelection.objects.values_list("top_id", "bottom_id", "score")),
+            [(top.id, bottom.id, round(0.6 * 0.7 + 0.4 * 0.7, 4))],
+        )
+        self.assertEqual(grey.items.count(), 2)
+
+    def test_small_clusters_are_dropped_but_the_dominant_one_is_kept(self):
+        clusters = [((10, 10, 10), 0.55), ((200, 0, 0), 0.35), ((0, 200, 0), 0.1)]
+        self.assertEqual(
+            select_item_colours(clusters, n_colours=3, min_share=0.15),
+            [[10, 10, 10, 0.55], [200, 0, 0, 0.35]],
+        )
+        self.assertEqual(select_item_colours([((1, 2, 3), 0.05)]), [[1, 2, 3, 0.05]])
+
+
+class ConcurrentProcessingTests(TransactionTestCase):
+    def test_a_top_and_bottom_processed_at_once_are_paired(self):
+        navy = Colour.objects.create(name="navy", r=20, g=30, b=120, type="BOTH")
+        khaki = Colour.objects.create(name="khaki", r=190, g=170, b=110, type="BOTTOM")
+        PredefinedPair.objects.create(top_colour=navy, bottom_colour=khaki)
+        top = WardrobeItem.objects.create(image="wardrobe/top.jpg", item_type="TOP")
+        bottom = WardrobeItem.objects.create(image="wardrobe/bottom.jpg", item_type="BOTTOM")
+
+        # Each worker stores its item's colours, then waits until the other
+        # has stored its own before looking for partners
+        stored = {top.id: threading.Event(), bottom.id: threading.Event()}
+        saw_other, pairing = {}, threading.Lock()
+
+        def pair_after_both_stored(item, colour_weights=None):
+            stored[item.id].set()
+            other_id = bottom.id if item.id == top.id else top.id
+            saw_other[item.id] = stored[other_id].wait(timeout=5)
+            with pairing:
+                return add_item_selections(item, colour_weights=colour_weights)
+
+        def worker(item, colours):
+            try:
+                assign_item_colours([item], [colours])
+            finally:
+                connection.close()
+
+        with mock.patch(
+            "api.utils.image_pipeline.add_item_selections", side_effect=pair_after_both_stored
+        ):
+            threads = [
+                threading.Thread(target=worker, args=(top, [[22, 32, 118, 1.0]])),
+                threading.Thread(target=worker, args=(bottom, [[188, 168, 112, 1.0]])),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(saw_other, {top.id: True, bottom.id: True})
+        self.assertEqual(
+            list(FinalSelection.objects.values_list("top_id", "bottom_id")), [(top.id, bottom.id)]
+        )
+
+
+@override_settings(RECOMMENDATION_RECENCY_WEIGHT=0)
+class RecommendationTests(TestCase):
+    def setUp(self):
+        self.white, self.navy, self.red = (
+            Colour.objects.create(name=name, r=value, g=value, b=value, type="BOTH")
+            for name, value in (("White", 250), ("Navy", 40), ("Red", 120))
+        )
+        PredefinedPair.objects.create(top_colour=self.white, bottom_colour=self.navy)
+        self.top = self.item("TOP", [(self.white, 0.8, 1.0), (self.red, 0.2, 1.0)])
+        self.close_bottom = self.item("BOTTOM", [(self.navy, 1.0, 0.9)])
+        self.far_bottom = self.item("BOTTOM", [(self.navy, 1.0, 0.3)])
+        self.red_bottom = self.item("BOTTOM", [(self.red, 1.0, 1.0)])
+
+    def item(self, item_type, colours):
+        item = WardrobeItem.objects.create(image=f"wardrobe/{item_type}.jpg", item_type=item_type)
+        for colour, weight, confidence in colours:
+            ItemColor.objects.create(
+                clothing=item, colour=colour, weight=weight, confidence=confidence
+            )
+        return item
+
+    def recommend(self, **params):
+        response = self.client.get(reverse("recommendations"), params)
+        self.assertEqual(response.status_code, 200)
+        return [(row["top"]["id"], row["bottom"]["id"], row["score"]) for row in response.json()]
+
+    def test_partners_are_ranked_by_weight_and_confidence(self):
+        self.assertEqual(
+            self.recommend(top=self.top.id),
+            [
+                (self.top.id, self.close_bottom.id, 0.72),
+                (self.top.id, self.far_bottom.id, 0.24),
+            ],
+        )
+        self.assertEqual(
+            self.recommend(bottom=self.far_bottom.id), [(self.top.id, self.far_bottom.id, 0.24)]
+        )
+        self.assertEqual(len(self.recommend(k=1)), 1)
+
+    def test_new_pairs_are_picked_up_without_a_restart(self):
+        self.assertEqual(self.recommend(bottom=self.red_bottom.id), [])
+        PredefinedPair.objects.create(top_colour=self.red, bottom_colour=self.red)
+        self.assertEqual(
+            self.recommend(bottom=self.red_bottom.id), [(self.top.id, self.red_bottom.id, 0.2)]
+        )
+
+    @override_settings(RECOMMENDATION_RECENCY_WEIGHT=0.5, RECOMMENDATION_RECENCY_HALF_LIFE_DAYS=30)
+    def test_older_items_score_lower(self):
+        old_bottom = self.item("BOTTOM", [])
+        WardrobeItem.objects.filter(id=old_bottom.id).update(
+            created_at=old_bottom.created_at - timedelta(days=30)
+        )
+        ItemColor.objects.create(clothing=old_bottom, colour=self.navy, confidence=0.9)
+
+        scores = {bottom: score for _, bottom, score in self.recommend(top=self.top.id)}
+        # Half the score is freshness, which averages 0.75 for a 30 day old bottom
+        self.assertEqual(scores[self.close_bottom.id], 0.72)
+        self.assertEqual(scores[old_bottom.id], round(0.72 * (0.5 + 0.5 * 0.75), 4))
+
+    def test_top_and_bottom_together_are_rejected(self):
+        response = self.client.get(
+            reverse("recommendations"), {"top": self.top.id, "bottom": self.red_bottom.id}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class CompatibilityCacheTests(TestCase):
+    def setUp(self):
+        self.white, self.navy = (
+            Colour.objects.create(name=name, r=value, g=value, b=value, type="BOTH")
+            for name, value in (("White", 250), ("Navy", 40))
+        )
+        self.pair = PredefinedPair.objects.create(top_colour=self.white, bottom_colour=self.navy)
+
+    def test_compatibility_is_reused_while_nothing_changes(self):
+        compatibility = get_compatibility()
+        # Only the shared palette and pair versions are read again
+        with self.assertNumQueries(2):
+            self.assertIs(get_compatibility(), compatibility)
+        self.assertEqual(compatibility.bottoms_for_top, {self.white.id: [self.navy.id]})
+        white, navy = (
+            compatibility.colour_ids.tolist().index(colour.id) for colour in (self.white, self.navy)
+        )
+        self.assertEqual(np.argwhere(compatibility.matrix).tolist(), [[white, navy]])
+
+    def test_pair_edits_rebuild_the_matrix(self):
+        PredefinedPair.objects.create(top_colour=self.navy, bottom_colour=self.white)
+        self.assertEqual(
+            get_compatibility().pairs,
+            {(self.white.id, self.navy.id), (self.navy.id, self.white.id)},
+        )
+
+        self.pair.delete()
+        self.assertEqual(get_compatibility().pairs, {(self.navy.id, self.white.id)})
+        self.assertEqual(get_compatibility().tops_for_bottom, {self.white.id: [self.navy.id]})
+
+    def test_pair_edits_made_by_another_process_are_picked_up(self):
+        get_compatibility()
+
+        # A bulk edit sends no signal; the other process invalidates through
+        # its own connection to the shared cache
+        PredefinedPair.objects.all().delete()
+        with mock.patch("api.utils.outfit_matcher.cache", caches.create_connection("default")):
+            invalidate_compatibility()
+
+        self.assertEqual(get_compatibility().pairs, frozenset())
+
+
+# CIEDE2000 test data from Sharma, Wu and Dalal (2005): pairs of Lab colours
+# and their colour difference
+SHARMA_CIEDE2000_PAIRS = [
+    ((50.0000, 2.6772, -79.7751), (50.0000, 0.0000, -82.7485), 2.0425),
+    ((50.0000, 3.1571, -77.2803), (50.0000, 0.0000, -82.7485), 2.8615),
+    ((50.0000, 2.8361, -74.0200), (50.0000, 0.0000, -82.7485), 3.4412),
+    ((50.0000, -1.3802, -84.2814), (50.0000, 0.0000, -82.7485), 1.0000),
+    ((50.0000, -1.1848, -84.8006), (50.0000, 0.0000, -82.7485), 1.0000),
+    ((50.0000, -0.9009, -85.5211), (50.0000, 0.0000, -82.7485), 1.0000),
+    ((50.0000, 0.0000, 0.0000), (50.0000, -1.0000, 2.0000), 2.3669),
+    ((50.0000, -1.0000, 2.0000), (50.0000, 0.0000, 0.0000), 2.3669),
+    ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0009), 7.1792),
+    ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0010), 7.1792),
+    ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0011), 7.2195),
+    ((50.0000, 2.4900, -0.0010), (50.0000, -2.4900, 0.0012), 7.2195),
+    ((50.0000, -0.0010, 2.4900), (50.0000, 0.0009, -2.4900), 4.8045),
+    ((50.0000, -0.0010, 2.4900), (50.0000, 0.0010, -2.4900), 4.8045),
+    ((50.0000, -0.0010, 2.4900), (50.0000, 0.0011, -2.4900), 4.7461),
+    ((50.0000, 2.5000, 0.0000), (50.0000, 0.0000, -2.5000), 4.3065),
+    ((50.0000, 2.5000, 0.0000), (73.0000, 25.0000, -18.0000), 27.1492),
+    ((50.0000, 2.5000, 0.0000), (61.0000, -5.0000, 29.0000), 22.8977),
+    ((50.0000, 2.5000, 0.0000), (56.0000, -27.0000, -3.0000), 31.9030),
+    ((50.0000, 2.5000, 0.0000), (58.0000, 24.0000, 15.0000), 19.4535),
+    ((50.0000, 2.5000, 0.0000), (50.0000, 3.1736, 0.5854), 1.0000),
+    ((50.0000, 2.5000, 0.0000), (50.0000, 3.2972, 0.0000), 1.0000),
+    ((50.0000, 2.5000, 0.0000), (50.0000, 1.8634, 0.5757), 1.0000),
+    ((50.0000, 2.5000, 0.0000), (50.0000, 3.2592, 0.3350), 1.0000),
+    ((60.2574, -34.0099, 36.2677), (60.4626, -34.1751, 39.4387), 1.2644),
+    ((63.0109, -31.0961, -5.8663), (62.8187, -29.7946, -4.0864), 1.2630),
+    ((61.2901, 3.7196, -5.3901), (61.4292, 2.2480, -4.9620), 1.8731),
+    ((35.0831, -44.1164, 3.7933), (35.0232, -40.0716, 1.5901), 1.8645),
+    ((22.7233, 20.0904, -46.6940), (23.0331, 14.9730, -42.5619), 2.0373),
+    ((36.4612, 47.8580, 18.3852), (36.2715, 50.5065, 21.2231), 1.4146),
+    ((90.8027, -2.0831, 1.4410), (91.1528, -1.6435, 0.0447), 1.4441),
+    ((90.9257, -0.5406, -0.9208), (88.6381, -0.8985, -0.7239), 1.5381),
+    ((6.7747, -0.2908, -2.4247), (5.8714, -0.0985, -2.2286), 0.6377),
+    ((2.0776, 0.0795, -1.1350), (0.9033, -0.0636, -0.5514), 0.9082),
+]
+
+
+class ColourMatcherTests(TestCase):
+    def random_palette(self, size=60, seed=0):
+        """Colours of every type, loaded with bulk_create so the palette is invalidated by hand"""
+        rng = np.random.default_rng(seed)
+        types = ["TOP", "BOTTOM", "BOTH"]
+        Colour.objects.bulk_create(
+            Colour(name=f"colour-{index}", r=r, g=g, b=b, type=types[index % 3])
+            for index, (r, g, b) in enumerate(rng.integers(0, 256, size=(size, 3)).tolist())
+        )
+        invalidate_palette()
+
+    def fixed_palette(self):
+        """Six colours, by name, whose matches were worked out by hand"""
+        rows = [
+            ("navy", 20, 30, 120, "BOTH"),
+            ("red", 200, 20, 30, "TOP"),
+            ("maroon", 150, 30, 40, "TOP"),
+            ("khaki", 190, 170, 110, "BOTTOM"),
+            ("sand", 215, 190, 140, "BOTH"),
+            ("black", 15, 15, 15, "BOTH"),
+        ]
+        return {
+            name: Colour.objects.create(name=name, r=r, g=g, b=b, type=colour_type)
+            for name, r, g, b, colour_type in rows
+        }
+
+    def test_palette_arrays_follow_the_colour_table(self):
+        colours = self.fixed_palette()
+
+        palette = get_palette()
+        self.assertEqual(palette.ids.dtype, np.int32)
+        self.assertEqual(palette.rgb.dtype, np.uint8)
+        self.assertEqual(
+            dict(zip(palette.ids.tolist(), palette.rgb.tolist())),
+            {colour.id: [colour.r, colour.g, colour.b] for colour in colours.values()},
+        )
+        self.assertEqual(
+            dict(zip(palette.ids.tolist(), palette.type_mask.tolist())),
+            {colour.id: TYPE_BITS[colour.type] for colour in colours.values()},
+        )
+
+        # Saving a colour bumps the palette version, so the arrays are reloaded
+        white = Colour.objects.create(name="white", r=250, g=250, b=250, type="BOTH")
+        self.assertIn(white.id, get_palette().ids.tolist())
+
+    def test_palette_edits_made_by_another_process_are_picked_up(self):
+        # Process-local caches would keep every other worker on a stale palette
+        self.assertNotIn("locmem", settings.CACHES["default"]["BACKEND"])
+        colours = self.fixed_palette()
+        get_palette()
+
+        # Another process edits a colour: no signal fires here, and it
+        # invalidates through its own connection to the shared cache
+        Colour.objects.filter(id=colours["red"].id).update(r=210)
+        with mock.patch("api.utils.color_matcher.cache", caches.create_connection("default")):
+            invalidate_palette()
+
+        palette = get_palette()
+        red = palette.ids.tolist().index(colours["red"].id)
+        self.assertEqual(palette.rgb[red].tolist(), [210, 20, 30])
+
+    def test_matches_against_a_fixed_palette(self):
+        colours = self.fixed_palette()
+        names = {colour.id: name for name, colour in colours.items()}
+        cases = [
+            # Nearest first: red at 21.2, maroon at 30.8; the TOP colours can't match a BOTTOM
+            ((180, 25, 35), "TOP", ["red", "maroon"]),
+            ((180, 25, 35), "BOTTOM", []),
+            # khaki at 20.6 and sand at 23.5, but khaki is for bottoms only
+            ((200, 180, 125), "TOP", ["sand"]),
+            ((200, 180, 125), "BOTTOM", ["khaki", "sand"]),
+            # black is 57.2 away, just past the threshold of 55
+            ((40, 40, 60), "BOTTOM", []),
+        ]
+
+        for rgb, item_type, expected in cases:
+            with self.subTest(rgb=rgb, item_type=item_type):
+                single = get_top_matches_within_threshold(*rgb, item_type, top_n=3)
+                (batch,) = get_top_matches_for_colours([rgb], [item_type], top_n=3)
+                self.assertEqual([names[colour_id] for colour_id in single], expected)
+                self.assertEqual([names[colour_id] for colour_id in batch], expected)
+
+        wider = get_top_matches_within_threshold(40, 40, 60, "BOTTOM", max_distance=60)
+        self.assertEqual([names[colour_id] for colour_id in wider], ["black"])
+        confidences = get_match_confidence(
+            [(200, 20, 30), (180, 25, 35)], [colours["red"].id] * 2, ["TOP"] * 2
+        )
+        np.testing.assert_allclose(confidences, [1, 1 - np.sqrt(450) / 55])
+
+    def test_delta_e_2000_matches_the_reference_pairs(self):
+        lab1, lab2, expected = (np.array(column) for column in zip(*SHARMA_CIEDE2000_PAIRS))
+
+        np.testing.assert_allclose(delta_e_2000(lab1, lab2), expected, atol=1e-4)
+        np.testing.assert_allclose(delta_e_2000(lab2, lab1), expected, atol=1e-4)
+
+    def test_lab_matching_applies_the_threshold_of_each_item_type(self):
+        navy = Colour.objects.create(name="navy", r=20, g=30, b=120, type="BOTH")
+        # About 3.98 from navy
+        colours, item_types = [(30, 40, 110)] * 2, ["TOP", "BOTTOM"]
+
+        matches = get_top_matches_lab(colours, item_types, thresholds={"TOP": 5, "BOTTOM": 3})
+        self.assertEqual([list(ids) for ids in matches], [[navy.id], []])
+
+        lab_settings = {"COLOUR_MATCH_SPACE": "lab", "COLOUR_MATCH_DELTA_E": {"TOP": 3, "BOTTOM": 5}}
+        with override_settings(**lab_settings):
+            matches = get_top_matches_for_colours(colours, item_types)
+            self.assertEqual([list(ids) for ids in matches], [[], [navy.id]])
+            confidence = get_match_confidence(colours[1:], [navy.id], item_types[1:])
+            np.testing.assert_allclose(confidence, [1 - 3.98 / 5], atol=0.01)
+
+    def test_lookup_table_agrees_with_the_exact_scan(self):
+        self.random_palette()
+        rng = np.random.default_rng(1)
+        colours = rng.integers(0, 256, size=(20000, 3))
+        item_types = ["TOP", "BOTTOM"] * 10000
+
+        exact = get_top_matches_rgb(colours, item_types, max_distance=442)
+        indexed = get_nearest_matches_from_lut(colours, item_types, max_distance=442)
+
+        palette = get_palette()
+        rgb_of = dict(zip(palette.ids.tolist(), palette.rgb.astype(float)))
+        gaps = [
+            np.linalg.norm(rgb_of[int(found[0])] - colour)
+            - np.linalg.norm(rgb_of[int(expected[0])] - colour)
+            for colour, expected, found in zip(colours, exact, indexed)
+            if list(found) != list(expected)
+        ]
+        # Designed to agree on ~99.98% of inputs: a bin's candidates can miss
+        # the nearest colour, but never by more than the bin's diagonal
+        self.assertLessEqual(len(gaps), len(colours) // 1000)
+        self.assertTrue(all(0 <= gap < 4 * np.sqrt(3) for gap in gaps))
+
+
+class SinglePassUploadTests(TemporaryMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 48), (200, 30, 30)).save(buffer, "JPEG")
+        self.jpeg = buffer.getvalue()
+
+    def spooled_upload(self, name):
+        upload = TemporaryUploadedFile(name, "image/jpeg", len(self.jpeg), None)
+        upload.write(self.jpeg)
+        upload.seek(0)
+        self.addCleanup(upload.close)
+        return upload
+
+    def test_uploads_are_read_once_whether_in_memory_or_spooled(self):
+        for upload in (SimpleUploadedFile("a.jpg", self.jpeg), self.spooled_upload("b.jpg")):
+            content = read_upload(upload)
+            self.assertIsInstance(content, memoryview)
+            self.assertEqual(content, self.jpeg)
+            self.assertEqual(upload.read(), self.jpeg)
+
+    def test_decoders_read_straight_from_the_buffer(self):
+        image = Image.open(BufferReader(memoryview(self.jpeg)))
+        self.assertEqual(image.size, (64, 48))
+        self.assertGreater(image.convert("RGB").getpixel((0, 0))[0], 150)
+
+    @override_settings(IMAGE_PROCESSING_BACKEND="thread", IMAGE_QUEUE_MAX_BYTES=100)
+    def test_queued_jobs_only_keep_bytes_within_the_memory_limit(self):
+        executor = mock.Mock()
+        with mock.patch("api.utils.image_pipeline.get_executor", return_value=executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                enqueue_items([1], {1: b"x" * 60})
+                enqueue_items([2], {2: b"y" * 60})
+        (_, _, first_contents, first_size), (_, _, second_contents, second_size) = [
+            call.args for call in executor.submit.call_args_list
+        ]
+        self.assertEqual((first_contents, first_size), ({1: b"x" * 60}, 60))
+        # Over the limit: the worker reads the stored file instead
+        self.assertEqual((second_contents, second_size), (None, 0))
+
+        release_contents(first_size)
+        with mock.patch("api.utils.image_pipeline.get_executor", return_value=executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                enqueue_items([3], {3: b"z" * 60})
+        self.assertEqual(executor.submit.call_args.args[2], {3: b"z" * 60})
+        release_contents(60)
+
+    def test_identical_files_in_a_batch_are_written_once(self):
+        uploads = [
+            SimpleUploadedFile("a.jpg", self.jpeg),
+            self.spooled_upload("b.jpg"),
+            SimpleUploadedFile("c.png", self.jpeg),
+        ]
+        items, contents = create_wardrobe_items(uploads, ["TOP", "BOTTOM", "TOP"])
+
+        self.assertEqual([bytes(content) for content in contents], [self.jpeg] * 3)
+        self.assertEqual(items[0].image.name, items[1].image.name)
+        self.assertNotEqual(items[0].image.name, items[2].image.name)
+        storage = items[0].image.storage
+        for item in WardrobeItem.objects.all():
+            with storage.open(item.image.name) as stored:
+                self.assertEqual(stored.read(), self.jpeg)
+
+    def test_files_written_for_a_failed_insert_are_tombstoned(self):
+        uploads = [SimpleUploadedFile("a.jpg", self.jpeg), SimpleUploadedFile("b.png", self.jpeg)]
+        with mock.patch.object(
+            WardrobeItem.objects, "bulk_create", side_effect=DatabaseError("insert failed")
+        ):
+            with self.assertRaises(DatabaseError):
+                create_wardrobe_items(uploads, ["TOP", "BOTTOM"])
+
+        self.assertFalse(WardrobeItem.objects.exists())
+        tombstones = set(FileTombstone.objects.values_list("name", flat=True))
+        self.assertEqual(len(tombstones), 2)
+        storage = WardrobeItem._meta.get_field("image").storage
+        self.assertTrue(all(storage.exists(name) for name in tombstones))
+
+
+@override_settings(IMAGE_PROCESSING_BACKEND="queue", BATCH_UPLOAD_MAX_FILES=3)
+class BatchUploadTests(TemporaryMediaTestCase):
+    def upload(self, count, item_types):
+        images = []
+        for index in range(count):
+            buffer = io.BytesIO()
+            Image.new("RGB", (32, 32), (index * 40, 30, 30)).save(buffer, "JPEG")
+            images.append(SimpleUploadedFile(f"{index}.jpg", buffer.getvalue(), "image/jpeg"))
+        return self.client.post(
+            reverse("upload_batch"), {"images": images, "item_types": item_types}
+        )
+
+    def test_one_item_type_applies_to_the_whole_batch(self):
+        response = self.upload(3, ["BOTTOM"])
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(
+            set(WardrobeItem.objects.values_list("item_type", "color_status")),
+            {("BOTTOM", "PENDING")},
+        )
+
+    def test_unknown_item_types_are_rejected(self):
+        response = self.upload(2, ["TOP", "SHOES"])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WardrobeItem.objects.exists())
+
+    def test_item_types_must_match_the_images(self):
+        response = self.upload(3, ["TOP", "BOTTOM"])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WardrobeItem.objects.exists())
+
+    def test_batches_over_the_file_limit_are_rejected(self):
+        response = self.upload(4, ["TOP"])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("At most 3 images", response.data["error"])
+        self.assertFalse(WardrobeItem.objects.exists())
+
+
+@override_settings(IMAGE_PROCESSING_MAX_ATTEMPTS=3, IMAGE_PROCESSING_RETRY_DELAY=30)
+class ProcessingStateTests(TemporaryMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.navy = Colour.objects.create(name="navy", r=20, g=30, b=120, type="BOTH")
+
+    def unreadable_item(self):
+        """A PENDING item whose image file was never written"""
+        return WardrobeItem.objects.create(image="wardrobe/missing.jpg", item_type="TOP")
+
+    def assertRetriesIn(self, item, seconds):
+        self.assertAlmostEqual(
+            (item.retry_after - timezone.now()).total_seconds(), seconds, delta=5
+        )
+
+    def test_an_item_is_claimed_once(self):
+        item = self.unreadable_item()
+
+        self.assertTrue(claim_item(item.id))
+        self.assertFalse(claim_item(item.id))
+
+        item.refresh_from_db()
+        self.assertEqual((item.color_status, item.processing_attempts), ("PROCESSING", 1))
+        self.assertIsNotNone(item.processing_started_at)
+
+    def test_failed_items_back_off_until_their_last_attempt_fails(self):
+        item = self.unreadable_item()
+
+        self.assertEqual(process_items([item.id]), [item.id])
+        item.refresh_from_db()
+        self.assertEqual((item.color_status, item.processing_attempts), ("PENDING", 1))
+        self.assertTrue(item.processing_error)
+        self.assertRetriesIn(item, 30)
+        # Not due yet
+        self.assertEqual(process_pending_items(), 0)
+
+        WardrobeItem.objects.filter(id=item.id).update(retry_after=timezone.now())
+        self.assertEqual(process_pending_items(), 1)
+        item.refresh_from_db()
+        self.assertEqual((item.color_status, item.processing_attempts), ("PENDING", 2))
+        self.assertRetriesIn(item, 60)
+
+        WardrobeItem.objects.filter(id=item.id).update(retry_after=timezone.now())
+        self.assertEqual(process_items([item.id]), [])
+        item.refresh_from_db()
+        self.assertEqual((item.color_status, item.processing_attempts), ("FAILED", 3))
+
+    @override_settings(IMAGE_PROCESSING_BACKEND="thread")
+    def test_worker_pool_resubmits_failed_items_after_their_delay(self):
+        item = self.unreadable_item()
+        executor = mock.Mock()
+        executor.submit.side_effect = lambda function, *args: function(*args)
+
+        with mock.patch("api.utils.image_pipeline.get_executor", return_value=executor), \
+                mock.patch("api.utils.image_pipeline.threading.Timer") as timer:
+            with self.captureOnCommitCallbacks(execute=True):
+                enqueue_items([item.id])
+
+        (delay, resubmit), kwargs = timer.call_args
+        self.assertAlmostEqual(delay, 30, delta=5)
+        self.assertEqual(resubmit, executor.submit)
+        self.assertEqual(kwargs["args"][1], [item.id])
+        timer.return_value.start.assert_called_once()
+
+    @override_settings(IMAGE_PROCESSING_BACKEND="thread")
+    def test_worker_pool_jobs_drop_stale_database_connections(self):
+        executor = mock.Mock()
+        executor.submit.side_effect = lambda function, *args: function(*args)
+        calls = []
+
+        with mock.patch("api.utils.image_pipeline.get_executor", return_value=executor), \
+                mock.patch(
+                    "api.utils.image_pipeline.close_old_connections",
+                    side_effect=lambda: calls.append("close"),
+                ), \
+                mock.patch(
+                    "api.utils.image_pipeline.process_items",
+                    side_effect=lambda *args: calls.append("process") or [],
+                ):
+            with self.captureOnCommitCallbacks(execute=True):
+                enqueue_items([1])
+
+        self.assertEqual(calls, ["close", "process", "close"])
+
+    def test_stale_items_are_requeued_or_failed(self):
+        long_ago = timezone.now() - timedelta(minutes=20)
+        stale = WardrobeItem.objects.create(
+            image="wardrobe/a.jpg", item_type="TOP", color_status="PROCESSING",
+            processing_attempts=1, processing_started_at=long_ago,
+        )
+        exhausted = WardrobeItem.objects.create(
+            image="wardrobe/b.jpg", item_type="TOP", color_status="PROCESSING",
+            processing_attempts=3, processing_started_at=long_ago,
+        )
+        running = WardrobeItem.objects.create(
+            image="wardrobe/c.jpg", item_type="TOP", color_status="PROCESSING",
+            processing_attempts=1, processing_started_at=timezone.now(),
+        )
+
+        self.assertEqual(requeue_stale_items(600), 1)
+
+        statuses = dict(WardrobeItem.objects.values_list("id", "color_status"))
+        self.assertEqual(
+            statuses, {stale.id: "PENDING", exhausted.id: "FAILED", running.id: "PROCESSING"}
+        )
+        self.assertEqual(
+            WardrobeItem.objects.get(id=exhausted.id).processing_error, "Processing timed out"
+        )
+
+    def test_process_uploads_works_through_the_backlog(self):
+        content_hash = "a" * 64
+        ImageAnalysis.objects.create(
+            content_hash=content_hash, r=20, g=30, b=120, extractor="meanshift",
+            colours=[[22, 32, 118, 1.0]],
+        )
+        item = WardrobeItem.objects.create(
+            image=f"wardrobe/{content_hash}.jpg", content_hash=content_hash, item_type="TOP"
+        )
+        failing = self.unreadable_item()
+
+        output = io.StringIO()
+        with mock.patch("api.utils.segmentation.preload"):
+            call_command("process_uploads", once=True, stdout=output)
+
+        self.assertIn("Processed 2 items", output.getvalue())
+        item.refresh_from_db()
+        self.assertEqual(item.color_status, "DONE")
+        # Waiting out its retry delay, so the worker stopped after one pass
+        failing.refresh_from_db()
+        self.assertEqual((failing.color_status, failing.processing_attempts), ("PENDING", 1))
+
+        response = self.client.get(reverse("get_processing_status", args=[item.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["color_status"], "DONE")
+        self.assertEqual(response.data["processing_attempts"], 1)
+        self.assertEqual(list(response.data["colors"]), ["navy"])
+
+        response = self.client.get(reverse("get_processing_status", args=[failing.id]))
+        self.assertEqual(response.data["color_status"], "PENDING")
+        self.assertTrue(response.data["processing_error"])
+
+    def test_status_of_an_unknown_item_is_not_found(self):
+        response = self.client.get(reverse("get_processing_status", args=[12345]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ContentAddressedInMemoryStorage(ContentAddressedMixin, InMemoryStorage):
+    pass
+
+
+class ShardedStorageTests(TemporaryMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = WardrobeItem._meta.get_field("image").storage
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (600, 400), (20, 160, 40)).save(buffer, "JPEG")
+        self.jpeg = buffer.getvalue()
+        self.content_hash = hash_file(ContentFile(self.jpeg))
+
+    def test_uploads_are_sharded_by_hash_prefix(self):
+        item = WardrobeItem(item_type="TOP", content_hash=self.content_hash)
+        item.image.save("shirt.JPG", ContentFile(self.jpeg), save=True)
+        h = self.content_hash
+        self.assertEqual(item.image.name, f"wardrobe/{h[:2]}/{h[2:4]}/{h}.jpg")
+
+    def test_relocate_moves_flat_files_thumbnails_and_rows(self):
+        self.storage.save("wardrobe/legacy.jpg", ContentFile(self.jpeg))
+        old = WardrobeItem.objects.create(image="wardrobe/legacy.jpg", item_type="TOP")
+        same_file = WardrobeItem.objects.create(image="wardrobe/legacy.jpg", item_type="BOTTOM")
+        # The thumbnail view still finds the flat file, and caches a derivative for it
+        url = reverse("thumbnail", args=[128, "legacy.jpg"])
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        call_command("relocate_images", batch_size=1, stdout=io.StringIO())
+
+        new_name = WardrobeItem.objects.get(id=old.id).image.name
+        self.assertEqual(WardrobeItem.objects.get(id=same_file.id).image.name, new_name)
+        h = self.content_hash
+        self.assertEqual(new_name, f"wardrobe/{h[:2]}/{h[2:4]}/{h}.jpg")
+        self.assertEqual(WardrobeItem.objects.get(id=old.id).content_hash, self.content_hash)
+        self.assertFalse(self.storage.exists("wardrobe/legacy.jpg"))
+        self.assertTrue(self.storage.exists(thumbnail_name(new_name, 128)))
+        self.assertFalse(self.storage.exists(thumbnail_name("wardrobe/legacy.jpg", 128)))
+
+        output = io.StringIO()
+        call_command("relocate_images", stdout=output)
+        self.assertIn("Moved 0 files", output.getvalue())
+
+    def test_relocate_moves_thumbnails_out_of_the_flat_layout(self):
+        h = self.content_hash
+        self.storage.save(f"wardrobe/{h}.jpg", ContentFile(self.jpeg))
+        item = WardrobeItem.objects.create(
+            image=f"wardrobe/{h}.jpg", content_hash=h, item_type="TOP"
+        )
+        self.storage.save(f"thumbnails/128/{h}.jpg.webp", ContentFile(b"thumb"))
+
+        call_command("relocate_images", stdout=io.StringIO())
+
+        new_name = WardrobeItem.objects.get(id=item.id).image.name
+        self.assertEqual(flat_thumbnail_name(new_name, 128), f"thumbnails/128/{h}.jpg.webp")
+        self.assertFalse(self.storage.exists(f"thumbnails/128/{h}.jpg.webp"))
+        self.assertEqual(self.storage.open(thumbnail_name(new_name, 128)).read(), b"thumb")
+
+    def test_relocate_resumes_legacy_files_moved_by_an_interrupted_batch(self):
+        self.storage.save("wardrobe/legacy.jpg", ContentFile(self.jpeg))
+        item = WardrobeItem.objects.create(image="wardrobe/legacy.jpg", item_type="TOP")
+
+        def interrupted(storage, old_name, new_name):
+            # The image moves, then the batch dies before its rows are committed
+            if old_name.startswith("thumbnails/"):
+                raise RuntimeError("interrupted")
+            return relocate_file(storage, old_name, new_name)
+
+        with mock.patch(
+            "api.management.commands.relocate_images.relocate_file", interrupted
+        ), self.assertRaises(RuntimeError):
+            call_command("relocate_images", stdout=io.StringIO())
+        self.assertEqual(WardrobeItem.objects.get(id=item.id).image.name, "wardrobe/legacy.jpg")
+
+        output = io.StringIO()
+        call_command("relocate_images", stdout=output, stderr=io.StringIO())
+        self.assertIn("(0 missing)", output.getvalue())
+        item.refresh_from_db()
+        self.assertEqual(item.content_hash, self.content_hash)
+        self.assertEqual(self.storage.open(item.image.name).read(), self.jpeg)
+
+    def test_any_storage_backend_can_be_content_addressed(self):
+        storage = ContentAddressedInMemoryStorage()
+        self.assertEqual(storage.save("wardrobe/a.jpg", ContentFile(self.jpeg)), "wardrobe/a.jpg")
+        self.assertEqual(storage.save("wardrobe/a.jpg", ContentFile(b"same name")), "wardrobe/a.jpg")
+        self.assertEqual(storage.open("wardrobe/a.jpg").read(), self.jpeg)
+
+        self.assertTrue(relocate_file(storage, "wardrobe/a.jpg", "wardrobe/ab/a.jpg"))
+        self.assertFalse(storage.exists("wardrobe/a.jpg"))
+        self.assertEqual(storage.open("wardrobe/ab/a.jpg").read(), self.jpeg)
+
+
+class FileSweepTests(TemporaryMediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = WardrobeItem._meta.get_field("image").storage
+
+    def upload(self, colour, item_type="TOP"):
+        buffer = io.BytesIO()
+        Image.new("RGB", (300, 200), colour).save(buffer, "JPEG")
+        upload = SimpleUploadedFile("a.jpg", buffer.getvalue())
+        (item,), _ = create_wardrobe_items([upload], [item_type])
+        return item
+
+    def test_delete_all_only_records_tombstones_and_the_sweep_reclaims_the_files(self):
+        shared = [self.upload((200, 0, 0)), self.upload((200, 0, 0))]
+        other = self.upload((0, 0, 200))
+        kept = self.upload((200, 0, 0), item_type="BOTTOM")
+        size = self.storage.size(other.image.name)
+
+        response = self.client.delete(reverse("delete-all-items", args=["TOP"]))
+        self.assertEqual(response.json()["count"], 3)
+        self.assertEqual(FileTombstone.objects.count(), 2)
+        self.assertTrue(self.storage.exists(other.image.name))
+
+        # Too recent for the default grace period
+        self.assertEqual(sweep_file_tombstones(self.storage), (0, 0, 0))
+        files, reclaimed, in_use = sweep_file_tombstones(self.storage, grace_seconds=0)
+        self.assertEqual((files, reclaimed, in_use), (1, size, 1))
+        self.assertFalse(self.storage.exists(other.image.name))
+        self.assertTrue(self.storage.exists(shared[0].image.name))
+        self.assertEqual(kept.image.name, shared[0].image.name)
+        self.assertFalse(FileTombstone.objects.exists())
+
+    def test_uploading_a_tombstoned_file_again_keeps_it(self):
+        item = self.upload((0, 150, 0))
+        item.delete()
+        self.assertTrue(FileTombstone.objects.filter(name=item.image.name).exists())
+
+        self.upload((0, 150, 0))
+        self.assertFalse(FileTombstone.objects.exists())
+
+    def test_orphans_left_by_past_failures_are_collected(self):
+        item = self.upload((0, 0, 0))
+        self.storage.save("wardrobe/ab/cd/abcd.jpg", ContentFile(b"orphan"))
+        self.storage.save(thumbnail_name("wardrobe/abcd.jpg", 128), ContentFile(b"thumb"))
+        self.storage.save(thumbnail_name(item.image.name, 128), ContentFile(b"thumb"))
+        # A used image's thumbnail left behind in the flat layout
+        self.storage.save(flat_thumbnail_name(item.image.name, 128), ContentFile(b"stale"))
+
+        self.assertEqual(record_orphaned_files(self.storage), 3)
+        output = io.StringIO()
+        call_command("sweep_files", grace=0, stdout=output)
+        self.assertIn("Deleted 3 files", output.getvalue())
+        self.assertFalse(self.storage.exists("wardrobe/ab/cd/abcd.jpg"))
+        self.assertFalse(self.storage.exists(flat_thumbnail_name(item.image.name, 128)))
+        self.assertTrue(self.storage.exists(item.image.name))
+        self.assertTrue(self.storage.exists(thumbnail_name(item.image.name, 128)))
+
+
+class PipelineMetricsTests(TestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = Histogram("test_seconds", "Test.", (0.1, 1.0), label="stage")
+        for value in (0.05, 0.5, 0.5, 2.0):
+            histogram.observe(value, "decode")
+
+        lines = histogram.render().splitlines()
+        self.assertEqual(lines[1], "# TYPE test_seconds histogram")
+        self.assertEqual(
+            lines[2:],
+            [
+                'test_seconds_bucket{stage="decode",le="0.1"} 1',
+                'test_seconds_bucket{stage="decode",le="1.0"} 3',
+                'test_seconds_bucket{stage="decode",le="+Inf"} 4',
+                'test_seconds_sum{stage="decode"} 3.05',
+                'test_seconds_count{stage="decode"} 4',
+            ],
+        )
+
+    def test_stages_are_only_timed_inside_an_enabled_timer(self):
+        with stage("outside"):
+            record("pixels", 10)
+        with StageTimer(enabled=False) as disabled:
+            with stage("decode"):
+                record("pixels", 10)
+        with StageTimer() as timer:
+            for _ in range(2):
+                with stage("decode"):
+                    record("pixels", 10)
+
+        self.assertEqual(disabled.as_dict(), {"stages": {}, "values": {}})
+        self.assertEqual(list(timer.durations), ["decode"])
+        self.assertEqual(timer.values, {"pixels": 10})
+
+    def test_instrumented_analysis_reports_its_stages(self):
+        image = Image.new("RGB", (40, 30), (200, 30, 60))
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        cutout = image.convert("RGBA")
+
+        analysis = analyse_uploaded_image(
+            buffer.getvalue(), mask=encode_mask(cutout), instrument=True
+        )
+        timings = analysis["timings"]
+        self.assertLessEqual(
+            {"decode", "apply_mask", "convert_to_cv2", "estimate_bandwidth", "meanshift_fit"},
+            set(timings["stages"]),
+        )
+        self.assertEqual(timings["values"]["decoded_pixels"], 1200)
+        self.assertEqual(timings["values"]["clusters"], 1)
+        self.assertNotIn("timings", analyse_uploaded_image(buffer.getvalue(), mask=analysis["mask"]))
+
+    def test_metrics_are_served_to_local_addresses_only(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn(b"# TYPE wardrobe_pipeline_stage_seconds histogram", response.content)
+
+        with override_settings(METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+
+class SyntheticWardrobeTests(TestCase):
+    def test_garment_stripes_cover_their_colour_shares(self):
+        image, mask = draw_garment([(200, 0, 0, 0.7), (0, 0, 200, 0.3)], "TOP", noise=0)
+        pixels = np.asarray(image)[np.asarray(mask) > 0]
+        red_share = np.mean(np.all(pixels == (200, 0, 0), axis=1))
+
+        self.assertAlmostEqual(red_share, 0.7, delta=0.05)
+        self.assertTrue(np.all(np.asarray(image)[np.asarray(mask) == 0] == 255))
+
+    def test_wardrobe_wears_weighted_palette_colours_and_has_outfits(self):
+        navy = Colour.objects.create(name="navy", r=20, g=30, b=120, type="BOTH")
+        red = Colour.objects.create(name="red", r=200, g=20, b=30, type="TOP")
+        khaki = Colour.objects.create(name="khaki", r=190, g=170, b=110, type="BOTTOM")
+        for top, bottom in ((navy, khaki), (red, khaki), (red, navy), (navy, navy)):
+            PredefinedPair.objects.create(top_colour=top, bottom_colour=bottom)
+
+        items = generate_wardrobe(4, 3, seed=1)
+        self.assertEqual(
+            [item.item_type for item in items], ["TOP"] * 4 + ["BOTTOM"] * 3
+        )
+        for item in items:
+            colours = list(item.colors.select_related("colour"))
+            self.assertAlmostEqual(sum(colour.weight for colour in colours), 1.0, places=3)
+            self.assertNotIn(
+                "BOTTOM" if item.item_type == "TOP" else "TOP",
+                [colour.colour.type for colour in colours],
+            )
+        self.assertTrue(FinalSelection.objects.exists())
+
+
+class ReclassifyTests(TestCase):
+    def setUp(self):
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        self.checkpoint = os.path.join(checkpoint_dir, "checkpoint.json")
+
+        self.navy = Colour.objects.create(name="navy", r=20, g=30, b=120, type="BOTH")
+        self.red = Colour.objects.create(name="red", r=200, g=20, b=30, type="TOP")
+        self.khaki = Colour.objects.create(name="khaki", r=190, g=170, b=110, type="BOTTOM")
+        PredefinedPair.objects.create(top_colour=self.navy, bottom_colour=self.khaki)
+
+    def analysed_item(self, item_type, colours, content_hash):
+        """A processed item whose analysis is stored but whose image file doesn't exist"""
+        ImageAnalysis.objects.create(
+            content_hash=content_hash, r=0, g=0, b=0, extractor="meanshift", colours=colours
+        )
+        return WardrobeItem.objects.create(
+            image=f"wardrobe/{content_hash}.jpg",
+            content_hash=content_hash,
+            item_type=item_type,
+            color_status="DONE",
+        )
+
+    def test_rematch_only_uses_stored_analyses(self):
+        top = self.analysed_item("TOP", [[22, 32, 118, 0.8], [198, 22, 28, 0.2]], "a" * 64)
+        bottom = self.analysed_item("BOTTOM", [[188, 168, 112, 1.0]], "b" * 64)
+        # Matched against an older palette
+        ItemColor.objects.create(clothing=top, colour=self.red, weight=1.0)
+        unanalysed = WardrobeItem.objects.create(
+            image="wardrobe/c.jpg", item_type="TOP", color_status="DONE"
+        )
+        ItemColor.objects.create(clothing=unanalysed, colour=self.red)
+
+        output, errors = io.StringIO(), io.StringIO()
+        call_command(
+            "reclassify", rematch_only=True, checkpoint=self.checkpoint, stdout=output, stderr=errors
+        )
+
+        self.assertEqual(
+            dict(top.colors.values_list("colour__name", "weight")), {"navy": 0.8, "red": 0.2}
+        )
+        self.assertEqual(list(bottom.colors.values_list("colour__name", flat=True)), ["khaki"])
+        self.assertEqual(list(unanalysed.colors.values_list("colour__name", flat=True)), ["red"])
+        self.assertIn(f"Item {unanalysed.id} kept its colours", errors.getvalue())
+        self.assertEqual(
+            list(FinalSelection.objects.values_list("top_id", "bottom_id")), [(top.id, bottom.id)]
+        )
+        self.assertIn("2 reused, 0 reanalysed, 1 failed", output.getvalue())
+
+    def test_rematch_only_picks_colours_again_from_the_stored_clusters(self):
+        top = self.analysed_item("TOP", [[22, 32, 118, 1.0]], "a" * 64)
+        ImageAnalysis.objects.update(features=[[22, 32, 118, 0.9], [198, 22, 28, 0.1]])
+
+        call_command(
+            "reclassify", rematch_only=True, checkpoint=self.checkpoint, stdout=io.StringIO()
+        )
+        self.assertEqual(dict(top.colors.values_list("colour__name", "weight")), {"navy": 0.9})
+
+        with override_settings(COLOUR_MIN_SHARE=0.05):
+            call_command(
+                "reclassify", rematch_only=True, checkpoint=self.checkpoint, stdout=io.StringIO()
+            )
+        self.assertEqual(
+            dict(top.colors.values_list("colour__name", "weight")), {"navy": 0.9, "red": 0.1}
+        )
+
+    def test_interrupted_run_resumes_after_its_last_chunk(self):
+        items = [
+            self.analysed_item("TOP", [[22, 32, 118, 1.0]], str(index) * 64) for index in range(3)
+        ]
+        calls = []
+
+        def interrupted(chunk, reanalyse=False):
+            calls.append([item.id for item in chunk])
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return reclassify_items(chunk, reanalyse)
+
+        with mock.patch("api.management.commands.reclassify.reclassify_items", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command(
+                    "reclassify", chunk_size=1, checkpoint=self.checkpoint, stdout=io.StringIO()
+                )
+        with open(self.checkpoint) as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)["last_id"], items[0].id)
+
+        output = io.StringIO()
+        call_command("reclassify", chunk_size=1, checkpoint=self.checkpoint, stdout=output)
+        self.assertIn(f"Resuming after item {items[0].id}", output.getvalue())
+        self.assertIn("Reclassified 2 items", output.getvalue())
+        self.assertIn("(3 reused, 0 reanalysed, 0 failed)", output.getvalue())
+        self.assertFalse(os.path.exists(self.checkpoint))
+        for item in items:
+            self.assertEqual(list(item.colors.values_list("colour__name", flat=True)), ["navy"])
+
+    def test_failed_reanalysis_keeps_the_colours_of_every_item_sharing_the_image(self):
+        items = [
+            self.analysed_item("TOP", [[22, 32, 118, 1.0]], "d" * 64),
+            WardrobeItem.objects.create(
+                image="wardrobe/d.jpg", content_hash="d" * 64, item_type="TOP", color_status="DONE"
+            ),
+        ]
+        ImageAnalysis.objects.update(extractor="histogram")
+        for item in items:
+            ItemColor.objects.create(clothing=item, colour=self.red)
+
+        storage = InMemoryStorage()
+        storage.save(items[0].image.name, ContentFile(b"image"))
+        failed = [(None, "segmentation failed")]
+        with mock.patch.object(WardrobeItem._meta.get_field("image"), "storage", storage), \
+                mock.patch("api.utils.image_pipeline.analyse_images", return_value=failed):
+            reused, reanalysed, errors = reclassify_items(list(WardrobeItem.objects.order_by("id")))
+
+        self.assertEqual((reused, reanalysed), (0, 0))
+        self.assertEqual(errors, {item.id: "segmentation failed" for item in items})
+        for item in items:
+            self.assertEqual(list(item.colors.values_list("colour__name", flat=True)), ["red"])
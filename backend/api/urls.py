@@ -4,8 +4,14 @@ from . import views
 
 urlpatterns = [
     path('upload/', views.upload_image, name='upload_image'),
+    path('upload/batch/', views.upload_batch, name='upload_batch'),
     path('wardrobe-items/', views.get_wardrobe_items, name='get_wardrobe_items'),
     path('wardrobe-items/<str:item_id>', views.delete_wardrobe_item, name='delete_wardrobe_item'),
+    path('wardrobe-items/<str:item_id>/status/', views.get_processing_status, name='get_processing_status'),
     path('final-selections/', views.get_final_selections, name='final-selections'),
+    path('recommendations/', views.get_recommendations, name='recommendations'),
     path('delete-all/<str:item_type>/', views.delete_all_items, name='delete-all-items'),
+    path('thumbnails/<int:size>/<str:name>', views.get_thumbnail, name='thumbnail'),
+    path('health/segmentation/', views.segmentation_health, name='segmentation-health'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
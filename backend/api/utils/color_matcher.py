@@ -1,33 +1,156 @@
+from typing import NamedTuple
+from uuid import uuid4
 import numpy as np
-import pandas as pd
 from ..models import Colour
+from django.conf import settings
 from django.core.cache import cache
+from .timing import stage
 
-def prepare_color_matrices():
-    """Prepare color matrices with caching"""
-    cache_key = 'color_matrices'
-    cached_data = cache.get(cache_key)
-    
-    if cached_data is None:
-        colours = Colour.objects.all().values('id', 'name', 'type', 'r', 'g', 'b')
-        color_info = pd.DataFrame(colours)
-        color_matrix = color_info[['r', 'g', 'b']].to_numpy()
-        
-        cached_data = (color_matrix, color_info)
-        cache.set(cache_key, cached_data, timeout=3600)  # Cache for 1 hour
-    
-    return cached_data
+PALETTE_VERSION_KEY = 'colour_palette_version'
+
+# Colour types as bits, so "TOP or BOTH" is a single AND against the item type
+TYPE_BITS = {'TOP': 1, 'BOTTOM': 2, 'BOTH': 3}
+
+# Bits kept per channel in the lookup table: 6 bits gives 64^3 bins of 4x4x4
+LUT_BITS = 6
+# Nearest palette colours kept per bin; the best of them is picked exactly at lookup
+LUT_CANDIDATES = 4
+
+# sRGB (D65) to CIE XYZ, and the D65 reference white
+SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+class Palette(NamedTuple):
+    version: str
+    ids: np.ndarray        # int32, (N,)
+    rgb: np.ndarray        # uint8, (N, 3)
+    type_mask: np.ndarray  # uint8, (N,) of TYPE_BITS
+    lab: np.ndarray        # float64, (N, 3) CIELAB of rgb
+
+_palette = None
+_luts = {'version': None, 'tables': {}}
+
+def get_palette_version():
+    """Current palette version, replaced whenever a Colour changes
+
+    It lives in the shared cache, so an edit made by any process reaches them all.
+    """
+    return cache.get_or_set(PALETTE_VERSION_KEY, 'initial', timeout=None)
+
+def invalidate_palette():
+    """Drop every structure derived from the Colour table, in every process"""
+    # A fresh token rather than an increment: two processes invalidating at
+    # once can't both write the same next version
+    cache.set(PALETTE_VERSION_KEY, uuid4().hex, timeout=None)
+
+def get_palette():
+    """Get the palette as compact NumPy arrays, reloading it when its version changes"""
+    global _palette
+    version = get_palette_version()
+
+    if _palette is None or _palette.version != version:
+        with stage('palette_load'):
+            rows = list(Colour.objects.values_list('id', 'r', 'g', 'b', 'type'))
+            rgb = np.array([row[1:4] for row in rows], dtype=np.uint8).reshape(-1, 3)
+            _palette = Palette(
+                version=version,
+                ids=np.array([row[0] for row in rows], dtype=np.int32),
+                rgb=rgb,
+                type_mask=np.array([TYPE_BITS[row[4]] for row in rows], dtype=np.uint8),
+                lab=rgb_to_lab(rgb),
+            )
+
+    return _palette
+
+def rgb_to_lab(rgb):
+    """Convert sRGB colours (..., 3) in 0-255 to CIELAB under D65"""
+    linear = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(linear > 0.04045, ((linear + 0.055) / 1.055) ** 2.4, linear / 12.92)
+    xyz = linear @ SRGB_TO_XYZ.T / D65_WHITE
+
+    epsilon = (6 / 29) ** 3
+    f = np.where(xyz > epsilon, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([
+        116 * f[..., 1] - 16,
+        500 * (f[..., 0] - f[..., 1]),
+        200 * (f[..., 1] - f[..., 2]),
+    ], axis=-1)
+
+def delta_e_2000(lab1, lab2):
+    """CIEDE2000 colour difference between broadcastable arrays of Lab colours"""
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    # Rescale a* so neutral colours get the right chroma
+    C_mean = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    G = 0.5 * (1 - np.sqrt(C_mean ** 7 / (C_mean ** 7 + 25 ** 7)))
+    a1p, a2p = (1 + G) * a1, (1 + G) * a2
+    C1p, C2p = np.hypot(a1p, b1), np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    # Differences in lightness, chroma and hue
+    chroma_product = C1p * C2p
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(chroma_product == 0, 0, dhp)
+    dHp = 2 * np.sqrt(chroma_product) * np.sin(np.radians(dhp) / 2)
+
+    # Means used by the weighting functions
+    Lp_mean = (L1 + L2) / 2
+    Cp_mean = (C1p + C2p) / 2
+    hp_sum = h1p + h2p
+    hp_mean = np.where(
+        np.abs(h1p - h2p) <= 180,
+        hp_sum / 2,
+        np.where(hp_sum < 360, (hp_sum + 360) / 2, (hp_sum - 360) / 2),
+    )
+    hp_mean = np.where(chroma_product == 0, hp_sum, hp_mean)
+
+    T = (
+        1
+        - 0.17 * np.cos(np.radians(hp_mean - 30))
+        + 0.24 * np.cos(np.radians(2 * hp_mean))
+        + 0.32 * np.cos(np.radians(3 * hp_mean + 6))
+        - 0.20 * np.cos(np.radians(4 * hp_mean - 63))
+    )
+    d_theta = 30 * np.exp(-(((hp_mean - 275) / 25) ** 2))
+    R_C = 2 * np.sqrt(Cp_mean ** 7 / (Cp_mean ** 7 + 25 ** 7))
+    S_L = 1 + 0.015 * (Lp_mean - 50) ** 2 / np.sqrt(20 + (Lp_mean - 50) ** 2)
+    S_C = 1 + 0.045 * Cp_mean
+    S_H = 1 + 0.015 * Cp_mean * T
+    R_T = -np.sin(np.radians(2 * d_theta)) * R_C
+
+    return np.sqrt(
+        (dLp / S_L) ** 2
+        + (dCp / S_C) ** 2
+        + (dHp / S_H) ** 2
+        + R_T * (dCp / S_C) * (dHp / S_H)
+    )
+
+def get_type_mask(palette, item_type):
+    """Boolean mask of the palette colours usable for an item type"""
+    return (palette.type_mask & TYPE_BITS[item_type]) != 0
 
 def get_top_matches_within_threshold(r, g, b, item_type, max_distance=55, top_n=1):
     """Get top N color matches within a threshold distance"""
-    # Get color matrices
-    color_matrix, color_info = prepare_color_matrices()
-    
-    # Filter by type
-    type_mask = (color_info['type'] == item_type) | (color_info['type'] == 'BOTH')
-    color_matrix = color_matrix[type_mask]
-    color_info = color_info[type_mask]
+    if getattr(settings, 'COLOUR_MATCH_SPACE', 'rgb') == 'lab':
+        return get_top_matches_lab([(r, g, b)], [item_type], top_n=top_n)[0]
+    if top_n == 1 and getattr(settings, 'COLOUR_MATCH_INDEX', None) == 'lut':
+        return get_nearest_matches_from_lut([(r, g, b)], [item_type], max_distance)[0]
 
+    palette = get_palette()
+
+    # Filter by type
+    type_mask = get_type_mask(palette, item_type)
+    color_matrix = palette.rgb[type_mask].astype(np.float64)
+    color_ids = palette.ids[type_mask]
 
     input_color = np.array([r, g, b])
 
@@ -37,11 +160,140 @@ def get_top_matches_within_threshold(r, g, b, item_type, max_distance=55, top_n=
     # Find indices where distance is below threshold
     match_indices = np.where(distances <= max_distance)[0]
 
-    # Return matched info with distances
-    matches = color_info.iloc[match_indices].copy()
-    matches["distance"] = distances[match_indices]
-
     # Sort by distance and return the top N matches
-    top_matches = matches.sort_values(by="distance").head(top_n).reset_index(drop=True)
+    order = np.argsort(distances[match_indices], kind='quicksort')[:top_n]
+
+    return color_ids[match_indices[order]]
+
+def rank_matches(distances, allowed, max_distances, palette_ids, top_n):
+    """Keep, per row of an (M, N) distance matrix, the ids of the top N allowed matches"""
+    distances = np.where(allowed & (distances <= max_distances), distances, np.inf)
+
+    # Sort each row by distance and keep the top N finite matches
+    order = np.argsort(distances, axis=1, kind='stable')[:, :top_n]
+    return [
+        palette_ids[row_order[np.isfinite(row[row_order])]]
+        for row, row_order in zip(distances, order)
+    ]
+
+def get_top_matches_for_colours(colours, item_types, max_distance=55, top_n=1):
+    """Get top N color matches for many colours in one vectorized pass"""
+    if getattr(settings, 'COLOUR_MATCH_SPACE', 'rgb') == 'lab':
+        return get_top_matches_lab(colours, item_types, top_n=top_n)
+    if top_n == 1 and getattr(settings, 'COLOUR_MATCH_INDEX', None) == 'lut':
+        return get_nearest_matches_from_lut(colours, item_types, max_distance)
+    return get_top_matches_rgb(colours, item_types, max_distance, top_n)
+
+def get_top_matches_rgb(colours, item_types, max_distance=55, top_n=1):
+    """Get top N color matches for many colours by Euclidean RGB distance"""
+    palette = get_palette()
+    color_matrix = palette.rgb.astype(np.float64)
+
+    input_colours = np.asarray(colours, dtype=float).reshape(-1, 3)
+    item_bits = np.array([TYPE_BITS[item_type] for item_type in item_types], dtype=np.uint8)
+
+    # Distance from every input colour to every palette colour, shape (M, N)
+    distances = np.linalg.norm(input_colours[:, None, :] - color_matrix[None, :, :], axis=2)
+
+    # Rule out colours of the wrong type or beyond the threshold
+    allowed = (palette.type_mask[None, :] & item_bits[:, None]) != 0
+    return rank_matches(distances, allowed, max_distance, palette.ids, top_n)
+
+def get_top_matches_lab(colours, item_types, top_n=1, thresholds=None):
+    """Get top N color matches for many colours by CIEDE2000 with per-type thresholds"""
+    palette = get_palette()
+    thresholds = thresholds or getattr(settings, 'COLOUR_MATCH_DELTA_E', {'TOP': 15, 'BOTTOM': 15})
+
+    input_lab = rgb_to_lab(np.asarray(colours, dtype=float).reshape(-1, 3))
+    item_bits = np.array([TYPE_BITS[item_type] for item_type in item_types], dtype=np.uint8)
+    max_distances = np.array([thresholds[item_type] for item_type in item_types], dtype=float)
+
+    # Perceptual difference from every input colour to every palette colour, shape (M, N)
+    distances = delta_e_2000(input_lab[:, None, :], palette.lab[None, :, :])
+
+    allowed = (palette.type_mask[None, :] & item_bits[:, None]) != 0
+    return rank_matches(distances, allowed, max_distances[:, None], palette.ids, top_n)
+
+def build_colour_lut(color_matrix, allowed, bits=LUT_BITS, candidates=LUT_CANDIDATES):
+    """Map every quantized RGB bin to the indices of its nearest allowed palette colours"""
+    allowed_indices = np.flatnonzero(allowed)
+    if len(allowed_indices) == 0:
+        return None
+    candidates = min(candidates, len(allowed_indices))
+
+    # Centre of every bin, in the same order as the bin index used for lookups
+    levels = 1 << bits
+    step = 256 // levels
+    centres = np.arange(levels, dtype=np.float32) * step + step / 2
+    grid = np.stack(np.meshgrid(centres, centres, centres, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    palette = color_matrix[allowed_indices].astype(np.float32)
+    nearest = np.empty((len(grid), candidates), dtype=np.int32)
+    chunk_size = 16384  # bound the (chunk, palette) distance matrix
+    for start in range(0, len(grid), chunk_size):
+        chunk = grid[start:start + chunk_size]
+        distances = ((chunk[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+        closest = np.argpartition(distances, candidates - 1, axis=1)[:, :candidates]
+        nearest[start:start + chunk_size] = allowed_indices[closest]
+    return nearest
+
+def get_colour_lut(item_type):
+    """Get the lookup table for an item type, rebuilding it when the palette changes"""
+    palette = get_palette()
+    if _luts['version'] != palette.version:
+        _luts['version'] = palette.version
+        _luts['tables'] = {}
+
+    if item_type not in _luts['tables']:
+        with stage('build_lut'):
+            _luts['tables'][item_type] = (
+                build_colour_lut(palette.rgb, get_type_mask(palette, item_type)),
+                palette,
+            )
+    return _luts['tables'][item_type]
+
+def get_nearest_matches_from_lut(colours, item_types, max_distance=55):
+    """Nearest palette colour for many colours via the lookup table, in O(1) per colour"""
+    input_colours = np.clip(np.asarray(colours, dtype=np.int64).reshape(-1, 3), 0, 255)
+    item_types = np.asarray(item_types)
+
+    shift = 8 - LUT_BITS
+    quantized = input_colours >> shift
+    bin_index = (quantized[:, 0] << (2 * LUT_BITS)) | (quantized[:, 1] << LUT_BITS) | quantized[:, 2]
+
+    results = [np.array([], dtype=np.int32)] * len(input_colours)
+    for item_type in np.unique(item_types):
+        nearest, palette = get_colour_lut(item_type)
+        if nearest is None:
+            continue
+
+        rows = np.flatnonzero(item_types == item_type)
+        candidates = nearest[bin_index[rows]]
+
+        # Pick among the bin's candidates using the real colour, not the bin centre
+        distances = np.linalg.norm(
+            palette.rgb[candidates].astype(np.float64) - input_colours[rows][:, None, :], axis=2
+        )
+        best = distances.argmin(axis=1)
+        best_candidates = candidates[np.arange(len(rows)), best]
+        best_distances = distances[np.arange(len(rows)), best]
+        for row, candidate, distance in zip(rows, best_candidates, best_distances):
+            if distance <= max_distance:
+                results[row] = palette.ids[[candidate]]
+    return results
+
+def get_match_confidence(colours, colour_ids, item_types, max_distance=55):
+    """How close each colour is to the palette colour it matched: 1 when exact, 0 at the threshold"""
+    palette = get_palette()
+    index_of = {colour_id: index for index, colour_id in enumerate(palette.ids.tolist())}
+    indices = np.array([index_of[int(colour_id)] for colour_id in colour_ids], dtype=np.int64)
+    input_colours = np.asarray(colours, dtype=float).reshape(-1, 3)
 
-    return top_matches["id"].to_numpy()
+    if getattr(settings, 'COLOUR_MATCH_SPACE', 'rgb') == 'lab':
+        thresholds = getattr(settings, 'COLOUR_MATCH_DELTA_E', {'TOP': 15, 'BOTTOM': 15})
+        distances = delta_e_2000(rgb_to_lab(input_colours), palette.lab[indices])
+        max_distances = np.array([thresholds[item_type] for item_type in item_types], dtype=float)
+    else:
+        distances = np.linalg.norm(input_colours - palette.rgb[indices], axis=1)
+        max_distances = max_distance
+    return np.clip(1 - distances / max_distances, 0, 1)
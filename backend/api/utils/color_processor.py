@@ -1,60 +1,230 @@
 import cv2
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 from rembg import remove
-from sklearn.cluster import MeanShift, estimate_bandwidth
+from sklearn.cluster import MeanShift, MiniBatchKMeans, estimate_bandwidth
+from .segmentation import get_session
+from .timing import StageTimer, record, stage
+from .uploads import BufferReader
 
-def remove_background_from_file(file_bytes):
-    """Remove background from uploaded image (in-memory)"""
-    output_data = remove(file_bytes)
-    return Image.open(io.BytesIO(output_data)).convert("RGBA")
+def load_analysis_image(file_bytes, max_size=None):
+    """Decode an image, shrinking it to fit within max_size pixels as cheaply as possible"""
+    image = Image.open(BufferReader(file_bytes))
+    if max_size:
+        # JPEGs decode straight to a reduced DCT scale, other formats use reduce()
+        image.draft("RGB", (max_size, max_size))
+        image.thumbnail((max_size, max_size), reducing_gap=2.0)
+    return image
+
+def remove_background_from_file(image):
+    """Remove background from uploaded image bytes or a PIL image (in-memory)"""
+    output = remove(image, session=get_session())
+    if isinstance(output, bytes):
+        output = Image.open(io.BytesIO(output))
+    return output.convert("RGBA")
+
+def encode_mask(cutout):
+    """Compress the alpha channel of a cutout into PNG bytes"""
+    buffer = io.BytesIO()
+    cutout.getchannel("A").save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+def apply_mask(image, mask_png):
+    """Rebuild a cutout from the analysis image and its stored mask, without the model"""
+    # Same orientation fix and composite as rembg's own cutout
+    image = ImageOps.exif_transpose(image)
+    mask = Image.open(io.BytesIO(mask_png))
+    if mask.size != image.size:
+        # Stored at a different IMAGE_ANALYSIS_MAX_SIZE
+        mask = mask.resize(image.size, Image.Resampling.LANCZOS)
+    empty = Image.new("RGBA", image.size, 0)
+    return Image.composite(image, empty, mask).convert("RGBA")
 
 def convert_to_cv2(pil_img):
     """Convert PIL image to OpenCV format"""
     open_cv_image = np.array(pil_img)
     return cv2.cvtColor(open_cv_image, cv2.COLOR_RGBA2RGB)
 
-def get_dominant_rgb_meanshift(image):
-    """Extract dominant color using MeanShift clustering"""
+def get_foreground_pixels(image):
+    """Flatten an image to an (N, 3) pixel array without the black (transparent) pixels"""
     pixels = image.reshape((-1, 3))
-    # Remove black (transparent) pixels
-    pixels = pixels[~np.all(pixels == [0, 0, 0], axis=1)]
+    foreground = pixels[~np.all(pixels == [0, 0, 0], axis=1)]
+    record("foreground_pixels", len(foreground))
+    return foreground
+
+def rank_clusters(centres, counts):
+    """Pair cluster centres with their share of the pixels, largest first, as (rgb, share)"""
+    counts = np.asarray(counts)
+    total = counts.sum()
+    # A stable sort keeps the first of equally large clusters first, like argmax
+    return [
+        (tuple(map(int, centres[index])), float(counts[index] / total))
+        for index in np.argsort(-counts, kind="stable")
+        if counts[index] > 0
+    ]
+
+def get_colour_clusters_meanshift(image):
+    """Cluster the foreground colours with MeanShift"""
+    pixels = get_foreground_pixels(image)
 
     if len(pixels) == 0:
-        return (0, 0, 0)  # fallback if no valid pixels
+        return [((0, 0, 0), 1.0)]  # fallback if no valid pixels
 
-    bandwidth = estimate_bandwidth(pixels, quantile=0.1, n_samples=500)
+    with stage("estimate_bandwidth"):
+        bandwidth = estimate_bandwidth(pixels, quantile=0.1, n_samples=500)
     if bandwidth == 0:
         bandwidth = 1  # fallback if bandwidth estimation fails
         
     ms = MeanShift(bandwidth=bandwidth, bin_seeding=True)
-    ms.fit(pixels)
+    with stage("meanshift_fit"):
+        ms.fit(pixels)
+
+    return rank_clusters(ms.cluster_centers_, np.bincount(ms.labels_))
+
+def get_colour_clusters_histogram(image, bins_per_channel=16):
+    """Cluster the foreground colours into the bins of a quantized 3D histogram"""
+    pixels = get_foreground_pixels(image)
+
+    if len(pixels) == 0:
+        return [((0, 0, 0), 1.0)]
+
+    # Index every pixel into a bins_per_channel^3 grid and count with bincount
+    quantized = (pixels.astype(np.int32) * bins_per_channel) // 256
+    bin_index = (
+        quantized[:, 0] * bins_per_channel + quantized[:, 1]
+    ) * bins_per_channel + quantized[:, 2]
+    counts = np.bincount(bin_index, minlength=bins_per_channel ** 3)
+
+    # Average the real pixels of each bin rather than using its centre
+    sums = np.stack(
+        [np.bincount(bin_index, weights=pixels[:, c], minlength=len(counts)) for c in range(3)],
+        axis=1,
+    )
+    means = sums / np.maximum(counts, 1)[:, None]
+    return rank_clusters(means, counts)
+
+def get_colour_clusters_kmeans(image, n_clusters=5, sample_size=5000):
+    """Cluster the foreground colours with MiniBatchKMeans on a random pixel sample"""
+    pixels = get_foreground_pixels(image)
+
+    if len(pixels) == 0:
+        return [((0, 0, 0), 1.0)]
+
+    rng = np.random.default_rng(0)
+    if len(pixels) > sample_size:
+        pixels = pixels[rng.choice(len(pixels), sample_size, replace=False)]
+
+    kmeans = MiniBatchKMeans(
+        n_clusters=min(n_clusters, len(pixels)), n_init=3, random_state=0
+    )
+    labels = kmeans.fit_predict(pixels.astype(np.float32))
+
+    counts = np.bincount(labels, minlength=kmeans.n_clusters)
+    return rank_clusters(kmeans.cluster_centers_, counts)
+
+def get_colour_clusters_median_cut(image, n_colors=8):
+    """Cluster the foreground colours with Pillow's median-cut quantizer"""
+    pixels = get_foreground_pixels(image)
 
-    labels = ms.labels_
-    cluster_centers = ms.cluster_centers_
+    if len(pixels) == 0:
+        return [((0, 0, 0), 1.0)]
+
+    # Quantize the foreground pixels as a one-pixel-wide image
+    strip = Image.fromarray(pixels.reshape((-1, 1, 3)).astype(np.uint8), "RGB")
+    quantized = strip.quantize(colors=n_colors, method=Image.Quantize.MEDIANCUT)
+
+    counts = np.bincount(np.asarray(quantized).ravel())
+    palette = np.array(quantized.getpalette()).reshape((-1, 3))
+    return rank_clusters(palette, counts)
 
-    # Find the largest cluster
-    unique, counts = np.unique(labels, return_counts=True)
-    dominant_index = np.argmax(counts)
-    dominant_color = cluster_centers[dominant_index]
+# Largest clusters stored with an analysis, so colours can be picked again from
+# them for another COLOUR_CLUSTERS or COLOUR_MIN_SHARE without re-analysing
+FEATURE_CLUSTERS = 8
 
-    return tuple(map(int, dominant_color))
+DOMINANT_COLOUR_EXTRACTORS = {
+    "meanshift": get_colour_clusters_meanshift,
+    "histogram": get_colour_clusters_histogram,
+    "kmeans": get_colour_clusters_kmeans,
+    "median_cut": get_colour_clusters_median_cut,
+}
 
-def process_uploaded_image(file_bytes):
-    """Process uploaded image and return dominant RGB color"""
+def get_colour_clusters(image, extractor="meanshift"):
+    """Cluster the foreground with the named extractor, as (rgb, pixel share) largest first"""
     try:
-        # Remove background
-        image_no_bg = remove_background_from_file(file_bytes)
-        
-        # Convert to CV2 format
+        extract = DOMINANT_COLOUR_EXTRACTORS[extractor]
+    except KeyError:
+        raise ValueError(
+            f"Unknown colour extractor {extractor!r}, "
+            f"expected one of {', '.join(DOMINANT_COLOUR_EXTRACTORS)}"
+        )
+    return extract(image)
+
+def get_dominant_rgb(image, extractor="meanshift"):
+    """Extract the dominant color with the named extractor"""
+    return get_colour_clusters(image, extractor)[0][0]
+
+def select_item_colours(clusters, n_colours=3, min_share=0.15):
+    """Keep the largest clusters as [r, g, b, share] rows; the dominant one always stays"""
+    return [
+        [*rgb, round(share, 4)]
+        for index, (rgb, share) in enumerate(clusters[:n_colours])
+        if index == 0 or share >= min_share
+    ]
+
+def analyse_uploaded_image(
+    file_bytes, max_size=None, extractor="meanshift", mask=None, n_colours=3, min_share=0.15,
+    instrument=False,
+):
+    """Segment an image and describe its colours: dominant RGB, weighted colours, mask, features
+
+    features are the extractor's largest clusters, the ones colours are picked from.
+
+    With instrument, the result also has the "timings" of each stage.
+    """
+    if instrument:
+        with StageTimer() as timer:
+            analysis = analyse_uploaded_image(
+                file_bytes, max_size, extractor, mask, n_colours, min_share
+            )
+        analysis["timings"] = timer.as_dict()
+        return analysis
+
+    # Decode at the analysis resolution, so the cost doesn't depend on the camera
+    with stage("decode"):
+        image = load_analysis_image(file_bytes, max_size)
+        image.load()
+    record("decoded_pixels", image.width * image.height)
+
+    # Remove background, or rebuild the cutout from a stored mask
+    if mask is None:
+        with stage("remove_background"):
+            image_no_bg = remove_background_from_file(image)
+        with stage("encode_mask"):
+            mask = encode_mask(image_no_bg)
+    else:
+        with stage("apply_mask"):
+            image_no_bg = apply_mask(image, mask)
+
+    # Convert to CV2 format
+    with stage("convert_to_cv2"):
         image_cv2 = convert_to_cv2(image_no_bg)
-        
-        # Get dominant color
-        dominant_color = get_dominant_rgb_meanshift(image_cv2)
-        
-        return dominant_color
-        
+
+    # One clustering pass gives both the dominant colour and the weighted colours
+    with stage("cluster"):
+        clusters = get_colour_clusters(image_cv2, extractor)
+    record("clusters", len(clusters))
+    colours = select_item_colours(clusters, n_colours, min_share)
+    return {
+        "rgb": tuple(colours[0][:3]),
+        "colours": colours,
+        "mask": mask,
+        "features": [[*rgb, round(share, 4)] for rgb, share in clusters[:FEATURE_CLUSTERS]],
+    }
+
+def try_analyse_uploaded_image(file_bytes, max_size=None, extractor="meanshift", mask=None, **kwargs):
+    """Analyse an image for a worker pool, returning (analysis, None) or (None, error)"""
+    try:
+        return analyse_uploaded_image(file_bytes, max_size, extractor, mask, **kwargs), None
     except Exception as e:
-        print(f"Error processing image: {str(e)}")
-        return (128, 128, 128)
\ No newline at end of file
+        return None, str(e) or e.__class__.__name__
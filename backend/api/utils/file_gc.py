@@ -0,0 +1,152 @@
+import logging
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from ..models import FileTombstone, WardrobeItem, record_file_tombstones
+from ..storage import wardrobe_image_name
+from .thumbnails import get_thumbnail_sizes, thumbnail_name
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIRECTORY = "thumbnails"
+IMAGE_DIRECTORY = "wardrobe"
+
+
+def is_thumbnail(name):
+    """Whether a storage name is a derived thumbnail rather than an uploaded image"""
+    return name.startswith(f"{THUMBNAIL_DIRECTORY}/")
+
+
+def thumbnail_source_names(name):
+    """Image names a thumbnail may have been rendered from, in the sharded and flat layouts"""
+    image_basename = os.path.basename(name)[: -len(".webp")]
+    return [wardrobe_image_name(image_basename), f"{IMAGE_DIRECTORY}/{image_basename}"]
+
+
+def current_thumbnail_names(image_name):
+    """Where the thumbnails of an image are stored in the current layout, at every size"""
+    return {thumbnail_name(image_name, size) for size in get_thumbnail_sizes()}
+
+
+def delete_stored_file(storage, name):
+    """Delete a stored file, returning its size in bytes, or None if there was no file"""
+    if not storage.exists(name):
+        return None
+    try:
+        size = storage.size(name)
+    except (OSError, NotImplementedError):
+        size = 0
+    storage.delete(name)
+    return size
+
+
+def sweep_file_tombstones(storage, batch_size=None, grace_seconds=None):
+    """Delete the files of tombstones past the grace period, returning (files, bytes, kept)
+
+    Images still used by an item only lose their tombstone. Deleting an image
+    also deletes its thumbnails.
+    """
+    batch_size = batch_size or getattr(settings, "FILE_GC_BATCH_SIZE", 500)
+    if grace_seconds is None:
+        grace_seconds = getattr(settings, "FILE_GC_GRACE_SECONDS", 300)
+    # Uploads write their file before their row is committed; the grace period
+    # covers that window for a tombstone recorded in between
+    cutoff = timezone.now() - timedelta(seconds=grace_seconds)
+    files = reclaimed = kept = 0
+
+    while True:
+        with transaction.atomic():
+            # Uploads reusing a name delete its tombstone, which waits for this batch
+            tombstones = list(
+                FileTombstone.objects.select_for_update(skip_locked=True)
+                .filter(created_at__lte=cutoff)
+                .order_by("id")[:batch_size]
+            )
+            if not tombstones:
+                break
+
+            names = [tombstone.name for tombstone in tombstones]
+            candidates = {
+                name: thumbnail_source_names(name) if is_thumbnail(name) else [name]
+                for name in names
+            }
+            still_used = set(
+                WardrobeItem.objects.filter(
+                    image__in=[source for sources in candidates.values() for source in sources]
+                ).values_list("image", flat=True)
+            )
+
+            for name in names:
+                if is_thumbnail(name):
+                    # Only the current name of a used image's thumbnail is kept, not
+                    # a stale copy in an older layout
+                    in_use = any(
+                        name in current_thumbnail_names(source)
+                        for source in still_used.intersection(candidates[name])
+                    )
+                else:
+                    in_use = name in still_used
+                if in_use:
+                    kept += 1
+                    continue
+                derived = [] if is_thumbnail(name) else [
+                    thumbnail_name(name, size) for size in get_thumbnail_sizes()
+                ]
+                for file_name in [name, *derived]:
+                    try:
+                        size = delete_stored_file(storage, file_name)
+                    except Exception as e:
+                        # Keep sweeping; the orphan scan finds the file again later
+                        logger.error(f"Error deleting {file_name}: {str(e)}")
+                        continue
+                    if size is not None:
+                        files += 1
+                        reclaimed += size
+
+            FileTombstone.objects.filter(id__in=[tombstone.id for tombstone in tombstones]).delete()
+
+    return files, reclaimed, kept
+
+
+def iter_stored_files(storage, directory):
+    """Every file name under a storage directory, walking its subdirectories"""
+    try:
+        subdirectories, file_names = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for file_name in file_names:
+        yield f"{directory}/{file_name}"
+    for subdirectory in subdirectories:
+        yield from iter_stored_files(storage, f"{directory}/{subdirectory}")
+
+
+def find_orphaned_files(storage):
+    """Stored images no item points at, and thumbnails not stored where a used image's are
+
+    That includes thumbnails of used images left in an older layout or at a
+    size no longer served.
+    """
+    referenced = set(WardrobeItem.objects.values_list("image", flat=True).iterator())
+    current_thumbnails = set().union(*map(current_thumbnail_names, referenced))
+
+    for name in iter_stored_files(storage, IMAGE_DIRECTORY):
+        if name not in referenced:
+            yield name
+    for name in iter_stored_files(storage, THUMBNAIL_DIRECTORY):
+        if name not in current_thumbnails:
+            yield name
+
+
+def record_orphaned_files(storage, batch_size=1000):
+    """Tombstone every orphaned file, so the next sweeps past the grace period collect it"""
+    orphans, found = [], 0
+    for name in find_orphaned_files(storage):
+        orphans.append(name)
+        if len(orphans) == batch_size:
+            record_file_tombstones(orphans)
+            found += len(orphans)
+            orphans = []
+    record_file_tombstones(orphans)
+    return found + len(orphans)
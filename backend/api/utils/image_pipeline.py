@@ -0,0 +1,617 @@
+import hashlib
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from collections import defaultdict
+from functools import partial
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+from ..models import WardrobeItem, ItemColor, ImageAnalysis, FileTombstone, record_file_tombstones
+from .color_processor import select_item_colours, try_analyse_uploaded_image
+from .color_matcher import get_match_confidence, get_top_matches_for_colours
+from .metrics import log_event, metrics_enabled, observe_analysis, observe_stages
+from .outfit_matcher import add_item_selections
+from .thumbnails import create_thumbnails
+from .timing import StageTimer, stage
+from .uploads import read_upload
+from . import segmentation
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_process_pool = None
+# Upload bytes held by jobs on the thread pool, queued or running
+_held_bytes = 0
+_held_bytes_lock = threading.Lock()
+
+
+def get_executor():
+    """Get the process-wide worker pool, creating it on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "IMAGE_PROCESSING_WORKERS", 2),
+            thread_name_prefix="image-pipeline",
+        )
+    return _executor
+
+
+def get_process_pool():
+    """Get the process pool used to segment batches of images in parallel"""
+    global _process_pool
+    if _process_pool is None:
+        # Spawn rather than fork: the parent already runs threads and ONNX sessions
+        _process_pool = ProcessPoolExecutor(
+            max_workers=getattr(settings, "IMAGE_PROCESSING_PROCESSES", None),
+            mp_context=multiprocessing.get_context("spawn"),
+            # Each worker loads the segmentation model once, up front
+            initializer=segmentation.preload,
+            initargs=(
+                getattr(settings, "REMBG_MODEL", None),
+                getattr(settings, "REMBG_THREADS", None),
+            ),
+        )
+    return _process_pool
+
+
+def create_wardrobe_items(images, item_types):
+    """Store a batch of uploaded files and insert their WardrobeItems in one query
+
+    Returns the items and, for each, its file's content as read from the upload,
+    so processing doesn't read the stored file back.
+    """
+    image_field = WardrobeItem._meta.get_field("image")
+    items, contents, uploads = [], [], {}
+    for image, item_type in zip(images, item_types):
+        content = read_upload(image)
+        # The content hash names the file, identical images are stored once
+        item = WardrobeItem(item_type=item_type, content_hash=hashlib.sha256(content).hexdigest())
+        item.image = image_field.generate_filename(item, image.name)
+        uploads.setdefault(item.image.name, (item, image))
+        items.append(item)
+        contents.append(content)
+
+    # A file waiting to be swept is needed again. Once a sweep holding the
+    # tombstone finishes, saving writes the file back if it was deleted
+    FileTombstone.objects.filter(name__in=list(uploads)).delete()
+
+    def persist(upload):
+        item, image = upload
+        item.image.save(image.name, image, save=False)
+
+    try:
+        # Distinct files are written concurrently
+        workers = min(len(uploads), getattr(settings, "IMAGE_UPLOAD_WRITE_WORKERS", 4))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-writer") as pool:
+                list(pool.map(persist, uploads.values()))
+        else:
+            for upload in uploads.values():
+                persist(upload)
+
+        return WardrobeItem.objects.bulk_create(items), contents
+    except Exception:
+        # Files already written have no row pointing at them; the sweeper
+        # deletes them unless another item shares them
+        record_file_tombstones(item.image.name for item, _ in uploads.values())
+        raise
+
+
+def enqueue_items(item_ids, contents=None):
+    """Schedule colour processing for freshly uploaded items
+
+    contents maps item ids to their image bytes when the caller already has
+    them in memory; the in-process backends then skip reading the file.
+    """
+    backend = getattr(settings, "IMAGE_PROCESSING_BACKEND", "thread")
+    item_ids = list(item_ids)
+
+    if backend == "sync":
+        while item_ids:
+            item_ids = process_items(item_ids, contents)
+    elif backend == "thread":
+        def submit():
+            held_contents, held_bytes = hold_contents(contents)
+            get_executor().submit(_run_in_thread, item_ids, held_contents, held_bytes)
+
+        transaction.on_commit(submit)
+    # With the "queue" backend the row itself is the job: the process_uploads
+    # worker command picks up every PENDING item
+
+
+def enqueue_item(item_id, content=None):
+    """Schedule colour processing for a single uploaded item"""
+    enqueue_items([item_id], None if content is None else {item_id: content})
+
+
+def hold_contents(contents):
+    """Keep upload bytes for a queued job if IMAGE_QUEUE_MAX_BYTES allows, as (contents, size)
+
+    Past the limit the job gets no bytes and its worker reads the stored
+    file, so a backlog of queued uploads can't pile up in memory.
+    """
+    global _held_bytes
+    size = sum(len(content) for content in (contents or {}).values())
+    if not size:
+        return None, 0
+    with _held_bytes_lock:
+        if _held_bytes + size > getattr(settings, "IMAGE_QUEUE_MAX_BYTES", 64 * 1024 * 1024):
+            return None, 0
+        _held_bytes += size
+    return contents, size
+
+
+def release_contents(size):
+    """Give back the bytes hold_contents() let a job keep"""
+    global _held_bytes
+    with _held_bytes_lock:
+        _held_bytes -= size
+
+
+def _run_in_thread(item_ids, contents=None, held_bytes=0):
+    """Process items on the worker pool, resubmitting the ones with retries left"""
+    # Pool threads outlive requests: drop connections the database has closed
+    # (restart, idle timeout) or that are past CONN_MAX_AGE around every job
+    close_old_connections()
+    try:
+        retry_ids = process_items(item_ids, contents)
+        if retry_ids:
+            schedule_retry(retry_ids)
+    except Exception as e:
+        logger.error(f"Unexpected error in image pipeline for items {item_ids}: {str(e)}")
+    finally:
+        release_contents(held_bytes)
+        close_old_connections()
+
+
+def schedule_retry(item_ids):
+    """Resubmit items to the worker pool once their retry_after time has passed"""
+    retry_after = WardrobeItem.objects.filter(id__in=item_ids).aggregate(Max("retry_after"))[
+        "retry_after__max"
+    ]
+    delay = max((retry_after - timezone.now()).total_seconds(), 0) if retry_after else 0
+    timer = threading.Timer(delay, get_executor().submit, args=(_run_in_thread, item_ids))
+    timer.daemon = True
+    timer.start()
+
+
+def claim_item(item_id):
+    """Atomically move an item from PENDING to PROCESSING; False if someone else has it"""
+    return (
+        WardrobeItem.objects.filter(id=item_id, color_status="PENDING").update(
+            color_status="PROCESSING",
+            processing_attempts=F("processing_attempts") + 1,
+            processing_started_at=timezone.now(),
+        )
+        == 1
+    )
+
+
+def analyse_images(images_bytes, masks=None):
+    """Segment and cluster many images, in parallel when there is more than one
+
+    Images with a stored background mask skip the segmentation model.
+    """
+    global _process_pool
+    analyse = partial(
+        try_analyse_uploaded_image,
+        max_size=getattr(settings, "IMAGE_ANALYSIS_MAX_SIZE", None),
+        extractor=getattr(settings, "COLOUR_EXTRACTOR", "meanshift"),
+        n_colours=getattr(settings, "COLOUR_CLUSTERS", 3),
+        min_share=getattr(settings, "COLOUR_MIN_SHARE", 0.15),
+        instrument=metrics_enabled(),
+    )
+    masks = masks or [None] * len(images_bytes)
+
+    if len(images_bytes) > 1 and getattr(settings, "IMAGE_PROCESSING_PROCESSES", None) != 0:
+        try:
+            # Memoryviews can't be pickled across to the workers
+            images_bytes = [bytes(image_bytes) for image_bytes in images_bytes]
+            return list(get_process_pool().map(analyse, images_bytes, masks))
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool for the next batch
+            _process_pool = None
+            raise
+    return [analyse(image_bytes, mask=mask) for image_bytes, mask in zip(images_bytes, masks)]
+
+
+def analysis_colours(analysis):
+    """Weighted [r, g, b, share] colours of an ImageAnalysis under the current settings
+
+    They are picked again from the stored clusters, so a COLOUR_CLUSTERS or
+    COLOUR_MIN_SHARE change only needs re-matching. Analyses stored without
+    clusters keep the colours they were given, or their dominant colour alone.
+    """
+    if analysis.features:
+        return select_item_colours(
+            [(feature[:3], feature[3]) for feature in analysis.features],
+            n_colours=getattr(settings, "COLOUR_CLUSTERS", 3),
+            min_share=getattr(settings, "COLOUR_MIN_SHARE", 0.15),
+        )
+    return analysis.colours or [[analysis.r, analysis.g, analysis.b, 1.0]]
+
+
+def match_weighted_colours(wardrobe_items, item_colours):
+    """Match every weighted colour of every item in one call
+
+    Returns, per item, {colour_id: weight} and {colour_id: match confidence}.
+    """
+    owners, rgbs, item_types = [], [], []
+    for index, (item, colours) in enumerate(zip(wardrobe_items, item_colours)):
+        for r, g, b, share in colours:
+            owners.append((index, share))
+            rgbs.append((r, g, b))
+            item_types.append(item.item_type)
+
+    matched, matched_rgbs, matched_ids, matched_types = [], [], [], []
+    for owner, rgb, item_type, colour_ids in zip(
+        owners, rgbs, item_types, get_top_matches_for_colours(rgbs, item_types)
+    ):
+        for colour_id in colour_ids:
+            matched.append(owner)
+            matched_rgbs.append(rgb)
+            matched_ids.append(int(colour_id))
+            matched_types.append(item_type)
+    confidences = get_match_confidence(matched_rgbs, matched_ids, matched_types)
+
+    # Two clusters matching the same palette colour add up their shares and
+    # average their confidence by share
+    weights = [defaultdict(float) for _ in wardrobe_items]
+    confidence_sums = [defaultdict(float) for _ in wardrobe_items]
+    for (index, share), colour_id, confidence in zip(matched, matched_ids, confidences):
+        weights[index][colour_id] += share
+        confidence_sums[index][colour_id] += share * float(confidence)
+    item_confidences = [
+        {colour_id: confidence_sums[index][colour_id] / weight for colour_id, weight in item_weights.items()}
+        for index, item_weights in enumerate(weights)
+    ]
+    return weights, item_confidences
+
+
+def build_item_colours(wardrobe_items, colour_weights, colour_confidences):
+    """ItemColor rows for matched items and their {colour_id: weight} maps"""
+    return [
+        ItemColor(
+            clothing=item,
+            colour_id=colour_id,
+            weight=round(weight, 4),
+            confidence=round(confidences[colour_id], 4),
+        )
+        for item, weights, confidences in zip(wardrobe_items, colour_weights, colour_confidences)
+        for colour_id, weight in weights.items()
+    ]
+
+
+def assign_item_colours(wardrobe_items, item_colours):
+    """Match all items' weighted colours against the palette at once and store the ItemColor rows"""
+    with stage("match"):
+        colour_weights, colour_confidences = match_weighted_colours(wardrobe_items, item_colours)
+
+    with stage("store"):
+        # The colours are committed before partners are looked up. Of two
+        # items processed at once by different workers, the one pairing
+        # itself last then always sees the other's colours
+        with transaction.atomic():
+            ItemColor.objects.bulk_create(
+                build_item_colours(wardrobe_items, colour_weights, colour_confidences),
+                ignore_conflicts=True,
+            )
+
+        # Pair each new item with its matching partners
+        for item, weights in zip(wardrobe_items, colour_weights):
+            add_item_selections(item, colour_weights=weights)
+
+    return colour_weights
+
+
+def build_image_analysis(content_hash, analysis):
+    """ImageAnalysis row storing the dominant colour, cutout mask and colour features"""
+    r, g, b = analysis["rgb"]
+    return ImageAnalysis(
+        content_hash=content_hash,
+        r=r,
+        g=g,
+        b=b,
+        extractor=getattr(settings, "COLOUR_EXTRACTOR", "meanshift"),
+        mask=analysis["mask"],
+        features=analysis["features"],
+        colours=analysis["colours"],
+    )
+
+
+def create_item_thumbnails(wardrobe_item, image_bytes):
+    """Write an upload's resized copies while its bytes are already in memory"""
+    try:
+        create_thumbnails(wardrobe_item.image.storage, wardrobe_item.image.name, image_bytes)
+    except Exception as e:
+        # Not fatal: the thumbnail view renders missing sizes on first request
+        logger.error(f"Error creating thumbnails for item {wardrobe_item.id}: {str(e)}")
+
+
+def rematch_items(wardrobe_items, analyses=None):
+    """Redo colour matching from stored analyses, returning the items that have none
+
+    No image is read and no model runs, so this is the cheap path after a
+    palette, pair, threshold, COLOUR_CLUSTERS or COLOUR_MIN_SHARE change.
+    analyses optionally maps content hashes to ImageAnalysis rows already
+    loaded. The items' ItemColor rows are replaced in one transaction;
+    outfits are left to rebuild_final_selections().
+    """
+    if analyses is None:
+        analyses = {
+            analysis.content_hash: analysis
+            for analysis in ImageAnalysis.objects.filter(
+                content_hash__in=[item.content_hash for item in wardrobe_items if item.content_hash]
+            ).only("content_hash", "r", "g", "b", "colours", "features")
+        }
+    matched_items = [item for item in wardrobe_items if item.content_hash in analyses]
+    colour_weights, colour_confidences = match_weighted_colours(
+        matched_items, [analysis_colours(analyses[item.content_hash]) for item in matched_items]
+    )
+
+    with transaction.atomic():
+        ItemColor.objects.filter(clothing__in=matched_items).delete()
+        ItemColor.objects.bulk_create(
+            build_item_colours(matched_items, colour_weights, colour_confidences)
+        )
+
+    return [item for item in wardrobe_items if item.content_hash not in analyses]
+
+
+def reclassify_items(wardrobe_items, reanalyse=False):
+    """Recompute the colours of processed items, returning (reused, reanalysed, errors)
+
+    Stored analyses from the current extractor are reused as they are. The
+    others are analysed again, on the process pool, through their stored
+    mask when they have one. The items are then re-matched by rematch_items().
+    """
+    extractor = getattr(settings, "COLOUR_EXTRACTOR", "meanshift")
+    analyses = {
+        analysis.content_hash: analysis
+        for analysis in ImageAnalysis.objects.filter(
+            content_hash__in=[item.content_hash for item in wardrobe_items if item.content_hash]
+        )
+    }
+
+    # 1. Read the images whose analysis is missing or out of date, once per content hash
+    stale_items, images_bytes, masks, errors = {}, [], [], {}
+    for item in wardrobe_items:
+        analysis = analyses.get(item.content_hash)
+        if analysis is not None and analysis.extractor == extractor and not reanalyse:
+            continue
+        if item.content_hash in stale_items:
+            stale_items[item.content_hash].append(item)
+            continue
+        try:
+            with item.image.open("rb") as img_file:
+                image_bytes = img_file.read()
+        except Exception as e:
+            errors[item.id] = str(e)
+            continue
+        if not item.content_hash:
+            item.content_hash = hashlib.sha256(image_bytes).hexdigest()
+            WardrobeItem.objects.filter(id=item.id).update(content_hash=item.content_hash)
+            if item.content_hash in stale_items:
+                stale_items[item.content_hash].append(item)
+                continue
+        stale_items[item.content_hash] = [item]
+        images_bytes.append(image_bytes)
+        masks.append(bytes(analysis.mask) if analysis and analysis.mask else None)
+
+    # 2. Analyse them, skipping segmentation where a mask is stored
+    new_analyses = []
+    for (content_hash, items), (result, error) in zip(
+        stale_items.items(), analyse_images(images_bytes, masks)
+    ):
+        if error is not None:
+            # Every item sharing the image keeps its colours, none is matched
+            # from the out-of-date analysis
+            errors.update((item.id, error) for item in items)
+            continue
+        analyses[content_hash] = build_image_analysis(content_hash, result)
+        new_analyses.append(analyses[content_hash])
+
+    ImageAnalysis.objects.bulk_create(
+        new_analyses,
+        update_conflicts=True,
+        unique_fields=["content_hash"],
+        update_fields=["r", "g", "b", "extractor", "mask", "features", "colours"],
+    )
+
+    # 3. Match the whole chunk at once and swap its ItemColor rows. Every item
+    # left has a current analysis, stored or just made
+    matched_items = [item for item in wardrobe_items if item.id not in errors]
+    rematch_items(matched_items, analyses)
+
+    new_hashes = {analysis.content_hash for analysis in new_analyses}
+    reanalysed = sum(item.content_hash in new_hashes for item in matched_items)
+    return len(matched_items) - reanalysed, reanalysed, errors
+
+
+def _record_failure(wardrobe_item, error):
+    """Store the error and either requeue the item or mark it FAILED, returning the status
+
+    Requeued items wait IMAGE_PROCESSING_RETRY_DELAY seconds, doubled for
+    every attempt already made, before they are retried.
+    """
+    max_attempts = getattr(settings, "IMAGE_PROCESSING_MAX_ATTEMPTS", 3)
+    new_status = "PENDING" if wardrobe_item.processing_attempts < max_attempts else "FAILED"
+    retry_after = None
+    if new_status == "PENDING":
+        delay = getattr(settings, "IMAGE_PROCESSING_RETRY_DELAY", 30)
+        retry_after = timezone.now() + timedelta(
+            seconds=delay * 2 ** (wardrobe_item.processing_attempts - 1)
+        )
+    logger.error(
+        f"Error processing image colors for item {wardrobe_item.id} "
+        f"(attempt {wardrobe_item.processing_attempts}): {error}"
+    )
+    WardrobeItem.objects.filter(id=wardrobe_item.id).update(
+        color_status=new_status, processing_error=error, retry_after=retry_after
+    )
+    return new_status
+
+
+def process_items(item_ids, contents=None):
+    """Run background removal and colour matching for items, returning the ids to retry
+
+    contents optionally maps item ids to image bytes already in memory.
+    """
+    contents = contents or {}
+    claimed_ids = [item_id for item_id in item_ids if claim_item(item_id)]
+    wardrobe_items = list(WardrobeItem.objects.filter(id__in=claimed_ids))
+    retry_ids = []
+    # Stages shared by the batch, and the read and analysis stages of each item
+    batch_timer = StageTimer(enabled=metrics_enabled())
+    item_timers = defaultdict(StageTimer)
+
+    # 1. Reuse the colours of images we have already analysed
+    known_colours = {
+        analysis.content_hash: analysis_colours(analysis)
+        for analysis in ImageAnalysis.objects.filter(
+            content_hash__in=[item.content_hash for item in wardrobe_items if item.content_hash]
+        )
+    }
+
+    known_keys = set(known_colours)
+
+    # 2. Read each new image once, even if it appears several times in the batch
+    readable_items, images_bytes, read_keys = [], [], {}
+    for item in wardrobe_items:
+        key = item.content_hash or item.image.name
+        if key in known_colours or key in read_keys:
+            continue
+        try:
+            with item_timers[item.id].stage("read"):
+                if item.id in contents:
+                    images_bytes.append(contents[item.id])
+                else:
+                    with item.image.open("rb") as img_file:
+                        images_bytes.append(img_file.read())
+            if not item.content_hash:
+                # Uploaded before content hashing, so its analysis can be stored too
+                item.content_hash = hashlib.sha256(images_bytes[-1]).hexdigest()
+                WardrobeItem.objects.filter(id=item.id).update(content_hash=item.content_hash)
+            with item_timers[item.id].stage("thumbnails"):
+                create_item_thumbnails(item, images_bytes[-1])
+            read_keys[key] = item
+            readable_items.append(item)
+        except Exception as e:
+            if _record_failure(item, str(e)) == "PENDING":
+                retry_ids.append(item.id)
+
+    # 3. Segment and extract the weighted colours
+    try:
+        with batch_timer.stage("analyse"):
+            results = analyse_images(images_bytes)
+    except Exception as e:
+        results = [(None, str(e))] * len(readable_items)
+
+    new_analyses, failed_keys = [], {}
+    for item, (analysis, error) in zip(readable_items, results):
+        key = item.content_hash or item.image.name
+        if error is not None:
+            failed_keys[key] = error
+            continue
+        logger.info(f"{item.image.name} Dominant RGB: {analysis['rgb']}")
+        if "timings" in analysis:
+            item_timers[item.id].durations.update(analysis["timings"]["stages"])
+            item_timers[item.id].values.update(analysis.pop("timings")["values"])
+        known_colours[key] = analysis["colours"]
+        if item.content_hash:
+            new_analyses.append(build_image_analysis(item.content_hash, analysis))
+
+    ImageAnalysis.objects.bulk_create(new_analyses, ignore_conflicts=True)
+
+    analysed_items, item_colours = [], []
+    for item in wardrobe_items:
+        key = item.content_hash or item.image.name
+        if key in known_colours:
+            analysed_items.append(item)
+            item_colours.append(known_colours[key])
+        elif key in failed_keys:
+            if _record_failure(item, failed_keys[key]) == "PENDING":
+                retry_ids.append(item.id)
+
+    # 4. Match colours and build outfits for the whole batch
+    done_ids = set()
+    if analysed_items:
+        try:
+            with batch_timer:
+                assign_item_colours(analysed_items, item_colours)
+        except Exception as e:
+            for item in analysed_items:
+                if _record_failure(item, str(e)) == "PENDING":
+                    retry_ids.append(item.id)
+        else:
+            done_ids = {item.id for item in analysed_items}
+            WardrobeItem.objects.filter(id__in=done_ids).update(
+                color_status="DONE", processing_error="", processed_at=timezone.now()
+            )
+
+    if batch_timer.enabled:
+        report_processed_items(
+            wardrobe_items, item_timers, batch_timer, done_ids, set(retry_ids), known_keys
+        )
+    return retry_ids
+
+
+def report_processed_items(wardrobe_items, item_timers, batch_timer, done_ids, retry_ids, cached_keys):
+    """Add a processed batch to the pipeline metrics and log one line per item"""
+    observe_stages(batch_timer.durations)
+    for item in wardrobe_items:
+        timer = item_timers[item.id]
+        observe_analysis(timer.as_dict())
+        if item.id in done_ids:
+            item_status = "DONE"
+        else:
+            item_status = "PENDING" if item.id in retry_ids else "FAILED"
+        log_event(
+            "item_processed",
+            item_id=item.id,
+            item_type=item.item_type,
+            status=item_status,
+            cached=(item.content_hash or item.image.name) in cached_keys,
+            batch_size=len(wardrobe_items),
+            stages={
+                name: round(seconds, 6)
+                for name, seconds in {**timer.durations, **batch_timer.durations}.items()
+            },
+            **timer.values,
+        )
+
+
+def requeue_stale_items(timeout):
+    """Put back items left in PROCESSING by a worker that died mid-job"""
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    max_attempts = getattr(settings, "IMAGE_PROCESSING_MAX_ATTEMPTS", 3)
+    stale_items = WardrobeItem.objects.filter(
+        color_status="PROCESSING", processing_started_at__lt=cutoff
+    )
+
+    stale_items.filter(processing_attempts__gte=max_attempts).update(
+        color_status="FAILED", processing_error="Processing timed out"
+    )
+    return stale_items.update(color_status="PENDING")
+
+
+def process_pending_items(limit=None):
+    """Process a batch of PENDING items in upload order, returning how many were picked up
+
+    Failed items waiting out their retry delay are left for a later batch.
+    """
+    pending_ids = WardrobeItem.objects.filter(
+        Q(retry_after__isnull=True) | Q(retry_after__lte=timezone.now()),
+        color_status="PENDING",
+    ).order_by("created_at", "id").values_list("id", flat=True)
+    if limit:
+        pending_ids = pending_ids[:limit]
+
+    pending_ids = list(pending_ids)
+    process_items(pending_ids)
+    return len(pending_ids)
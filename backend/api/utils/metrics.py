@@ -0,0 +1,110 @@
+import json
+import logging
+import threading
+from bisect import bisect_left
+from django.conf import settings
+
+# Structured, one JSON object per line
+event_logger = logging.getLogger("api.metrics")
+
+SECONDS_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+PIXEL_BUCKETS = tuple(4 ** power for power in range(6, 13))  # 4096 to 16.7M
+CLUSTER_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def metrics_enabled():
+    """Whether pipeline timings are collected, exposed and logged"""
+    return getattr(settings, "METRICS_ENABLED", True)
+
+
+class Histogram:
+    """Prometheus-style histogram with one optional label, kept in process memory"""
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        # Counts per bucket, then sum and count; render() makes them cumulative
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label_value: list(counts) for label_value, counts in self._series.items()}
+
+        for label_value in sorted(series, key=str):
+            counts = series[label_value]
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {counts[-2]}")
+            lines.append(f"{self.name}_count{suffix} {counts[-1]}")
+        return "\n".join(lines)
+
+
+STAGE_SECONDS = Histogram(
+    "wardrobe_pipeline_stage_seconds",
+    "Time spent in each stage of uploading and processing an image.",
+    SECONDS_BUCKETS,
+    label="stage",
+)
+IMAGE_PIXELS = Histogram(
+    "wardrobe_pipeline_image_pixels",
+    "Pixels analysed per image: the whole decoded image, or its foreground.",
+    PIXEL_BUCKETS,
+    label="kind",
+)
+COLOUR_CLUSTERS = Histogram(
+    "wardrobe_pipeline_colour_clusters",
+    "Colour clusters found per image by the dominant colour extractor.",
+    CLUSTER_BUCKETS,
+)
+REGISTRY = (STAGE_SECONDS, IMAGE_PIXELS, COLOUR_CLUSTERS)
+
+
+def observe_stages(durations):
+    """Add a {stage: seconds} map to the stage histogram"""
+    for stage_name, seconds in durations.items():
+        STAGE_SECONDS.observe(seconds, stage_name)
+
+
+def observe_analysis(timings):
+    """Record the stage timings and counts an image analysis returned"""
+    observe_stages(timings["stages"])
+    values = timings["values"]
+    for kind in ("decoded", "foreground"):
+        if f"{kind}_pixels" in values:
+            IMAGE_PIXELS.observe(values[f"{kind}_pixels"], kind)
+    if "clusters" in values:
+        COLOUR_CLUSTERS.observe(values["clusters"])
+
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def log_event(event, **fields):
+    """Write a structured log line"""
+    event_logger.info(json.dumps({"event": event, **fields}, separators=(",", ":"), default=str))
@@ -0,0 +1,180 @@
+from collections import defaultdict
+from itertools import product
+from typing import NamedTuple
+from uuid import uuid4
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from ..models import ItemColor, PredefinedPair, FinalSelection
+from .color_matcher import get_palette
+
+PAIRS_VERSION_KEY = "colour_pairs_version"
+
+
+class Compatibility(NamedTuple):
+    version: tuple              # (palette version, pairs version)
+    colour_ids: np.ndarray      # int64, (N,) colour id of each row and column
+    matrix: np.ndarray          # bool, (N, N) indexed [top colour, bottom colour]
+    pairs: frozenset            # {(top_colour_id, bottom_colour_id)}
+    bottoms_for_top: dict       # top colour id -> [bottom colour ids]
+    tops_for_bottom: dict       # bottom colour id -> [top colour ids]
+
+
+_compatibility = None
+
+
+def get_pairs_version():
+    """Current version of the allowed colour pairs, replaced whenever a PredefinedPair changes
+
+    Like the palette version, it lives in the shared cache so every process sees edits.
+    """
+    return cache.get_or_set(PAIRS_VERSION_KEY, "initial", timeout=None)
+
+
+def invalidate_compatibility():
+    """Drop the compatibility structures built from the PredefinedPair table, in every process"""
+    cache.set(PAIRS_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+def get_compatibility():
+    """Get the allowed colour pairs as a boolean matrix, reloading them when either version changes"""
+    global _compatibility
+    palette = get_palette()
+    version = (palette.version, get_pairs_version())
+
+    if _compatibility is None or _compatibility.version != version:
+        colour_ids = palette.ids.astype(np.int64)
+        positions = np.full(int(colour_ids.max(initial=-1)) + 1, -1, dtype=np.int64)
+        positions[colour_ids] = np.arange(len(colour_ids))
+
+        pairs = frozenset(PredefinedPair.objects.values_list("top_colour_id", "bottom_colour_id"))
+        matrix = np.zeros((len(colour_ids), len(colour_ids)), dtype=bool)
+        bottoms_for_top, tops_for_bottom = defaultdict(list), defaultdict(list)
+        for top_colour_id, bottom_colour_id in pairs:
+            matrix[positions[top_colour_id], positions[bottom_colour_id]] = True
+            bottoms_for_top[top_colour_id].append(bottom_colour_id)
+            tops_for_bottom[bottom_colour_id].append(top_colour_id)
+
+        _compatibility = Compatibility(
+            version=version,
+            colour_ids=colour_ids,
+            matrix=matrix,
+            pairs=pairs,
+            bottoms_for_top=dict(bottoms_for_top),
+            tops_for_bottom=dict(tops_for_bottom),
+        )
+
+    return _compatibility
+
+
+def get_items_by_colour(item_type):
+    """Map each colour id to {clothing id: colour weight} for the items of the given type"""
+    items_by_colour = defaultdict(dict)
+    rows = ItemColor.objects.filter(clothing__item_type=item_type).values_list(
+        "clothing_id", "colour_id", "weight"
+    )
+    for clothing_id, colour_id, weight in rows:
+        items_by_colour[colour_id][clothing_id] = weight
+    return items_by_colour
+
+
+def get_allowed_pairs():
+    """Get the set of allowed (top_colour_id, bottom_colour_id) pairs"""
+    return get_compatibility().pairs
+
+
+def find_matching_pairs(tops_by_colour, bottoms_by_colour, allowed_pairs):
+    """Join tops and bottoms on the allowed colour pairs, returning {(top_id, bottom_id): score}"""
+    scores = defaultdict(float)
+    for top_colour_id, bottom_colour_id in allowed_pairs:
+        tops = tops_by_colour.get(top_colour_id)
+        bottoms = bottoms_by_colour.get(bottom_colour_id)
+        if tops and bottoms:
+            # Each shared pair adds the product of the two colours' weights
+            for (top_id, top_weight), (bottom_id, bottom_weight) in product(
+                tops.items(), bottoms.items()
+            ):
+                scores[top_id, bottom_id] += top_weight * bottom_weight
+    return scores
+
+
+def rebuild_final_selections(batch_size=500):
+    """Make FinalSelection match the current colours and pairs, returning (created, deleted)"""
+    matches = find_matching_pairs(
+        get_items_by_colour("TOP"),
+        get_items_by_colour("BOTTOM"),
+        get_allowed_pairs(),
+    )
+    existing = {
+        (top_id, bottom_id): (selection_id, score)
+        for selection_id, top_id, bottom_id, score in FinalSelection.objects.values_list(
+            "id", "top_id", "bottom_id", "score"
+        )
+    }
+    stale_ids = [
+        selection_id for pair, (selection_id, _) in existing.items() if pair not in matches
+    ]
+    rescored = [
+        FinalSelection(id=selection_id, score=round(matches[pair], 4))
+        for pair, (selection_id, score) in existing.items()
+        if pair in matches and round(matches[pair], 4) != score
+    ]
+    new_selections = [
+        FinalSelection(
+            top_id=top_id, bottom_id=bottom_id, score=round(matches[top_id, bottom_id], 4)
+        )
+        for top_id, bottom_id in matches.keys() - existing.keys()
+    ]
+
+    # Untouched pairs keep their rows (and created_at, which orders the listings)
+    with transaction.atomic():
+        for start in range(0, len(stale_ids), batch_size):
+            FinalSelection.objects.filter(id__in=stale_ids[start:start + batch_size]).delete()
+        FinalSelection.objects.bulk_update(rescored, ["score"], batch_size=batch_size)
+        FinalSelection.objects.bulk_create(
+            new_selections, ignore_conflicts=True, batch_size=batch_size
+        )
+    return len(new_selections), len(stale_ids)
+
+
+def add_item_selections(wardrobe_item, colour_weights=None):
+    """Create the FinalSelection rows pairing one item with its matching partners"""
+    if colour_weights is None:
+        colour_weights = dict(
+            ItemColor.objects.filter(clothing=wardrobe_item).values_list("colour_id", "weight")
+        )
+
+    # Find the partner colours allowed next to this item's colours
+    compatibility = get_compatibility()
+    if wardrobe_item.item_type == "TOP":
+        partner_type, partners_of = "BOTTOM", compatibility.bottoms_for_top
+    else:
+        partner_type, partners_of = "TOP", compatibility.tops_for_bottom
+
+    partner_colours = defaultdict(list)
+    for colour_id in colour_weights:
+        for partner_colour_id in partners_of.get(colour_id, ()):
+            partner_colours[partner_colour_id].append(colour_id)
+
+    # Only the opposite-type items wearing one of those colours are touched
+    scores = defaultdict(float)
+    partner_rows = ItemColor.objects.filter(
+        clothing__item_type=partner_type, colour_id__in=list(partner_colours)
+    ).values_list("clothing_id", "colour_id", "weight")
+    for partner_id, partner_colour_id, partner_weight in partner_rows:
+        for colour_id in partner_colours[partner_colour_id]:
+            scores[partner_id] += colour_weights[colour_id] * partner_weight
+
+    if wardrobe_item.item_type == "TOP":
+        new_selections = [
+            FinalSelection(top_id=wardrobe_item.id, bottom_id=partner_id, score=round(score, 4))
+            for partner_id, score in scores.items()
+        ]
+    else:
+        new_selections = [
+            FinalSelection(top_id=partner_id, bottom_id=wardrobe_item.id, score=round(score, 4))
+            for partner_id, score in scores.items()
+        ]
+
+    FinalSelection.objects.bulk_create(new_selections, ignore_conflicts=True)
+    return len(new_selections)
@@ -0,0 +1,67 @@
+import base64
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils.urls import replace_query_param
+
+# Pages are ordered newest first; id breaks ties between rows created together
+KEYSET_ORDERING = ("-created_at", "-id")
+
+
+def wants_pagination(request):
+    """Paginate only when the client asks for it, so existing callers still get a list"""
+    return "page_size" in request.query_params or "cursor" in request.query_params
+
+
+def get_page_size(request):
+    """Read the page_size parameter, capped at API_MAX_PAGE_SIZE"""
+    page_size = request.query_params.get("page_size")
+    if page_size is None:
+        return getattr(settings, "API_PAGE_SIZE", 100)
+    page_size = int(page_size)
+    if page_size < 1:
+        raise ValueError("page_size must be a positive integer")
+    return min(page_size, getattr(settings, "API_MAX_PAGE_SIZE", 1000))
+
+
+def encode_cursor(obj):
+    """Turn the position of a row into an opaque cursor"""
+    position = f"{obj.created_at.isoformat()}|{obj.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Read the (created_at, id) position out of a cursor, raising ValueError if invalid"""
+    try:
+        created_at, obj_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        created_at, obj_id = parse_datetime(created_at), int(obj_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if created_at is None:
+        raise ValueError("Invalid cursor")
+    return created_at, obj_id
+
+
+def paginate_keyset(request, queryset):
+    """Get one page of rows after the request's cursor and the URL of the next page"""
+    page_size = get_page_size(request)
+    queryset = queryset.order_by(*KEYSET_ORDERING)
+
+    cursor = request.query_params.get("cursor")
+    if cursor:
+        created_at, obj_id = decode_cursor(cursor)
+        # Seek past the last row seen instead of counting an OFFSET
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=obj_id)
+        )
+
+    # One extra row tells us whether there is a next page
+    rows = list(queryset[: page_size + 1])
+    page, has_next = rows[:page_size], len(rows) > page_size
+
+    next_url = None
+    if has_next:
+        next_url = replace_query_param(
+            request.build_absolute_uri(), "cursor", encode_cursor(page[-1])
+        )
+    return page, next_url
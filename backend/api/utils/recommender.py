@@ -0,0 +1,183 @@
+from typing import NamedTuple
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+from scipy import sparse
+from ..models import ItemColor
+from .outfit_matcher import get_compatibility
+
+
+class RecommendationMatrices(NamedTuple):
+    fingerprint: tuple
+    top_ids: np.ndarray         # int64, (T,)
+    bottom_ids: np.ndarray      # int64, (B,)
+    top_created: np.ndarray     # float64, (T,) creation time in epoch seconds
+    bottom_created: np.ndarray  # float64, (B,)
+    tops: sparse.csr_matrix     # (T, N) colour weight x match confidence
+    bottoms: sparse.csr_matrix  # (B, N)
+    top_partners: sparse.csr_matrix     # (T, N) tops x compatibility: bottom colours each top suits
+    bottom_partners: sparse.csr_matrix  # (B, N) bottoms x compatibility.T
+
+
+_matrices = None
+# (fingerprint, ranking), replaced as one tuple so threads never see a mismatched pair
+_overall = (None, None)
+
+
+def get_fingerprint():
+    """Something that changes whenever item colours, pairs or the palette do"""
+    item_colours = ItemColor.objects.aggregate(count=Count("id"), last=Max("id"))
+    return (get_compatibility().version, item_colours["count"], item_colours["last"])
+
+
+def build_item_matrix(rows, colour_index):
+    """Item x colour matrix of weight x confidence, with the item ids and creation times"""
+    item_ids, created, positions = [], [], {}
+    row_indices, col_indices, values = [], [], []
+    for clothing_id, created_at, colour_id, weight, confidence in rows:
+        if clothing_id not in positions:
+            positions[clothing_id] = len(item_ids)
+            item_ids.append(clothing_id)
+            created.append(created_at.timestamp())
+        row_indices.append(positions[clothing_id])
+        col_indices.append(colour_index[colour_id])
+        values.append(weight * confidence)
+
+    matrix = sparse.csr_matrix(
+        (values, (row_indices, col_indices)), shape=(len(item_ids), len(colour_index))
+    )
+    return np.array(item_ids, dtype=np.int64), np.array(created, dtype=np.float64), matrix
+
+
+def load_matrices(fingerprint):
+    """Read every item colour and allowed pair into sparse matrices"""
+    # Colours are numbered like the rows and columns of the compatibility matrix
+    compatibility = get_compatibility()
+    colour_index = {
+        colour_id: index for index, colour_id in enumerate(compatibility.colour_ids.tolist())
+    }
+
+    def item_rows(item_type):
+        return (
+            ItemColor.objects.filter(clothing__item_type=item_type)
+            .order_by("clothing_id")
+            .values_list("clothing_id", "clothing__created_at", "colour_id", "weight", "confidence")
+        )
+
+    top_ids, top_created, tops = build_item_matrix(item_rows("TOP"), colour_index)
+    bottom_ids, bottom_created, bottoms = build_item_matrix(item_rows("BOTTOM"), colour_index)
+
+    allowed = sparse.csr_matrix(compatibility.matrix, dtype=np.float64)
+
+    return RecommendationMatrices(
+        fingerprint=fingerprint,
+        top_ids=top_ids,
+        bottom_ids=bottom_ids,
+        top_created=top_created,
+        bottom_created=bottom_created,
+        tops=tops,
+        bottoms=bottoms,
+        top_partners=(tops @ allowed).tocsr(),
+        bottom_partners=(bottoms @ allowed.T).tocsr(),
+    )
+
+
+def get_matrices():
+    """Get the recommendation matrices, rebuilding them when the data behind them changes"""
+    global _matrices
+    fingerprint = get_fingerprint()
+    if _matrices is None or _matrices.fingerprint != fingerprint:
+        _matrices = load_matrices(fingerprint)
+    return _matrices
+
+
+def get_overall_ranking(matrices):
+    """Every compatible (top, bottom) pair by colour score, highest first, built once per data change"""
+    global _overall
+    fingerprint, ranking = _overall
+    if fingerprint != matrices.fingerprint:
+        # Every top against every bottom; only the compatible pairs are ever materialized
+        colour_scores = (matrices.top_partners @ matrices.bottoms.T).tocoo()
+        order = np.argsort(-colour_scores.data, kind="stable")
+        ranking = (colour_scores.data[order], colour_scores.row[order], colour_scores.col[order])
+        _overall = (matrices.fingerprint, ranking)
+    return ranking
+
+
+def get_recency(created, now):
+    """Halve an item's freshness every RECOMMENDATION_RECENCY_HALF_LIFE_DAYS"""
+    half_life = getattr(settings, "RECOMMENDATION_RECENCY_HALF_LIFE_DAYS", 30) * 86400
+    return 0.5 ** (np.maximum(now - created, 0) / half_life)
+
+
+def top_k(scores, k):
+    """Indices of the k highest positive scores, best first"""
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def recommend_outfits(top_id=None, bottom_id=None, k=10):
+    """Best k outfits for a top, a bottom, or overall, as (top_id, bottom_id, score)
+
+    A pair's colour score sums weight x confidence products over its allowed
+    colour pairs; RECOMMENDATION_RECENCY_WEIGHT of it depends on how recently
+    its two items were added.
+    """
+    matrices = get_matrices()
+    recency_weight = getattr(settings, "RECOMMENDATION_RECENCY_WEIGHT", 0.2)
+    now = timezone.now().timestamp()
+    top_recency = get_recency(matrices.top_created, now)
+    bottom_recency = get_recency(matrices.bottom_created, now)
+
+    if top_id is not None or bottom_id is not None:
+        if top_id is not None:
+            own_ids, own_recency, partners = matrices.top_ids, top_recency, matrices.top_partners
+            other_ids, other_recency, others = (
+                matrices.bottom_ids, bottom_recency, matrices.bottoms
+            )
+            item_id = top_id
+        else:
+            own_ids, own_recency, partners = (
+                matrices.bottom_ids, bottom_recency, matrices.bottom_partners
+            )
+            other_ids, other_recency, others = matrices.top_ids, top_recency, matrices.tops
+            item_id = bottom_id
+
+        position = np.searchsorted(own_ids, item_id)
+        if position == len(own_ids) or own_ids[position] != item_id:
+            return []
+
+        # One sparse row times the other side's colours scores every partner at once
+        colour_scores = (partners[position] @ others.T).toarray().ravel()
+        scores = colour_scores * (
+            1 - recency_weight + recency_weight * (own_recency[position] + other_recency) / 2
+        )
+        best = top_k(scores, k)
+        if top_id is not None:
+            return [(item_id, int(other_ids[i]), float(scores[i])) for i in best]
+        return [(int(other_ids[i]), item_id, float(scores[i])) for i in best]
+
+    colour_scores, top_rows, bottom_cols = get_overall_ranking(matrices)
+    if len(colour_scores) == 0:
+        return []
+    # Recency can only lower a score to (1 - weight) of its colour score, so pairs
+    # below that fraction of the k-th colour score can never make the top k
+    cutoff = (1 - recency_weight) * colour_scores[min(k, len(colour_scores)) - 1]
+    candidates = np.searchsorted(-colour_scores, -cutoff, side="right")
+    top_rows, bottom_cols = top_rows[:candidates], bottom_cols[:candidates]
+    scores = colour_scores[:candidates] * (
+        1 - recency_weight
+        + recency_weight * (top_recency[top_rows] + bottom_recency[bottom_cols]) / 2
+    )
+    best = top_k(scores, k)
+    return [
+        (
+            int(matrices.top_ids[top_rows[i]]),
+            int(matrices.bottom_ids[bottom_cols[i]]),
+            float(scores[i]),
+        )
+        for i in best
+    ]
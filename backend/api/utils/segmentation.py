@@ -0,0 +1,80 @@
+import io
+import threading
+import time
+from PIL import Image
+
+# Kept free of Django imports so process pool workers can load it directly
+_config = {"model_name": "u2net", "threads": None}
+_session = None
+_load_seconds = None
+_lock = threading.Lock()
+
+
+def configure(model_name=None, threads=None):
+    """Choose the rembg model and ONNX thread count, dropping a session built differently"""
+    global _session, _load_seconds
+    new_config = {"model_name": model_name or _config["model_name"], "threads": threads}
+    with _lock:
+        if new_config != _config:
+            _config.update(new_config)
+            _session = _load_seconds = None
+
+
+def configure_from_settings():
+    """Read the segmentation options from Django settings"""
+    from django.conf import settings
+
+    configure(
+        model_name=getattr(settings, "REMBG_MODEL", None),
+        threads=getattr(settings, "REMBG_THREADS", None),
+    )
+
+
+def _create_session():
+    """Load the ONNX model behind a rembg session"""
+    import onnxruntime as ort
+    from rembg import new_session
+
+    sess_opts = ort.SessionOptions()
+    if _config["threads"]:
+        sess_opts.intra_op_num_threads = _config["threads"]
+        sess_opts.inter_op_num_threads = 1
+    return new_session(_config["model_name"], sess_opts=sess_opts)
+
+
+def get_session():
+    """Get the process-wide rembg session, loading the model once on first use"""
+    global _session, _load_seconds
+    if _session is None:
+        with _lock:
+            if _session is None:
+                start = time.perf_counter()
+                _session = _create_session()
+                _load_seconds = time.perf_counter() - start
+    return _session
+
+
+def warm_up():
+    """Load the model and run one tiny inference so the first upload pays nothing"""
+    from rembg import remove
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), (255, 255, 255)).save(buffer, "PNG")
+    remove(buffer.getvalue(), session=get_session())
+
+
+def preload(model_name=None, threads=None):
+    """Configure and warm up the session; used at startup and as a pool initializer"""
+    if model_name or threads:
+        configure(model_name=model_name, threads=threads)
+    warm_up()
+
+
+def health():
+    """Describe the state of the segmentation session"""
+    return {
+        "model": _config["model_name"],
+        "threads": _config["threads"],
+        "loaded": _session is not None,
+        "load_seconds": _load_seconds,
+    }
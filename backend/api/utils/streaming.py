@@ -0,0 +1,68 @@
+import json
+import logging
+from itertools import islice
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+logger = logging.getLogger(__name__)
+
+STREAM_CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def dumps(row):
+    """Encode serialized data the way DRF's JSONRenderer would"""
+    return json.dumps(row, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":"))
+
+
+def iter_serialized_chunks(queryset, serializer_class, context, chunk_size):
+    """Serialize a queryset one chunk at a time, never holding more than a chunk of rows"""
+    # With a chunk_size, iterator() also runs the queryset's prefetches per chunk
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield serializer_class(chunk, many=True, context=context).data
+
+
+def iter_json_array(chunks):
+    """Render serialized chunks as the parts of a single JSON array"""
+    yield "["
+    first = True
+    for chunk in chunks:
+        # Encode the chunk as one list and drop its brackets
+        yield ("" if first else ",") + dumps(chunk)[1:-1]
+        first = False
+    yield "]"
+
+
+def iter_ndjson(chunks):
+    """Render serialized chunks as newline-delimited JSON, one row per line"""
+    for chunk in chunks:
+        yield "".join(dumps(row) + "\n" for row in chunk)
+
+
+def stream_serialized(queryset, serializer_class, stream_format, context=None):
+    """Build a StreamingHttpResponse that serializes the queryset as it is sent"""
+    if stream_format not in STREAM_CONTENT_TYPES:
+        raise ValueError(f"stream must be one of: {', '.join(STREAM_CONTENT_TYPES)}")
+
+    chunk_size = getattr(settings, "STREAM_CHUNK_SIZE", 500)
+    chunks = iter_serialized_chunks(queryset, serializer_class, context, chunk_size)
+    parts = iter_json_array(chunks) if stream_format == "json" else iter_ndjson(chunks)
+
+    def logged(parts):
+        # The status line is already sent, so a failure can only be logged
+        try:
+            yield from parts
+        except Exception as e:
+            logger.error(f"Error streaming {serializer_class.__name__} rows: {str(e)}")
+            raise
+
+    return StreamingHttpResponse(
+        logged(parts), content_type=STREAM_CONTENT_TYPES[stream_format]
+    )
@@ -0,0 +1,133 @@
+import hashlib
+import io
+import random
+import numpy as np
+from PIL import Image, ImageDraw
+from ..models import Colour, ItemColor, WardrobeItem
+from ..storage import wardrobe_image_name
+from .outfit_matcher import rebuild_final_selections
+
+# Garment outlines on a unit square, drawn as polygons over a white background
+GARMENT_OUTLINES = {
+    # T-shirt: shoulders, short sleeves, body
+    "TOP": [
+        (0.30, 0.10), (0.70, 0.10), (0.95, 0.30), (0.85, 0.42), (0.75, 0.35),
+        (0.75, 0.92), (0.25, 0.92), (0.25, 0.35), (0.15, 0.42), (0.05, 0.30),
+    ],
+    # Trousers: waistband and two legs
+    "BOTTOM": [
+        (0.25, 0.05), (0.75, 0.05), (0.80, 0.95), (0.57, 0.95), (0.50, 0.40),
+        (0.43, 0.95), (0.20, 0.95),
+    ],
+}
+
+
+def random_shares(rng, count, min_share=0.15):
+    """count pixel shares adding up to 1, largest first, each at least min_share"""
+    min_share = min(min_share, 1 / count)
+    cuts = sorted(rng.uniform(0, 1 - count * min_share) for _ in range(count - 1))
+    spans = [end - start for start, end in zip([0, *cuts], [*cuts, 1 - count * min_share])]
+    return sorted((round(min_share + span, 4) for span in spans), reverse=True)
+
+
+def draw_garment(colours, item_type, size=256, noise=6.0, seed=0):
+    """Render a flat-lay garment striped in weighted colours, returning (image, mask)
+
+    colours are (r, g, b, share) rows; each colour covers its share of the
+    garment. The mask is the garment's outline, as a segmentation model would find it.
+    """
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).polygon(
+        [(x * size, y * size) for x, y in GARMENT_OUTLINES[item_type]], fill=255
+    )
+    garment = np.asarray(mask) > 0
+
+    # Horizontal bands, each as tall as its colour's share of the garment's rows
+    rows = np.flatnonzero(garment.any(axis=1))
+    shares = np.array([share for *_, share in colours], dtype=np.float64)
+    bounds = rows[0] + np.round(np.cumsum(shares / shares.sum()) * len(rows)).astype(int)
+    pixels = np.full((size, size, 3), 255, dtype=np.float64)
+    top = rows[0]
+    for (r, g, b, _), bottom in zip(colours, bounds):
+        band = garment.copy()
+        band[:top] = band[bottom:] = False
+        pixels[band] = (r, g, b)
+        top = bottom
+
+    # Fabric texture, so extractors see spread-out clusters rather than flat colours
+    rng = np.random.default_rng(seed)
+    pixels[garment] += rng.normal(0, noise, size=(int(garment.sum()), 3))
+    image = Image.fromarray(np.clip(np.round(pixels), 0, 255).astype(np.uint8), "RGB")
+    return image, mask
+
+
+def generate_garment_images(count, size=256, seed=0, palette=None):
+    """Synthetic garment photos as (name, JPEG bytes, PNG mask bytes, colours) tuples
+
+    Colours are drawn from palette, (r, g, b) tuples, or at random without one.
+    """
+    rng = random.Random(seed)
+    samples = []
+    for index in range(count):
+        item_type = "TOP" if index % 2 == 0 else "BOTTOM"
+        colours = [
+            (*(rng.choice(palette) if palette else [rng.randrange(256) for _ in range(3)]), share)
+            for share in random_shares(rng, rng.randint(1, 3))
+        ]
+        image, mask = draw_garment(colours, item_type, size, seed=seed + index)
+
+        image_buffer, mask_buffer = io.BytesIO(), io.BytesIO()
+        image.save(image_buffer, "JPEG", quality=90)
+        mask.save(mask_buffer, "PNG", optimize=True)
+        samples.append(
+            (f"synthetic-{index}.jpg", image_buffer.getvalue(), mask_buffer.getvalue(), colours)
+        )
+    return samples
+
+
+def generate_wardrobe(n_tops, n_bottoms, seed=0, max_colours=3):
+    """Insert synthetic processed items wearing weighted colours of the Colour palette
+
+    Their outfits are materialized too, as uploads would have done. Items have
+    image names but no stored files. Returns the items.
+    """
+    palette = list(Colour.objects.all())
+    palette_by_type = {
+        item_type: [colour for colour in palette if colour.type in (item_type, "BOTH")]
+        for item_type in ("TOP", "BOTTOM")
+    }
+    if not palette_by_type["TOP"] or not palette_by_type["BOTTOM"]:
+        raise ValueError("The Colour palette needs colours for both tops and bottoms")
+
+    rng = random.Random(seed)
+    items = []
+    for item_type, count in (("TOP", n_tops), ("BOTTOM", n_bottoms)):
+        for index in range(count):
+            content_hash = hashlib.sha256(f"synthetic-{seed}-{item_type}-{index}".encode()).hexdigest()
+            items.append(
+                WardrobeItem(
+                    image=wardrobe_image_name(f"{content_hash}.jpg"),
+                    content_hash=content_hash,
+                    item_type=item_type,
+                    color_status="DONE",
+                )
+            )
+    items = WardrobeItem.objects.bulk_create(items)
+
+    item_colours = []
+    for item in items:
+        pool = palette_by_type[item.item_type]
+        count = rng.randint(1, min(max_colours, len(pool)))
+        for colour, share in zip(rng.sample(pool, count), random_shares(rng, count)):
+            item_colours.append(
+                ItemColor(
+                    clothing=item,
+                    colour=colour,
+                    weight=share,
+                    confidence=round(rng.uniform(0.5, 1.0), 4),
+                )
+            )
+    ItemColor.objects.bulk_create(item_colours, batch_size=1000)
+
+    rebuild_final_selections()
+    return items
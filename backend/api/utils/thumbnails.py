@@ -0,0 +1,66 @@
+import io
+import os
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.urls import reverse
+from PIL import Image, ImageOps
+from ..storage import shard_name
+from .uploads import BufferReader
+
+
+def get_thumbnail_sizes():
+    """Widths, in pixels, of the derivative images served for each upload"""
+    return tuple(getattr(settings, "THUMBNAIL_SIZES", (128, 256, 512)))
+
+
+def thumbnail_name(image_name, size):
+    """Storage name of an image's derivative at the given size"""
+    return shard_name(f"thumbnails/{size}", f"{os.path.basename(image_name)}.webp")
+
+
+def flat_thumbnail_name(image_name, size):
+    """Storage name the derivative had before thumbnails were sharded"""
+    return f"thumbnails/{size}/{os.path.basename(image_name)}.webp"
+
+
+def render_thumbnail(image_bytes, size):
+    """Shrink an image to the given width and encode it as WebP"""
+    image = Image.open(BufferReader(image_bytes))
+    # Decode JPEGs at a reduced scale; the resize below does the rest
+    image.draft("RGB", (size, size))
+    image = ImageOps.exif_transpose(image)
+    # srcset advertises widths, so only the width is constrained
+    image.thumbnail((size, image.height), reducing_gap=2.0)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+    output = io.BytesIO()
+    image.save(output, "WEBP", quality=getattr(settings, "THUMBNAIL_QUALITY", 80))
+    return output.getvalue()
+
+
+def create_thumbnails(storage, image_name, image_bytes=None, sizes=None):
+    """Write the missing derivatives of an image, returning their storage names"""
+    names = {}
+    for size in sizes or get_thumbnail_sizes():
+        name = thumbnail_name(image_name, size)
+        if not storage.exists(name):
+            if image_bytes is None:
+                with storage.open(image_name, "rb") as img_file:
+                    image_bytes = img_file.read()
+            storage.save(name, ContentFile(render_thumbnail(image_bytes, size)))
+        names[size] = name
+    return names
+
+
+def get_srcset(image_name, request=None):
+    """srcset attribute value listing an image's derivatives, widest last"""
+    if not image_name:
+        return None
+    urls = []
+    for size in get_thumbnail_sizes():
+        url = reverse("thumbnail", args=[size, os.path.basename(image_name)])
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        urls.append(f"{url} {size}w")
+    return ", ".join(urls)
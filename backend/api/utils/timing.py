@@ -0,0 +1,70 @@
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+# Timer of the analysis running in this thread or process, if it is being timed
+_current_timer = ContextVar("stage_timer", default=None)
+
+_untimed = nullcontext()
+
+
+class StageTimer:
+    """Collects how long named stages take, plus counts such as pixels or clusters
+
+    Code anywhere below `with timer:` reports through stage() and record(),
+    which do nothing when no timer is active. A disabled timer never becomes
+    active, so that code runs untimed.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.durations = {}
+        self.values = {}
+        self._token = None
+
+    def __enter__(self):
+        if self.enabled:
+            self._token = _current_timer.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._token is not None:
+            _current_timer.reset(self._token)
+            self._token = None
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def as_dict(self):
+        return {"stages": self.durations, "values": self.values}
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        durations = self.timer.durations
+        # A stage entered several times adds up
+        durations[self.name] = durations.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+def stage(name):
+    """Time a block as the named stage of the active timer"""
+    timer = _current_timer.get()
+    if timer is None:
+        return _untimed
+    return _Stage(timer, name)
+
+
+def record(name, value):
+    """Attach a value, e.g. a pixel count, to the active timer"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.values[name] = value
@@ -0,0 +1,57 @@
+import io
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable, read-only file over a bytes-like object, so decoders don't copy it up front
+
+    io.BytesIO copies anything that isn't bytes; this reads straight out of
+    the caller's buffer (bytes, bytearray or memoryview).
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._buffer[self._position:self._position + len(b)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def read_upload(upload):
+    """Content of an uploaded file as a memoryview, read into memory at most once
+
+    Uploads Django kept in memory are shared rather than copied; the ones it
+    spooled to a temporary file are read into a single preallocated buffer.
+    """
+    if isinstance(upload.file, io.BytesIO):
+        # getvalue() hands over the BytesIO's own bytes when it can, and unlike
+        # getbuffer() leaves nothing exported that would stop it closing
+        return memoryview(upload.file.getvalue())
+
+    buffer = bytearray(upload.size)
+    upload.file.seek(0)
+    size = upload.file.readinto(buffer)
+    upload.file.seek(0)
+    return memoryview(buffer)[:size]
@@ -1,25 +1,46 @@
-import os
-from django.db import IntegrityError
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework import status
-from .models import WardrobeItem, Colour, ItemColor, PredefinedPair, FinalSelection
+from .models import WardrobeItem, ItemColor, FinalSelection, record_file_tombstones
 from .serializers import WardrobeItemSerializer, FinalSelectionSerializer
+from .storage import wardrobe_image_name
 import logging
-from .utils.color_processor import process_uploaded_image
-from .utils.color_matcher import get_top_matches_within_threshold
-from itertools import product
+from .utils.image_pipeline import enqueue_item, enqueue_items, create_wardrobe_items
+from .utils import segmentation
+from .utils.metrics import log_event, metrics_enabled, observe_stages, render_metrics
+from .utils.pagination import paginate_keyset, wants_pagination
+from .utils.recommender import recommend_outfits
+from .utils.streaming import stream_serialized
+from .utils.thumbnails import create_thumbnails, get_thumbnail_sizes
+from .utils.timing import StageTimer
 
 logger = logging.getLogger(__name__)
 
 
+def log_upload(wardrobe_items, contents, timer):
+    """Record how long storing and queueing an upload took, and log it"""
+    if not metrics_enabled():
+        return
+    observe_stages(timer.durations)
+    log_event(
+        "upload",
+        item_ids=[item.id for item in wardrobe_items],
+        item_types=[item.item_type for item in wardrobe_items],
+        bytes=sum(len(content) for content in contents),
+        stages={name: round(seconds, 6) for name, seconds in timer.durations.items()},
+    )
+
+
 @api_view(["POST"])
 @parser_classes([MultiPartParser, FormParser])
 def upload_image(request):
     try:
-        print(" Uploading image...")
         image = request.FILES.get("image")
         item_type = request.data.get("item_type")
 
@@ -29,46 +50,74 @@ def upload_image(request):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Create wardrobe item first
-        wardrobe_item = WardrobeItem.objects.create(image=image, item_type=item_type)
+        # Create wardrobe item first, its colours are assigned in the background
+        # from the bytes already read off the upload
+        timer = StageTimer()
+        with timer.stage("ingest"):
+            (wardrobe_item,), (content,) = create_wardrobe_items([image], [item_type])
+        with timer.stage("enqueue"):
+            enqueue_item(wardrobe_item.id, content)
+        log_upload([wardrobe_item], [content], timer)
+        wardrobe_item.refresh_from_db()
+
+        serializer = WardrobeItemSerializer(wardrobe_item, context={"request": request})
+
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
-        # Process the saved image
-        try:
-            # Get the path to the saved image
-            image_path = os.path.join(settings.MEDIA_ROOT, str(wardrobe_item.image))
+    except Exception as e:
+        logger.error(f"Error in upload_image: {str(e)}")
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # Read the saved image file
-            with open(image_path, "rb") as img_file:
-                image_bytes = img_file.read()
 
-            # Process the image
-            dominant_rgb = process_uploaded_image(image_bytes)
-            print(f"{image} Dominant RGB: {dominant_rgb}")
+@api_view(["POST"])
+@parser_classes([MultiPartParser, FormParser])
+def upload_batch(request):
+    try:
+        images = request.FILES.getlist("images")
+        item_types = request.data.getlist("item_types") or request.data.getlist("item_type")
+
+        # A single item type applies to every image in the batch
+        if len(item_types) == 1:
+            item_types = item_types * len(images)
 
-            # Get top matching colors
-            matching_color_ids = get_top_matches_within_threshold(
-                r=dominant_rgb[0],
-                g=dominant_rgb[1],
-                b=dominant_rgb[2],
-                item_type=item_type,
+        if not images or len(item_types) != len(images):
+            return Response(
+                {"error": "Images and one item type per image are required"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-            # Create ItemColor entries
-            for color_id in matching_color_ids:
-                colour = Colour.objects.get(id=color_id)
-                ItemColor.objects.create(clothing=wardrobe_item, colour=colour)
+        valid_types = dict(WardrobeItem.ITEM_TYPES)
+        if any(item_type not in valid_types for item_type in item_types):
+            return Response(
+                {"error": f"Item type must be one of {', '.join(valid_types)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        except Exception as e:
-            logger.error(f"Error processing image colors: {str(e)}")
-            logger.error(f"Image path: {image_path}")
-            pass
+        max_files = getattr(settings, "BATCH_UPLOAD_MAX_FILES", 200)
+        if len(images) > max_files:
+            return Response(
+                {"error": f"At most {max_files} images can be uploaded at once"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        serializer = WardrobeItemSerializer(wardrobe_item, context={"request": request})
+        # Store every item in one insert, the whole batch is processed together
+        timer = StageTimer()
+        with timer.stage("ingest"):
+            wardrobe_items, contents = create_wardrobe_items(images, item_types)
+        item_ids = [item.id for item in wardrobe_items]
+        with timer.stage("enqueue"):
+            enqueue_items(item_ids, dict(zip(item_ids, contents)))
+        log_upload(wardrobe_items, contents, timer)
 
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        serializer = WardrobeItemSerializer(
+            WardrobeItem.objects.filter(id__in=item_ids),
+            many=True,
+            context={"request": request},
+        )
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
     except Exception as e:
-        logger.error(f"Error in upload_image: {str(e)}")
+        logger.error(f"Error in upload_batch: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
@@ -76,30 +125,64 @@ def upload_image(request):
 def get_wardrobe_items(request):
     try:
         item_type = request.query_params.get("type")
+        colour_id = request.query_params.get("colour")
         queryset = WardrobeItem.objects.all()
 
         if item_type:
             queryset = queryset.filter(item_type=item_type)
-        serializer = WardrobeItemSerializer(
-            queryset, many=True, context={"request": request}
-        )
-        return Response(serializer.data)
+        if colour_id:
+            queryset = queryset.filter(colors__colour_id=int(colour_id))
+
+        stream_format = request.query_params.get("stream")
+        if stream_format:
+            return stream_serialized(
+                queryset, WardrobeItemSerializer, stream_format, context={"request": request}
+            )
+
+        if not wants_pagination(request):
+            serializer = WardrobeItemSerializer(
+                queryset, many=True, context={"request": request}
+            )
+            return Response(serializer.data)
 
+        page, next_url = paginate_keyset(request, queryset)
+        serializer = WardrobeItemSerializer(page, many=True, context={"request": request})
+        return Response({"next": next_url, "results": serializer.data})
+
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error in get_wardrobe_items: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(["GET"])
+def get_processing_status(request, item_id):
+    try:
+        item = WardrobeItem.objects.get(id=item_id)
+        return Response(
+            {
+                "id": item.id,
+                "color_status": item.color_status,
+                "processing_attempts": item.processing_attempts,
+                "processing_error": item.processing_error,
+                "processed_at": item.processed_at,
+                "colors": item.colors.values_list("colour__name", flat=True),
+            }
+        )
+
+    except WardrobeItem.DoesNotExist:
+        return Response({"error": "Item not found"}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(["DELETE"])
 def delete_wardrobe_item(request, item_id):
     try:
         item = WardrobeItem.objects.get(id=item_id)
 
-        # Delete the actual image file
-        if item.image:
-            if os.path.isfile(item.image.path):
-                os.remove(item.image.path)
-
+        # Its image file is swept later, unless an identical upload still uses it
         item.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -112,86 +195,108 @@ def delete_wardrobe_item(request, item_id):
 @api_view(["GET"])
 def get_final_selections(request):
     try:
-        # 1. Get all clothing items with their colors
-        tops_with_colors = (
-            ItemColor.objects.filter(clothing__item_type="TOP")
-            .values("clothing_id", "colour_id")
-            .distinct()
+        # Selections are materialized on upload, so this is a pure read. The colours
+        # of every top and bottom are fetched in one query each
+        item_colours = ItemColor.objects.select_related("colour")
+        final_selections = FinalSelection.objects.select_related("top", "bottom").prefetch_related(
+            Prefetch("top__colors", queryset=item_colours),
+            Prefetch("bottom__colors", queryset=item_colours),
         )
 
-        bottoms_with_colors = (
-            ItemColor.objects.filter(clothing__item_type="BOTTOM")
-            .values("clothing_id", "colour_id")
-            .distinct()
-        )
+        top_id = request.query_params.get("top")
+        bottom_id = request.query_params.get("bottom")
+        colour_id = request.query_params.get("colour")
+        if top_id:
+            final_selections = final_selections.filter(top_id=int(top_id))
+        if bottom_id:
+            final_selections = final_selections.filter(bottom_id=int(bottom_id))
+        if colour_id:
+            # Outfits where either the top or the bottom wears the colour
+            wearing_colour = ItemColor.objects.filter(colour_id=int(colour_id)).values(
+                "clothing_id"
+            )
+            final_selections = final_selections.filter(
+                Q(top_id__in=wearing_colour) | Q(bottom_id__in=wearing_colour)
+            )
 
-        # 2. Get all valid color pairs from PredefinedPair
-        predefined_pairs = PredefinedPair.objects.all().values(
-            "top_colour_id", "bottom_colour_id"
-        )
+        stream_format = request.query_params.get("stream")
+        if stream_format:
+            return stream_serialized(
+                final_selections,
+                FinalSelectionSerializer,
+                stream_format,
+                context={"request": request},
+            )
 
-        # 3. Create final selections
-        new_selections = []
-        # Get existing pairs to avoid duplicates
-        existing_pairs = set(FinalSelection.objects.values_list("top_id", "bottom_id"))
-
-        # For each top and bottom combination
-        for top_item, bottom_item in product(tops_with_colors, bottoms_with_colors):
-            try:
-                top_clothing_id = top_item["clothing_id"]
-                bottom_clothing_id = bottom_item["clothing_id"]
-
-                # Skip if this pair already exists
-                if (top_clothing_id, bottom_clothing_id) in existing_pairs:
-                    continue
-
-                # Check if their colors match in predefined pairs
-                color_match = predefined_pairs.filter(
-                    top_colour_id=top_item["colour_id"],
-                    bottom_colour_id=bottom_item["colour_id"],
-                ).exists()
-
-                if color_match:
-                    try:
-                        FinalSelection.objects.create(
-                            top_id=top_clothing_id, bottom_id=bottom_clothing_id
-                        )
-                    except IntegrityError:
-                        # If duplicate entry, just skip and continue
-                        continue
-
-            except Exception as e:
-                # Log the error but continue processing other pairs
-                logger.error(
-                    f"Error processing pair {top_item}, {bottom_item}: {str(e)}"
-                )
-                continue
-
-        # 4. Return all final selections with images
-        final_selections = FinalSelection.objects.select_related("top", "bottom").all()
-        serializer = FinalSelectionSerializer(
-            final_selections, many=True, context={"request": request}
-        )
+        if not wants_pagination(request):
+            serializer = FinalSelectionSerializer(
+                final_selections, many=True, context={"request": request}
+            )
+            return Response(serializer.data)
 
-        return Response(serializer.data)
+        page, next_url = paginate_keyset(request, final_selections)
+        serializer = FinalSelectionSerializer(page, many=True, context={"request": request})
+        return Response({"next": next_url, "results": serializer.data})
 
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error generating final selections: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(["GET"])
+def get_recommendations(request):
+    try:
+        top_id = request.query_params.get("top")
+        bottom_id = request.query_params.get("bottom")
+        if top_id and bottom_id:
+            raise ValueError("Pass either top or bottom, not both")
+
+        k = int(request.query_params.get("k", getattr(settings, "RECOMMENDATION_K", 10)))
+        if k < 1:
+            raise ValueError("k must be a positive integer")
+        k = min(k, getattr(settings, "RECOMMENDATION_MAX_K", 100))
+
+        outfits = recommend_outfits(
+            top_id=int(top_id) if top_id else None,
+            bottom_id=int(bottom_id) if bottom_id else None,
+            k=k,
+        )
+
+        # The items of every recommended outfit in one query
+        item_ids = {item_id for top, bottom, _ in outfits for item_id in (top, bottom)}
+        items = WardrobeItem.objects.in_bulk(item_ids)
+        context = {"request": request}
+        return Response([
+            {
+                "top": WardrobeItemSerializer(items[top], context=context).data,
+                "bottom": WardrobeItemSerializer(items[bottom], context=context).data,
+                "score": round(score, 4),
+            }
+            for top, bottom, score in outfits
+            if top in items and bottom in items
+        ])
+
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        logger.error(f"Error generating recommendations: {str(e)}")
+        return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(["DELETE"])
 def delete_all_items(request, item_type):
     try:
         # Delete all items of the specified type
         items = WardrobeItem.objects.filter(item_type=item_type)
-        # Delete the actual image file
-        for item in items:
-          if item.image:
-              if os.path.isfile(item.image.path):
-                  os.remove(item.image.path)
-        count = items.count()
-        items.delete()
+        with transaction.atomic():
+            image_names = list(items.values_list("image", flat=True).distinct())
+            # The cascade still collects the items, but only needs their ids
+            _, deleted = items.only("id").delete()
+            # The files are deleted later by the sweep_files command
+            record_file_tombstones(image_names)
+        count = deleted.get(WardrobeItem._meta.label, 0)
 
         return Response(
             {
@@ -202,3 +307,62 @@ def delete_all_items(request, item_type):
     except Exception as e:
         logger.error(f"Error deleting {item_type} items: {str(e)}")
         return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(["GET", "POST"])
+def segmentation_health(request):
+    try:
+        # POST loads the model and runs a warm-up inference if it isn't loaded yet
+        if request.method == "POST":
+            segmentation.warm_up()
+        return Response(segmentation.health())
+
+    except Exception as e:
+        logger.error(f"Segmentation health check failed: {str(e)}")
+        return Response(
+            {**segmentation.health(), "error": str(e)},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+
+
+# A plain Django view: browsers ask for image types that DRF's JSON-only
+# content negotiation would reject
+@require_GET
+def get_thumbnail(request, size, name):
+    try:
+        storage = WardrobeItem._meta.get_field("image").storage
+        if size not in get_thumbnail_sizes():
+            raise Http404("Thumbnail not found")
+        # Images not yet moved by relocate_images still sit in the flat directory
+        image_name = next(
+            (
+                candidate
+                for candidate in (wardrobe_image_name(name), f"wardrobe/{name}")
+                if storage.exists(candidate)
+            ),
+            None,
+        )
+        if image_name is None:
+            raise Http404("Thumbnail not found")
+
+        # Rendered on the first request and read from disk afterwards
+        thumbnail = create_thumbnails(storage, image_name, sizes=[size])[size]
+        response = FileResponse(storage.open(thumbnail, "rb"), content_type="image/webp")
+        # Images are named after their content, so a derivative never changes
+        response["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+    except Http404:
+        raise
+    except Exception as e:
+        logger.error(f"Error serving {size}px thumbnail of {name}: {str(e)}")
+        return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@require_GET
+def metrics(request):
+    """Pipeline metrics in the Prometheus text format, for local scrapers only"""
+    allowed_ips = getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])
+    if not metrics_enabled() or request.META.get("REMOTE_ADDR") not in allowed_ips:
+        raise Http404("Metrics are not available")
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -87,6 +87,23 @@ DATABASES = {
         'PORT': '5432',
     }
 }
+# WARDROBE_DATABASE=sqlite switches to a local SQLite file, e.g. to run the
+# offline benchmarks without Postgres
+if os.environ.get('WARDROBE_DATABASE') == 'sqlite':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+    }
+
+# Shared by every process (web workers, process_uploads, reclassify), so the
+# palette and colour pair versions bumped by one reach the others. Create the
+# table with `python manage.py createcachetable`
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'wardrobe_cache',
+    }
+}
 
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # Next.js development server
@@ -132,6 +149,12 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Cursor pagination of the list endpoints, used when a client sends page_size or cursor
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Rows serialized per batch by the ?stream=json / ?stream=ndjson export mode
+STREAM_CHUNK_SIZE = 500
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
@@ -150,6 +173,98 @@ import os
 if not os.path.exists(MEDIA_ROOT):
     os.makedirs(MEDIA_ROOT)
 
+# Wardrobe images and their thumbnails live in the "wardrobe" storage. Any
+# Django storage backend can be plugged in; mix api.storage.ContentAddressedMixin
+# into it (e.g. an S3 backend with endpoint_url pointing at MinIO) so identical
+# uploads are stored once
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'wardrobe': {'BACKEND': 'api.storage.ContentAddressedStorage'},
+}
+# Levels of two-character hash-prefix directories files are sharded into,
+# e.g. wardrobe/ab/cd/abcd....jpg. Run the relocate_images command after a change
+MEDIA_SHARD_DEPTH = 2
+# Deleting items only records file tombstones; the sweep_files command deletes
+# the files, FILE_GC_BATCH_SIZE at a time, once they are FILE_GC_GRACE_SECONDS old
+FILE_GC_BATCH_SIZE = 500
+FILE_GC_GRACE_SECONDS = 300
+
+# Image processing pipeline
+# "thread" runs jobs on an in-process worker pool, "queue" leaves them for
+# `manage.py process_uploads` and "sync" processes inside the request
+IMAGE_PROCESSING_BACKEND = 'thread'
+IMAGE_PROCESSING_WORKERS = 2
+IMAGE_PROCESSING_MAX_ATTEMPTS = 3
+# Seconds before a failed item is retried, doubling with each attempt
+# (thread and queue backends; "sync" retries at once)
+IMAGE_PROCESSING_RETRY_DELAY = 30
+# Upload bytes queued thread-pool jobs may keep in memory; past it, jobs read
+# their stored file instead
+IMAGE_QUEUE_MAX_BYTES = 64 * 1024 * 1024
+# Processes used to segment batch uploads in parallel (None = one per CPU, 0 = inline)
+IMAGE_PROCESSING_PROCESSES = None
+
+# Background removal: rembg model, ONNX intra-op threads (None = ONNX default)
+# and whether to load the model when the WSGI application starts
+REMBG_MODEL = 'u2net'
+REMBG_THREADS = None
+REMBG_PRELOAD = True
+# Longest side, in pixels, images are shrunk to before segmentation (None = full size)
+IMAGE_ANALYSIS_MAX_SIZE = 512
+# Dominant colour extractor: "meanshift", "histogram", "kmeans" or "median_cut"
+COLOUR_EXTRACTOR = 'meanshift'
+# Colours kept per item: the largest clusters, up to COLOUR_CLUSTERS, that cover
+# at least COLOUR_MIN_SHARE of the foreground (the dominant one is always kept).
+# Up to 8 clusters are stored, so `reclassify --rematch-only` applies a change
+COLOUR_CLUSTERS = 3
+COLOUR_MIN_SHARE = 0.15
+# Palette matching index: None for an exact scan, "lut" for a precomputed
+# quantized-RGB lookup table (RGB space, nearest colour only)
+COLOUR_MATCH_INDEX = None
+# Colour space for palette matching: "rgb" (Euclidean, max_distance 55) or
+# "lab" (CIEDE2000, with the per-item-type thresholds below)
+COLOUR_MATCH_SPACE = 'rgb'
+COLOUR_MATCH_DELTA_E = {'TOP': 15, 'BOTTOM': 15}
+
+# Resized WebP copies of each upload, listed in the serializers' srcset fields.
+# They are written by the image pipeline and, for older uploads, on first request
+THUMBNAIL_SIZES = (128, 256, 512)
+THUMBNAIL_QUALITY = 80
+
+# Outfit recommendations: outfits returned by default and at most, and how much of
+# a score comes from recency (items lose half their freshness every half-life)
+RECOMMENDATION_K = 10
+RECOMMENDATION_MAX_K = 100
+RECOMMENDATION_RECENCY_WEIGHT = 0.2
+RECOMMENDATION_RECENCY_HALF_LIFE_DAYS = 30
+
+# Batch uploads
+BATCH_UPLOAD_MAX_FILES = 200
+# Threads writing a batch's distinct files to storage at the same time
+IMAGE_UPLOAD_WRITE_WORKERS = 4
+DATA_UPLOAD_MAX_NUMBER_FILES = BATCH_UPLOAD_MAX_FILES
+
+# Image pipeline metrics: per-stage timings, pixel and cluster counts, served in
+# the Prometheus text format at /api/metrics/ to the addresses below, and one
+# JSON log line per upload and processed item on the "api.metrics" logger
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json_line': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'metrics': {'class': 'logging.StreamHandler', 'formatter': 'json_line'},
+    },
+    'loggers': {
+        'api.metrics': {'handlers': ['metrics'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
 
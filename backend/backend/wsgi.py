@@ -14,3 +14,16 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Load the segmentation model before serving (and, with `gunicorn --preload`,
+# before forking) so the first upload after a deploy doesn't pay for it
+import logging
+from django.conf import settings
+
+if settings.REMBG_PRELOAD:
+    from api.utils import segmentation
+
+    try:
+        segmentation.preload()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Could not preload segmentation model: {str(e)}")